@@ -4,16 +4,31 @@
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
 import asyncio
+import importlib.util
+import io
+import math
 import os
-import re
+import signal
+import sys
 import traceback
 import subprocess
 import threading
+import time
+from collections import deque
 from queue import Queue
 
+BOOT = time.perf_counter()  # Startup report starts counting here, everything below counts as import time
+
 import discord
 from discord.ext import commands
 from tony_modules.storage import JSONStore
+from tony_modules.admission import Admission, MAX_QUEUE
+from tony_modules.router import Router, MessageInfo, substitute_pipes
+from tony_modules.metrics import REGISTRY
+from tony_modules.outbox import CoalescingContext, Outbox, WINDOW
+from tony_modules.watchdog import LoopWatchdog, all_tasks, current_task
+from tony_modules.profiling import Profile
+from tony_modules import offload, supervisor, tracing
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # GLOBAL DEFINITIONS
@@ -27,14 +42,52 @@ MODULES = [
     'tony_modules.financial_funcs'
 ]
 
+MANIFEST_FILE = os.path.join(ROOTPATH, 'storage', 'manifest.json')  # What each module registers, so commands-only modules can start as stubs
+HELP_HEADER = '```diff\n<arg>: Mandatory | [arg]: Optional | (arg): Default value | ...: Can provide multiple values\nYou can also pipeline commands using $(<command>), i.e. !speak $(!joke)\n=========='
+PENDING_FILE = os.path.join(ROOTPATH, 'storage', 'pending.json')  # Commands a bot handing over (see tony_modules/supervisor.py) didn't get to
+
+CORE_MODULES = [  # Hold state the whole bot shares, a change to any of these still needs a restart
+    'TSpark',
+    'tony_modules.metrics',
+    'tony_modules.tracing',
+    'tony_modules.router',
+    'tony_modules.watchdog',
+    'tony_modules.profiling',
+    'tony_modules.outbox',
+    'tony_modules.ratelimit',
+    'tony_modules.admission',
+    'tony_modules.offload'
+]
+
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # CLASSES
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
+class RestartNeeded(Exception):
+    pass
+
+
 class Tony(commands.Bot):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.config = JSONStore(os.path.join(ROOTPATH, 'storage', 'config.json'))  # Auxiliary global variables
+        self.router = Router(self)  # Every message goes through here, cogs register handlers with it instead of listening to on_message
+        self.manifest = JSONStore(MANIFEST_FILE)
+        self.stubs = {}  # Command name or alias: module it's a stand-in for, until that module is imported
+        self.startup = [('imports', time.perf_counter() - BOOT)]  # (step, seconds) for the startup report
+        self.tasks = {}  # Module: background tasks it started, its teardown stops them
+        self.handoff = {}  # Module: state its teardown left behind for the setup that replaces it
+        self.pending = JSONStore(PENDING_FILE)
+        self.active = asyncio.Event()  # Clear while this is a standby, it answers nothing until the supervisor says to take over
+        if not supervisor.standby():
+            self.active.set()
+        self.held = deque(maxlen=100)  # Commands seen as a standby, in case the bot being replaced disconnected before it saw them
+        self.draining = None  # While handing over: commands that came in since, saved for the bot taking over
+        self.last_seen = 0  # Id of the newest message seen
+        self.help_pages = None  # !help's messages, rendered the first time they're asked for after the commands change
+        self.help_index = {}  # Command name or alias: its help entry
+        self.outboxes = {}  # Channel id: Outbox merging the sends commands make there
+        self.admission = Admission(self.config)  # Per-user and per-command rate limits on commands
     
     async def announce(self, msg, emb = None):
         await bot.get_channel(bot.config['CHANNEL_IDS']['ANNOUNCEMENTS']).send(msg, embed = emb)
@@ -44,16 +97,208 @@ class Tony(commands.Bot):
     
     async def mods(self): # Logs module import errors to dedicated error channel
         await bot.wait_until_ready()
+        self.startup.append(('connected and ready (since launch)', time.perf_counter() - BOOT))
+
+        if not self.active.is_set(): # Standby: import everything now so taking over finds their dependencies imported already
+            for module in MODULES:
+                try:
+                    importlib.import_module(module)
+                except Exception:
+                    traceback.print_exc()
+                    print(f"Standby can't import {module}, leaving the running bot be")
+                    return await self.close()
+            supervisor.announce(supervisor.READY)
+            await self.active.wait()
+            self.startup.append(('took over (since launch)', time.perf_counter() - BOOT))
         
         for module in MODULES:
             try:
-                bot.load_extension(module)
+                entry = self.manifest[module]
+                if self.config['LAZY_LOADING'] is not False and entry and entry['lazy'] and entry['mtime'] == self.module_mtime(module):
+                    for name, info in entry['commands'].items():
+                        self.stub(module, name, info)
+                    self.startup.append((f"{module} (stubbed {len(entry['commands'])} commands)", 0))
+                else:
+                    took = self.load_module(module)
+                    self.startup.append((f"{module} (load {took:.3f})", took))
             except Exception as e:
                 await bot.log(f"```Failed to import {module}:\n{traceback.format_exc()}```")
+        self.startup.append(('modules loaded (since launch)', time.perf_counter() - BOOT))
+        print(self.startup_report())
         print("Bot up and running")
+        await self.replay_pending()
+
+    async def hand_over(self): # Supervisor's SIGTERM: let the running command finish, save the queued ones for the bot taking over, disconnect
+        if self.draining is not None:
+            return
+        self.draining = []
+        drained = [threading.Event() for handler in self.handlers]
+        for event in drained: # Everything queued before these gets saved instead of run, each Handler stops at one
+            self.handler.queue.put(event)
+        deadline = time.monotonic() + (self.config['HANDOVER_TIMEOUT'] or 60)
+        while not all(event.is_set() for event in drained) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        # Saved and announced before closing, once close() returns Client.run stops the loop and cancels this
+        self.pending['commands'] = [[msg.channel.id, msg.id] for msg in self.draining]
+        self.pending['last'] = self.last_seen
+        supervisor.announce(supervisor.RELEASED)
+
+        try:
+            for module in list(self.extensions): # Stops their background tasks
+                self.unload_extension(module)
+            if hasattr(self, 'sandbox'): # Its workers would keep this process from exiting
+                await self.sandbox.close()
+            offload.shutdown()
+        finally:
+            await self.close()
+
+    async def replay_pending(self): # Runs the commands the bot this one replaced didn't get to
+        saved, last = self.pending['commands'] or [], self.pending['last']
+        if saved or last is not None:
+            self.pending['commands'], self.pending['last'] = [], None
+        messages = []
+        for channel_id, message_id in saved:
+            try:
+                messages.append(await self.get_channel(channel_id).fetch_message(message_id))
+            except (AttributeError, discord.HTTPException): # Channel or message gone since
+                pass
+        if last is not None: # Only trust what was held if the old bot said what it saw last, otherwise it might have answered them
+            messages += [msg for msg in self.held if msg.id > last]
+        self.held.clear()
+        messages.sort(key=lambda msg: msg.id) # Queued ones and ones that came in while draining are saved in separate passes
+
+        if messages:
+            print(f"Replaying {len(messages)} commands from before the handover")
+        for msg in messages: # Already let in once, not limited again
+            await run_command(msg, MessageInfo(msg), limited=False)
+
+    def module_mtime(self, module):
+        return os.path.getmtime(importlib.util.find_spec(module).origin)
+
+    def load_module(self, module): # Loads a module as an extension, returns how long that took and notes what it registered in the manifest
+        entry = self.manifest[module]
+        for name in (entry['commands'] if entry and module in self.stubs.values() else []):
+            self.remove_command(name)
+        self.stubs = {name: stubbed for name, stubbed in self.stubs.items() if stubbed != module}
+
+        footprint = lambda: (sum(len(listeners) for listeners in self.extra_events.values()), len(self.router), sum(not task.done() for task in all_tasks(self.loop)))
+        before = footprint()
+        start = time.perf_counter()
+        self.load_extension(module) # Runs the module itself, importing it first would run it twice
+        took = time.perf_counter() - start
+
+        self.record(module, lazy=footprint() == before) # Only commands, no listeners, message handlers or background tasks that need it running from the start
+        return took
+
+    def record(self, module, lazy): # Notes a loaded module's commands in the manifest
+        self.manifest[module] = {
+            'mtime': self.module_mtime(module),
+            'lazy': lazy,
+            'commands': {command.name: {'aliases': command.aliases, 'description': command.description, 'usage': command.usage}
+                         for command in self.commands if command.module == module}
+        }
+
+    def stub(self, module, name, info): # Registers a placeholder for a command whose module hasn't been imported yet
+        async def placeholder(ctx, *args):
+            await ctx.send(f"!{name} is still loading, try again") # Only reachable if something invokes it without ensure_loaded
+        self.add_command(commands.Command(placeholder, name=name, aliases=info['aliases'], description=info['description'], usage=info['usage']))
+        for alias in [name] + info['aliases']:
+            self.stubs[alias] = module
+
+    async def ensure_loaded(self, name): # Swaps a stub for the real command, importing its module the first time it's used
+        module = self.stubs.get(name)
+        if module is not None:
+            took = self.load_module(module)
+            self.startup.append((f"{module} on first use of !{name} (load {took:.3f})", took))
+
+    def unload_extension(self, name): # reload_extension doesn't come through here, so nothing is going to pick up what its teardown left
+        super().unload_extension(name)
+        self.handoff.pop(name, None)
+
+    async def get_context(self, message, *, cls=None): # Commands' sends go through their channel's Outbox, unless COALESCING is false
+        if cls is None:
+            cls = commands.Context if self.config['COALESCING'] is False else CoalescingContext
+        return await super().get_context(message, cls=cls)
+
+    def outbox(self, channel):
+        if channel.id not in self.outboxes:
+            self.outboxes[channel.id] = Outbox(channel, window=self.config['COALESCE_WINDOW'] or WINDOW)
+        return self.outboxes[channel.id]
+
+    def add_command(self, command): # Loading, reloading and stubbing modules all come through here and remove_command
+        super().add_command(command)
+        self.help_pages = None
+
+    def remove_command(self, name):
+        self.help_pages = None
+        return super().remove_command(name)
+
+    def render_help(self): # Returns !help's pages and the entry for each command name or alias
+        if self.help_pages is None:
+            pages, content, index = [], HELP_HEADER, {}
+            for command in sorted(self.commands, key=lambda command: command.name):
+                entry = f"!{command.name} {command.description or ''}{command.usage or ''}"
+                for name in [command.name] + list(command.aliases):
+                    index[name] = entry
+                if len(content) + len(entry) >= 1900:
+                    pages.append(f"{content}```")
+                    content = '```diff'
+                content += f"\n\n{entry}"
+            pages.append(f"{content}```")
+            self.help_pages, self.help_index = pages, index
+        return self.help_pages, self.help_index
+
+    def startup_report(self):
+        return "Startup (seconds):\n" + '\n'.join(f"  {step:<70}{seconds:>8.3f}" for step, seconds in self.startup)
+
+    def start_task(self, owner, coroutine): # Starts a background task for a module, so its teardown can stop it on unload/reload
+        task = self.loop.create_task(coroutine)
+        self.tasks.setdefault(owner, []).append(task)
+        return task
+
+    def stop_tasks(self, owner):
+        for task in self.tasks.pop(owner, []):
+            task.cancel()
+
+    def changed_modules(self, since='ORIG_HEAD'): # Python modules changed between since and HEAD (ORIG_HEAD is where the last pull started from)
+        diff = subprocess.run(["git", "diff", "--name-only", since, "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if diff.returncode:
+            raise RuntimeError(diff.stderr.decode('utf-8'))
+        return [path[:-3].replace('/', '.') for path in diff.stdout.decode('utf-8').split('\n') if path.endswith('.py')]
+
+    def reload(self, modules): # Reloads modules in place, returns (module, seconds or the error) for each extension reloaded
+        core = [module for module in modules if module in CORE_MODULES]
+        if core:
+            raise RestartNeeded(', '.join(core))
+
+        # Helper modules (anything that isn't an extension) are re-imported in the order they were first imported, so dependencies come
+        #   first, then every extension is reloaded since any of them could be holding on to the old versions
+        helpers = [module for module in sys.modules if module.startswith('tony_modules.') and module not in MODULES + CORE_MODULES]
+        if any(module in helpers for module in modules):
+            for module in helpers:
+                importlib.reload(sys.modules[module])
+            modules = MODULES
+
+        results = []
+        for module in [module for module in MODULES if module in modules]:
+            start = time.perf_counter()
+            try:
+                if module in self.extensions:
+                    self.reload_extension(module) # Rolls itself back if the new version fails to load
+                    self.record(module, lazy=self.manifest[module]['lazy'] if self.manifest[module] else False)
+                else: # Stubbed (the stubs could be out of date now) or failed to load before
+                    self.load_module(module)
+            except Exception as error:
+                results.append((module, error))
+                continue
+            results.append((module, time.perf_counter() - start))
+        return results
 
     def restart(self):
-        exit()
+        if supervisor.supervised(): # The supervisor starts a replacement alongside, this one keeps answering until it's ready
+            supervisor.announce(supervisor.RESTART)
+        else:
+            exit()
 
     def pull(self):
         return subprocess.run(["git", "pull"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -78,6 +323,9 @@ class Pipe(commands.context.Context): # Wrapper for Context to enable piping
         elif args:
             self.content = ' '.join(str(arg) for arg in args)
 
+    async def send_now(self, *args, **kwargs): # Nothing a piped command sends is really sent
+        return await self.send(*args, **kwargs)
+
     def __getattr__(self, attr):
         return getattr(self.__ctx, attr)
 
@@ -88,9 +336,9 @@ class Pipe(commands.context.Context): # Wrapper for Context to enable piping
         return setattr(self.__ctx, attr, value)
 
 
-class Handler(threading.Thread): # Auxiliary thread to execute secondary commands
-    def __init__(self, queue, loop):
-        threading.Thread.__init__(self)
+class Handler(threading.Thread): # Auxiliary thread to execute secondary commands, HANDLER_THREADS of them share a queue
+    def __init__(self, queue, loop, name='Handler'):
+        threading.Thread.__init__(self, name=name)
         self.queue = queue
         self.daemon = True
         self.tasks = []
@@ -103,29 +351,45 @@ class Handler(threading.Thread): # Auxiliary thread to execute secondary command
             else:
                 self.tasks.append(self.queue.get(block=False))
 
+            trace = None
             try:
-                bot, msg, ctx = self.tasks.pop(0)
-                
-                piped_message = msg.content
-                while re.search(r'\$\(![a-z]+[^$()]*\)', piped_message):
-                    sub = re.search(r'\$\(![a-z]+[^$()]*\)', piped_message)[0] # Find chunk of message to substitute
-                    msg.content = sub[2:-1]
-                    cmd = msg.content.split(' ')[0][1:]
-                    pipe = Pipe(self.execute(bot.get_context(msg)))
-                    
-                    self.execute(bot.get_command(cmd).invoke(pipe))
-                    piped_message = piped_message.replace(sub, pipe.content, 1)
-                
-                msg.content = piped_message
-                self.execute(bot.process_commands(msg))
+                if isinstance(self.tasks[0], threading.Event): # Handing over, everything queued before this has been run or saved
+                    self.tasks.pop(0).set()
+                    return
+                bot, msg, ctx, queued, trace = self.tasks.pop(0)
+                if bot.draining is not None: # Handing over, the bot taking over runs it instead
+                    bot.draining.append(msg)
+                    continue
+                REGISTRY.observe('command_queue_seconds', time.monotonic() - queued, command=ctx.command.qualified_name) # Not the alias typed, so it lines up with command_seconds
+                if trace is not None:
+                    trace.args['queue_ms'] = round((time.monotonic() - queued) * 1000, 1)
+                with tracing.activate(trace):
+                    self.dispatch(bot, msg)
             
             except Exception as error:
                 suppressed = (commands.CommandNotFound)
                 if not isinstance(error, suppressed):
                     self.execute(ctx.channel.send(f"```{''.join(traceback.format_exception(type(error), error, error.__traceback__))}```"))
+            finally:
+                tracing.end(trace)
     
+    def dispatch(self, bot, msg): # Substitutes any $(!cmd) pipes, then runs the message's command (blocks until it's done)
+        def run(command): # Runs one piped command and returns what it would have sent
+            msg.content = command
+            cmd = command.split(' ')[0][1:]
+            self.execute(bot.ensure_loaded(cmd))
+            with tracing.span(f"pipe !{cmd}"):
+                pipe = Pipe(self.execute(bot.get_context(msg)))
+                
+                self.execute(bot.get_command(cmd).invoke(pipe))
+            return pipe.content
+        
+        msg.content = substitute_pipes(msg.content, run)
+        self.execute(bot.ensure_loaded(msg.content.split(' ')[0][1:]))
+        self.execute(bot.process_commands(msg))
+
     def execute(self, coroutine):
-            return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(180)
+            return asyncio.run_coroutine_threadsafe(tracing.bind(coroutine), self.loop).result(180) # bind carries this thread's trace over to the loop
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # BOT SETUP
@@ -138,15 +402,64 @@ bot.remove_command('help')  # Remove keyword "help" from reserved command list
 # EVENTS
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-@bot.event # Command filtering
+@bot.event
 async def on_message(msg):
-    if bot.filter(msg) and msg.content[:1] == bot.command_prefix:
-        command_name = msg.content.split(' ')[0][1:]
-        if command_name in bot.all_commands:
-            if bot.get_command(command_name).module == "__main__":
-                await bot.process_commands(msg)
-            else:
-                bot.handler.queue.put((bot, msg, await bot.get_context(msg)))
+    bot.last_seen = max(bot.last_seen, msg.id)
+    if not bot.active.is_set(): # Standby, the bot being replaced is still answering
+        if msg.content[:1] == '!' and bot.filter(msg):
+            bot.held.append(msg)
+        return
+    await bot.router.dispatch(msg)
+
+async def route_command(msg, info): # Command filtering
+    if info.command in bot.all_commands:
+        if bot.draining is not None: # Handing over, the bot taking over runs it instead
+            return bot.draining.append(msg)
+        name = bot.all_commands[info.command].name # Aliases share their command's limits
+        shed = bot.admission.admit(msg.author.id, name)
+        if shed is not None:
+            return turn_away(msg, name, *shed)
+        await run_command(msg, info)
+
+async def run_command(msg, info, limited=True):
+    await bot.ensure_loaded(info.command)
+    if bot.get_command(info.command).module == __name__: # Commands defined here run on the loop, the rest go to the Handler
+        with tracing.span(f"!{info.command}", root=True, author=msg.author, channel=msg.channel):
+            await bot.process_commands(msg)
+    elif limited and bot.handler.queue.qsize() >= (bot.config['MAX_QUEUE'] or MAX_QUEUE): # Anything more would just wait behind a full queue
+        turn_away(msg, bot.get_command(info.command).name, 'queue', None)
+    else:
+        trace = tracing.begin(f"!{info.command}", root=True, author=msg.author, channel=msg.channel) # Finished by the Handler once it has run
+        bot.handler.queue.put((bot, msg, await bot.get_context(msg), time.monotonic(), trace))
+
+def turn_away(msg, command, reason, retry): # Sheds a command, telling its user (once, not for every command they spam)
+    REGISTRY.inc('commands_shed_total', command=command, reason=reason)
+    bot.dispatch('command_shed', msg, command, reason) # on_command_shed listeners, ie bench/replay.py
+    if bot.admission.warn(msg.author.id):
+        bot.outbox(msg.channel).add(f"{msg.author.mention} Busy, try !{command} again {f'in {math.ceil(retry)}s' if retry else 'in a bit'}")
+
+bot.router.register(bot, route_command)
+
+@bot.before_invoke # Command timing (pipe sub-commands included)
+async def start_timer(ctx):
+    ctx.started = time.perf_counter()
+    ctx.span = tracing.begin(f"command {ctx.command.qualified_name}", args=ctx.message.content)
+    ctx.span_token = tracing.attach(ctx.span) if ctx.span is not None else None
+    bot.watchdog.track(current_task(bot.loop), ctx.command.qualified_name)
+
+@bot.after_invoke
+async def stop_timer(ctx):
+    name = ctx.command.qualified_name
+    if hasattr(ctx, 'flush'): # Whatever it sent that's still waiting to be merged goes out now
+        await ctx.flush()
+    bot.watchdog.untrack(current_task(bot.loop))
+    if ctx.span is not None:
+        tracing.detach(ctx.span_token)
+        tracing.end(ctx.span, failed=ctx.command_failed)
+    REGISTRY.observe('command_seconds', time.perf_counter() - ctx.started, command=name)
+    REGISTRY.inc('commands_total', command=name)
+    if ctx.command_failed:
+        REGISTRY.inc('command_failures_total', command=name)
 
 @bot.event # Bot error logging
 async def on_error(ctx, error):
@@ -160,14 +473,20 @@ async def on_command_error(ctx, error):
 
 @bot.event
 async def on_guild_channel_create(channel):
+    if not bot.active.is_set(): # Standby, the bot being replaced still posts these
+        return
     await bot.announce(f"**New channel {channel.mention} has been created**")
 
 @bot.event
 async def on_guild_channel_delete(channel):
+    if not bot.active.is_set(): # Standby, the bot being replaced still posts these
+        return
     await bot.announce(f"**Channel #{channel.name} has been deleted**")
 
 @bot.event
 async def on_guild_emojis_update(guild, before, after):
+    if not bot.active.is_set(): # Standby, the bot being replaced still posts these
+        return
     emb = discord.Embed()
     if (len(before) > len(after)): # Deleted
         emoji = list(set(before) - set(after))[0]
@@ -181,6 +500,8 @@ async def on_guild_emojis_update(guild, before, after):
 
 @bot.event # Archive deleted messages
 async def on_raw_message_delete(raw):
+    if not bot.active.is_set(): # Standby, the bot being replaced still posts these
+        return
     if raw.cached_message and bot.filter(raw.cached_message):
         msg = raw.cached_message
         channel = bot.get_channel(raw.channel_id)
@@ -195,29 +516,110 @@ async def on_raw_message_delete(raw):
 # COMMANDS
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-@bot.command(description = '~ This command')
-async def help(ctx):
-    content = '```diff\n<arg>: Mandatory | [arg]: Optional | (arg): Default value | ...: Can provide multiple values\nYou can also pipeline commands using $(<command>), i.e. !speak $(!joke)\n=========='
-    for command in bot.commands:
-        if command.description is None:
-            command.description = ''
-        if command.usage is None:
-            command.usage = ''
-
-        if len(content) + len(command.name) + len(command.description) + len(command.usage) >= 1900:
+@bot.command(description = '[command] ~ This command, or just the help for [command]')
+async def help(ctx, name = None):
+    pages, index = bot.render_help()
+    if name is None:
+        for page in pages:
+            await ctx.send(page)
+        return
+    name = name.lstrip('!')
+    if name in index:
+        aliases = bot.get_command(name).aliases
+        also = f"\n(also {', '.join(f'!{alias}' for alias in aliases)})" if aliases else ''
+        await ctx.send(f"```diff\n{index[name]}{also}```")
+    else:
+        await ctx.send(f"There's no !{name}, see !help for every command")
+
+@bot.command(description = '~ Command and HTTP latency percentiles since startup', usage='\n\tstartup : Show how long startup took, by module')
+async def stats(ctx, *args):
+    if 'startup' in args:
+        return await ctx.send(f"```{bot.startup_report()[-1990:]}```")
+    ms = lambda hist, p: f"{hist.percentile(p) * 1000:.0f}" if hist and hist.percentile(p) is not None else '-'
+    runs = {dict(labels)['command']: hist for labels, hist in REGISTRY.histograms('command_seconds').items()}
+    waits = {dict(labels)['command']: hist for labels, hist in REGISTRY.histograms('command_queue_seconds').items()}
+    http = {dict(labels)['host']: hist for labels, hist in REGISTRY.histograms('http_seconds').items()}
+
+    lines = [f"{'command':<14}{'runs':>6}{'fails':>6}{'p50':>8}{'p95':>8}{'p99':>8}{'wait50':>8}{'wait99':>8}  (ms)"]
+    for name in sorted(set(runs) | set(waits), key=lambda n: -(runs[n].count if n in runs else 0)):
+        run, wait = runs.get(name), waits.get(name)
+        lines.append(f"{name:<14}{run.count if run else 0:>6}{REGISTRY.counter('command_failures_total', command=name):>6}"
+                     f"{ms(run, 50):>8}{ms(run, 95):>8}{ms(run, 99):>8}{ms(wait, 50):>8}{ms(wait, 99):>8}")
+    lines.append(f"\n{'http host':<34}{'calls':>6}{'fails':>6}{'p50':>8}{'p95':>8}{'p99':>8}")
+    for host, hist in sorted(http.items(), key=lambda item: -item[1].count):
+        lines.append(f"{host[:33]:<34}{hist.count:>6}{REGISTRY.counter('http_failures_total', host=host):>6}"
+                     f"{ms(hist, 50):>8}{ms(hist, 95):>8}{ms(hist, 99):>8}")
+    lag = next(iter(REGISTRY.histograms('loop_lag_seconds').values()), None)
+    shed = {reason: sum(REGISTRY.counter('commands_shed_total', command=name, reason=reason) for name in {command.name for command in bot.commands}) for reason in ('user', 'command', 'queue')}
+    lines.append(f"\nHandler queue depth: {bot.handler.queue.qsize()} ({len(bot.handlers)} threads, sheds past {bot.config['MAX_QUEUE'] or MAX_QUEUE})")
+    lines.append(f"Shed: {sum(shed.values())} ({', '.join(f'{n} by {reason} limit' for reason, n in shed.items())})")
+    lines.append(f"Event loop lag (ms): p50 {ms(lag, 50)}, p99 {ms(lag, 99)}, max {f'{max(lag.recent) * 1000:.0f}' if lag else '-'}")
+
+    content = '```'
+    for line in lines:
+        if len(content) + len(line) >= 1900:
             await ctx.send(f"{content}```")
-            content = '```diff'
-        content += f"\n\n!{command.name} {command.description}{command.usage}"
+            content = '```'
+        content += f"\n{line}"
     await ctx.send(f"{content}```")
 
+@bot.command(description = '<command ...> ~ Run a command under the profilers and attach the results', usage='\n\t-m : Also snapshot memory allocations (slower)')
+async def profile(ctx, *args):
+    alloc = '-m' in args
+    command = ' '.join(arg for arg in args if arg != '-m').strip()
+    if not command:
+        return await ctx.send("Usage: !profile [-m] <command ...>")
+    if command[0] != '!':
+        command = f"!{command}"
+    name = command.split(' ')[0][1:]
+    if bot.get_command(name) is None or name == 'profile':
+        return await ctx.send(f"Can't profile {command.split(' ')[0]}")
+
+    # The command goes through the Handler's dispatch (pipes included) on an executor thread, so its coroutines
+    #   still run here on the loop thread, which is the thread the profilers watch
+    ctx.message.content = command
+    loop = asyncio.get_event_loop()
+    with Profile(alloc=alloc) as result:
+        await loop.run_in_executor(None, bot.handler.dispatch, bot, ctx.message)
+
+    files = [discord.File(io.BytesIO(data), filename=filename) for filename, data in result.files(f"profile-{name}")]
+    await ctx.send(f"**!{name}** took {result.elapsed:.3f}s\n"
+                   f"`.pstats`: load with `pstats.Stats(path)` or snakeviz | `.collapsed.txt`: flamegraph.pl or speedscope", files=files)
+
 @bot.command(description = '~ Restart Tony')
 async def restart(ctx):
     await ctx.send("Restarting.... This could take a while")
     bot.restart()
 
-@bot.command(description = '~ Perform a git pull, then restart Tony')
+async def reload_and_report(ctx, modules): # Reloads modules in place, or restarts if one of them can't be
+    try:
+        results = bot.reload(modules)
+    except RestartNeeded as e:
+        await ctx.send(f"Core files changed ({e}), restarting.... This could take a while")
+        bot.restart()
+        return
+    if not results:
+        return await ctx.send("Nothing to reload")
+    await ctx.send('\n'.join(
+        f"Reloaded {module} in {result * 1000:.0f}ms" if isinstance(result, float) else f"**Failed to reload {module}** (kept the old version): {result}"
+        for module, result in results))
+
+@bot.command(description = '[module] ~ Reload the modules changed by the last pull (or just [module]) without restarting')
+async def reload(ctx, module = None):
+    if module is None:
+        try:
+            modules = bot.changed_modules()
+        except RuntimeError as e:
+            return await ctx.send(f"```Error:\n{e}```")
+    else:
+        modules = [module if module.startswith('tony_modules.') else f"tony_modules.{module}"]
+        if modules[0] not in MODULES and modules[0] not in sys.modules:
+            return await ctx.send(f"Don't know {module}, try one of: {', '.join(m.split('.')[-1] for m in MODULES)}")
+    await reload_and_report(ctx, modules)
+
+@bot.command(description = '~ Perform a git pull, then reload what changed (restarting only if it has to)')
 async def rebase(ctx):
-    await ctx.send("Pulling and restarting.... This could take a while")
+    await ctx.send("Pulling....")
     pull = bot.pull()
 
     if pull.returncode:
@@ -226,13 +628,44 @@ async def rebase(ctx):
         await ctx.send(f"Nothing changed - not restarting")
     else:
         await ctx.send(f"```{pull.stdout.decode('utf-8')}```")
-        bot.restart()
+        try:
+            modules = bot.changed_modules()
+        except RuntimeError as e: # ie no ORIG_HEAD to diff against
+            return await ctx.send(f"```Error:\n{e}```")
+        await reload_and_report(ctx, modules)
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # BOT STARTUP
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
-asyncio.ensure_future(bot.mods())
-bot.handler = Handler(Queue(), asyncio.get_event_loop()) 
-bot.handler.start()
-bot.run(bot.config['API_KEYS']['BOT_TOKEN'], bot=True)
+async def export_metrics(): # Dump metrics in Prometheus' text format for a local scrape (ie node_exporter's textfile collector)
+    path = bot.config['METRICS_FILE'] or os.path.join(ROOTPATH, 'storage', 'metrics.prom')
+    while True:
+        try:
+            REGISTRY.write(path)
+        except OSError:
+            traceback.print_exc()
+        await asyncio.sleep(bot.config['METRICS_INTERVAL'] or 15)
+
+def start(loop): # Everything that runs alongside the gateway connection, returns the task loading the extensions
+    tracing.TRACER.configure(bot.config['TRACE_FILE'] or os.path.join(ROOTPATH, 'storage', 'traces.json'), max_bytes=bot.config['TRACE_MAX_BYTES'] or 5 * 1024 * 1024)
+    tracing.install(loop) # Tasks and run_in_executor jobs keep their creator's trace
+    modules = asyncio.ensure_future(bot.mods(), loop=loop)
+    offload.configure(bot.config['CPU_WORKERS'] if bot.config['CPU_WORKERS'] is not None else offload.WORKERS)
+    queue, threads = Queue(), bot.config['HANDLER_THREADS'] or 1
+    bot.handlers = [Handler(queue, loop, name='Handler' if threads == 1 else f"Handler-{num}") for num in range(threads)]
+    bot.handler = bot.handlers[0]
+    for handler in bot.handlers:
+        handler.start()
+    REGISTRY.gauge('handler_queue_depth', bot.handler.queue.qsize)
+    bot.watchdog = LoopWatchdog(loop, lambda text: bot.log(f"```{text[-1990:]}```"), threshold=bot.config['LOOP_LAG_THRESHOLD'] or 0.5)
+    bot.watchdog.start()
+    asyncio.ensure_future(export_metrics(), loop=loop)
+    if supervisor.supervised():
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.ensure_future(bot.hand_over(), loop=loop))
+        loop.add_signal_handler(signal.SIGUSR1, bot.active.set)
+    return modules
+
+if __name__ == '__main__': # bench/replay.py imports this file to drive the bot without a connection
+    start(asyncio.get_event_loop())
+    bot.run(bot.config['API_KEYS']['BOT_TOKEN'], bot=True)
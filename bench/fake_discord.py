@@ -0,0 +1,258 @@
+'''
+A stand-in for Discord's gateway and REST API, so the bot can run locally with no network
+
+FakeHTTP replaces bot.http: it answers the REST calls discord.py makes with the payloads Discord would,
+    keeps every channel's messages for history/fetch_message, and can add latency and emulate
+    Discord's per-channel send limit
+FakeGateway builds a guild from the config and feeds events through discord.py's own parsers,
+    so on_message/on_raw_reaction_add/etc. are dispatched exactly like they are for real
+'''
+
+import asyncio
+import datetime
+import itertools
+import time
+from collections import Counter, defaultdict, deque
+from types import SimpleNamespace
+
+import discord
+from discord import utils
+
+EPOCH = datetime.datetime(2020, 1, 1)
+BOT_ID = 1000
+SEND_LIMIT = (5, 5.0)  # Discord lets a bot send 5 messages per channel every 5 seconds
+
+
+def _iso(snowflake):
+    return utils.snowflake_time(snowflake).isoformat()
+
+
+class FakeHTTP():
+    '''
+    Answers discord.py's HTTPClient calls from memory
+    latency: seconds every call takes, rate_limit: make sends wait out SEND_LIMIT like discord.py would on a 429
+    '''
+
+    def __init__(self, gateway, latency=0.0, rate_limit=True):
+        self.gateway = gateway
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.calls = Counter()  # method name: times called
+        self.limited = 0  # sends that had to wait for the rate limit
+        self.limited_seconds = 0.0
+        self._sent = defaultdict(deque)  # channel id: send times in the current window
+
+    async def _call(self, name):
+        self.calls[name] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def _wait_for_bucket(self, channel_id):
+        count, window = SEND_LIMIT
+        sent = self._sent[int(channel_id)]
+        started = time.monotonic()
+        while self.rate_limit:
+            now = time.monotonic()
+            while sent and now - sent[0] >= window:
+                sent.popleft()
+            if len(sent) < count:
+                break
+            await asyncio.sleep(window - (now - sent[0]))
+        sent.append(time.monotonic())
+        if sent[-1] > started + 0.001:
+            self.limited += 1
+            self.limited_seconds += sent[-1] - started
+
+    def _not_found(self, what):
+        return discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), {'code': 10008, 'message': f"Unknown {what}"})
+
+    # Messages
+
+    async def send_message(self, channel_id, content, *, tts=False, embed=None, nonce=None):
+        await self._wait_for_bucket(channel_id)
+        await self._call('send_message')
+        return self.gateway.bot_message(channel_id, content, embeds=[embed] if embed else [])
+
+    async def send_files(self, channel_id, *, files, content=None, tts=False, embed=None, nonce=None):
+        await self._wait_for_bucket(channel_id)
+        await self._call('send_files')
+        attachments = []
+        for file in files:
+            size = len(file.fp.read())
+            attachments.append({'id': str(next(self.gateway.ids)), 'filename': file.filename, 'size': size,
+                                'url': f"https://cdn.example/{file.filename}", 'proxy_url': f"https://cdn.example/{file.filename}"})
+        return self.gateway.bot_message(channel_id, content, embeds=[embed] if embed else [], attachments=attachments)
+
+    async def edit_message(self, channel_id, message_id, **fields):
+        await self._call('edit_message')
+        data = self.gateway.messages.get(int(message_id))
+        if data is None:
+            raise self._not_found('Message')
+        if 'content' in fields:
+            data['content'] = fields['content'] or ''
+        if 'embed' in fields:
+            data['embeds'] = [fields['embed']] if fields['embed'] else []
+        data['edited_timestamp'] = datetime.datetime.utcnow().isoformat()
+        return data
+
+    async def delete_message(self, channel_id, message_id, *, reason=None):
+        await self._call('delete_message')
+        self.gateway.forget(int(message_id))
+
+    async def get_message(self, channel_id, message_id):
+        await self._call('get_message')
+        data = self.gateway.messages.get(int(message_id))
+        if data is None:
+            raise self._not_found('Message')
+        return data
+
+    async def logs_from(self, channel_id, limit, before=None, after=None, around=None):
+        await self._call('logs_from')
+        ids = self.gateway.channels[int(channel_id)]
+        if before is not None:
+            ids = [i for i in ids if i < int(before)]
+        if after is not None:
+            ids = [i for i in ids if i > int(after)]
+        ids = sorted(ids, reverse=True)[:limit]
+        return [self.gateway.messages[i] for i in ids]
+
+    async def pins_from(self, channel_id):
+        await self._call('pins_from')
+        return []
+
+    # Reactions and the rest, which only need to succeed
+
+    async def add_reaction(self, channel_id, message_id, emoji):
+        await self._call('add_reaction')
+
+    async def remove_reaction(self, channel_id, message_id, emoji, member_id):
+        await self._call('remove_reaction')
+
+    async def remove_own_reaction(self, channel_id, message_id, emoji):
+        await self._call('remove_own_reaction')
+
+    async def clear_reactions(self, channel_id, message_id):
+        await self._call('clear_reactions')
+
+    async def send_typing(self, channel_id):
+        await self._call('send_typing')
+
+    async def get_user(self, user_id):
+        await self._call('get_user')
+        return self.gateway.user(int(user_id))
+
+    async def start_private_message(self, user_id):
+        await self._call('start_private_message')
+        return {'id': str(next(self.gateway.ids)), 'type': 1, 'recipients': [self.gateway.user(int(user_id))]}
+
+    def __getattr__(self, name):  # anything else discord.py asks for gets an empty answer, and shows up in the report
+        async def unhandled(*args, **kwargs):
+            await self._call(f"{name} (unhandled)")
+            return {}
+        return unhandled
+
+
+class FakeGateway():
+    '''
+    Owns the fake guild and everything said in it
+    Every channel id in the config's CHANNEL_IDS becomes a text channel of a guild with id SERVER_ID
+    '''
+
+    def __init__(self, bot, users=20, extra_channels=()):
+        self.bot = bot
+        self.state = bot._connection
+        self.guild_id = bot.config['SERVER_ID']
+        self.ids = itertools.count(utils.time_snowflake(EPOCH))
+        self.messages = {}  # message id: payload
+        self.channels = defaultdict(list)  # channel id: message ids, oldest first
+        self.users = [BOT_ID] + [BOT_ID + num for num in range(1, users + 1)]
+        self.echo = True
+
+        channel_ids = set(extra_channels)
+        for value in bot.config['CHANNEL_IDS'].values():
+            channel_ids.update(value if isinstance(value, list) else [value])
+        self.channel_ids = sorted(channel_ids)
+
+
+    def user(self, user_id):
+        return {'id': str(user_id), 'username': 'Tony' if user_id == BOT_ID else f"user{user_id - BOT_ID}",
+                'discriminator': f"{user_id % 10000:04}", 'avatar': None, 'bot': user_id == BOT_ID}
+
+
+    def member(self, user_id, with_user=True):
+        member = {'roles': [], 'joined_at': EPOCH.isoformat(), 'deaf': False, 'mute': False, 'nick': None}
+        if with_user:
+            member['user'] = self.user(user_id)
+        return member
+
+
+    def connect(self):
+        '''what READY and GUILD_CREATE would do, then marks the bot ready'''
+        self.state.user = discord.ClientUser(state=self.state, data=self.user(BOT_ID))
+        self.state._users[BOT_ID] = self.state.user
+        self.state._add_guild_from_data({
+            'id': str(self.guild_id), 'name': 'bench', 'owner_id': str(BOT_ID + 1), 'region': 'us-east',
+            'afk_timeout': 300, 'verification_level': 0, 'default_message_notifications': 0, 'explicit_content_filter': 0,
+            'mfa_level': 0, 'features': [], 'emojis': [], 'presences': [], 'voice_states': [], 'large': False,
+            'unavailable': False, 'member_count': len(self.users),
+            'roles': [{'id': str(self.guild_id), 'name': '@everyone', 'permissions': 104324673, 'position': 0,
+                       'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'members': [self.member(user_id) for user_id in self.users],
+            'channels': [{'id': str(channel_id), 'type': 0, 'name': f"channel-{num}", 'position': num,
+                          'permission_overwrites': [], 'nsfw': False, 'topic': None, 'parent_id': None}
+                         for num, channel_id in enumerate(self.channel_ids)]
+        })
+        self.bot._ready.set()
+
+
+    def _message(self, channel_id, author, content, embeds=(), attachments=()):
+        message_id = next(self.ids)
+        data = {'id': str(message_id), 'channel_id': str(channel_id), 'guild_id': str(self.guild_id),
+                'author': self.user(author), 'member': self.member(author, with_user=False), 'content': content or '',
+                'timestamp': _iso(message_id), 'edited_timestamp': None, 'tts': False, 'mention_everyone': False,
+                'mentions': [], 'mention_roles': [], 'attachments': list(attachments), 'embeds': list(embeds),
+                'pinned': False, 'type': 0}
+        self.messages[message_id] = data
+        self.channels[int(channel_id)].append(message_id)
+        return data
+
+
+    def bot_message(self, channel_id, content, embeds=(), attachments=()):
+        '''stores a message the bot sent, and echoes it back through the gateway like Discord does'''
+        data = self._message(channel_id, BOT_ID, content, embeds, attachments)
+        if self.echo:
+            self.bot.loop.call_soon(self.state.parse_message_create, data)
+        return data
+
+
+    def forget(self, message_id):
+        data = self.messages.pop(message_id, None)
+        if data is not None:
+            self.channels[int(data['channel_id'])].remove(message_id)
+
+
+    # Events, each goes through discord.py's parser for it
+
+    def message(self, channel_id, author, content):
+        data = self._message(channel_id, author, content)
+        self.state.parse_message_create(data)
+        return int(data['id'])
+
+
+    def reaction(self, message_id, user_id, emoji, emoji_id=None):
+        data = self.messages.get(message_id)
+        if data is None:
+            return
+        self.state.parse_message_reaction_add({
+            'user_id': str(user_id), 'channel_id': data['channel_id'], 'message_id': str(message_id),
+            'guild_id': str(self.guild_id), 'member': self.member(user_id),
+            'emoji': {'id': str(emoji_id) if emoji_id else None, 'name': emoji}
+        })
+
+
+    def delete(self, message_id):
+        data = self.messages.get(message_id)
+        if data is None:
+            return
+        self.forget(message_id)
+        self.state.parse_message_delete({'id': str(message_id), 'channel_id': data['channel_id'], 'guild_id': str(self.guild_id)})
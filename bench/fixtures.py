@@ -0,0 +1,75 @@
+'''
+Generated inputs for bench/micro.py, seeded so every run (and every machine) benchmarks the same data
+'''
+
+import io
+import json
+import math
+import random
+import struct
+import wave
+from types import SimpleNamespace
+
+SEED = 1234
+USERS = {  # the user ids financial_funcs.NAMES knows, so "I"/"me" resolve
+    'Ehren': 137749893207949312,
+    'Daniel': 309781352671084554,
+    'Aidan': 338163863738646528,
+    'Sam': 338139208621490177,
+    'Julien': 165576756525400065
+}
+ALIASES = ['ehren', 'wak', 'daniel', 'noid', 'aidan', 'lego', 'sam', 'julien'] + [f"<@{uid}>" for uid in USERS.values()]
+
+
+def iou_messages(count):
+    '''count fake IOU channel messages: single and multi-line IOUs, "I"/"me", crossed out ones and chatter'''
+    rand = random.Random(SEED)
+    money = lambda: rand.choice(['${:.2f}', '{:.2f}$', '{:.0f} dollars', '{:.0f} bucks']).format(rand.uniform(1, 200))
+    debt = lambda: rand.choice([
+        lambda: f"{rand.choice(ALIASES)} owes {rand.choice(ALIASES)} {money()}",
+        lambda: f"{rand.choice(ALIASES)} and {rand.choice(ALIASES)} owe {rand.choice(ALIASES)} {money()} for pizza",
+        lambda: f"i owe {rand.choice(ALIASES)} {money()}",
+        lambda: f"{rand.choice(ALIASES)} owes me {money()}",
+        lambda: f"~~{rand.choice(ALIASES)} owes {rand.choice(ALIASES)} {money()}~~",
+        lambda: "who has the aux cord"
+    ])()
+    return [SimpleNamespace(content='\n'.join(debt() for _ in range(rand.choice([1, 1, 1, 2, 3]))),
+                            author=SimpleNamespace(id=rand.choice(list(USERS.values()))))
+            for _ in range(count)]
+
+
+def store_file(path, size):
+    '''writes a JSONStore file of roughly size bytes, shaped like the bot's storage (lists of strings per key)'''
+    rand = random.Random(SEED)
+    data, written = {}, 2
+    while written < size:
+        key = f"key{len(data)}"
+        data[key] = [f"https://example.com/{rand.getrandbits(64):x}" for _ in range(50)]
+        written += len(json.dumps({key: data[key]}))
+    with open(path, 'w') as f:
+        json.dump(data, f)
+    return path
+
+
+def wav(seconds, channels=1, rate=22050):
+    '''a 16 bit WAV of a wobbling tone, seconds long'''
+    frames = bytearray()
+    for n in range(int(seconds * rate)):
+        sample = int(8000 * math.sin(2 * math.pi * (220 + 110 * math.sin(n / rate)) * n / rate))
+        frames += struct.pack('<h', sample) * channels
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as w:
+        w.setnchannels(channels)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(bytes(frames))
+    return out.getvalue()
+
+
+def piped_messages():
+    '''(name, message) pairs for the pipe substitution benchmark'''
+    return [
+        ('pipe_single', '!echo rolled $(!roll)'),
+        ('pipe_nested', '!echo $(!echo a $(!echo b $(!roll)) $(!roll)) c'),
+        ('pipe_20', '!echo ' + ' '.join(f"$(!echo {n})" for n in range(20)))
+    ]
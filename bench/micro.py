@@ -0,0 +1,144 @@
+'''
+Microbenchmarks for the bot's pure hot paths
+
+    python -m bench.micro                        run everything and print per-call times
+    python -m bench.micro --save                 ...and save them as the baseline (bench/baseline.json)
+    python -m bench.micro --compare              ...and compare against the baseline, exits 1 on regressions
+    python -m bench.micro -k iou --threshold 5   only benchmarks with "iou" in their name, flag anything 5% slower
+
+Timings are per call, best of --repeat runs (each run loops long enough to take at least --min-time seconds),
+    the best run is what gets compared since it's the least affected by whatever else the machine was doing
+A baseline is only meaningful on the machine (and Python) it was saved on
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+
+from bench import fixtures
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+
+def financial(workdir):
+    from tony_modules.financial_funcs import parse_message, plot_debts, reduce, simplify, sum_debts
+
+    messages = fixtures.iou_messages(10000)
+    debts = [debt for message in messages for debt in parse_message(message)]
+    yield 'iou_parse_message_10k', lambda: [parse_message(message) for message in messages]
+    yield 'iou_sum_debts', lambda: sum_debts(debts)
+    yield 'iou_simplify', lambda: simplify(debts)
+    yield 'iou_reduce', lambda: reduce(debts)
+    if shutil.which('dot') is None:
+        print('skipping iou_plot_debts: Graphviz (dot) is not installed')
+    else:
+        yield 'iou_plot_debts_simplified', lambda: plot_debts(simplify(debts))
+        yield 'iou_plot_debts_500', lambda: plot_debts(debts[:500])
+
+
+def storage(workdir):
+    from tony_modules.storage import JSONStore
+
+    for label, size in (('50k', 50 * 1024), ('500k', 500 * 1024), ('5m', 5 * 1024 * 1024)):
+        store = JSONStore(fixtures.store_file(os.path.join(workdir, f"store_{label}.json"), size))
+        yield f"jsonstore_read_{label}", lambda store=store: store.read()
+        yield f"jsonstore_read_key_{label}", lambda store=store: store['key0']
+        yield f"jsonstore_write_{label}", lambda store=store: store.write('key0', ['changed'])
+
+
+def speak(workdir):
+    from tony_modules.audio import alter
+
+    for seconds in (1, 10, 60):
+        clip = fixtures.wav(seconds)
+        yield f"speak_pitch_shift_{seconds}s", lambda clip=clip: alter(clip, 1, 2)
+    stereo = fixtures.wav(10, channels=2)
+    yield 'speak_pitch_shift_10s_stereo', lambda: alter(stereo, 1, 2)
+    yield 'speak_speed_only_10s', lambda: alter(stereo, 1.5, 1)
+
+
+def pipes(workdir):
+    from tony_modules.router import substitute_pipes
+
+    for name, message in fixtures.piped_messages():
+        yield name, lambda message=message: substitute_pipes(message, lambda command: '4242')
+
+
+GROUPS = [financial, storage, speak, pipes]
+
+
+def measure(func, repeat, min_time):
+    '''(best, median) seconds per call'''
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2 if number < 8 else 4
+    runs = [t / number for t in timer.repeat(repeat, number)]
+    return min(runs), statistics.median(runs)
+
+
+def fmt(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.2f} {unit}"
+    return f"{seconds / 1e-9:.0f} ns"
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Microbenchmarks for the bot\'s pure hot paths')
+    parser.add_argument('-k', '--filter', default='', help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2, help='seconds each run should take at least')
+    parser.add_argument('--baseline', default=os.path.join(HERE, 'baseline.json'))
+    parser.add_argument('--save', action='store_true', help='save these results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare against the baseline')
+    parser.add_argument('--threshold', type=float, default=10, help='percent slower than the baseline that counts as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results, regressions = {}, []
+    workdir = tempfile.mkdtemp(prefix='tony-micro-')
+    try:
+        print(f"{'benchmark':<32}{'best':>12}{'median':>12}" + (f"{'baseline':>12}{'change':>9}" if args.compare else ''))
+        for group in GROUPS:
+            try:
+                for name, func in group(workdir):
+                    if args.filter not in name:
+                        continue
+                    best, median = measure(func, args.repeat, args.min_time)
+                    results[name] = {'best': best, 'median': median}
+                    line = f"{name:<32}{fmt(best):>12}{fmt(median):>12}"
+                    if name in baseline:
+                        change = (best / baseline[name]['best'] - 1) * 100
+                        line += f"{fmt(baseline[name]['best']):>12}{change:>+8.1f}%"
+                        if change > args.threshold:
+                            line += '  REGRESSED'
+                            regressions.append(name)
+                    print(line, flush=True)
+            except ImportError as error:  # a dependency of that group isn't installed
+                print(f"skipping {group.__name__}: {error}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': {'python': sys.version, 'machine': platform.platform()}, 'results': results}, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    if regressions:
+        print(f"{len(regressions)} regression(s) over {args.threshold}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
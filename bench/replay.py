@@ -0,0 +1,263 @@
+'''
+Offline load test: runs the whole bot against bench/fake_discord.py and replays a stream of events into it
+
+    python -m bench.replay [--rate 20] [--events 500] [--mix "echo=4,pipe=2,chat=10,reaction=2,delete=1"]
+    python -m bench.replay --replay stream.jsonl      (a recorded stream, see --record)
+
+The bot gets a throwaway TONYROOT with a generated config (or a copy of --config), so nothing real is touched
+Commands that call out to other services (!wiki, !covid, ...) still do, the default mix sticks to ones that don't
+    (and synthetic chat stays out of the god world channel, which answers with image searches)
+
+Stream files have one event per line, message refs are the ordinal of an earlier message event in the same file:
+    {"t": 0.0, "type": "message", "channel": 300001, "author": 3, "content": "!roll"}
+    {"t": 0.1, "type": "reaction", "message": 0, "user": 4, "emoji": "upvote"}
+    {"t": 0.2, "type": "delete", "message": 0}
+'''
+
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'echo=4,roll=4,pipe=2,help=1,chat=12,reaction=3,delete=1'
+COMMANDS = {  # mix name: message content
+    'echo': '!echo load testing the bot',
+    'roll': '!roll',
+    'pipe': '!echo rolled $(!roll)',
+    'help': '!help',
+    'stats': '!stats',
+    'iou': '!iou quiet'
+}
+CHAT = ['hello', 'anyone up?', 'check this out https://example.com/some/page?utm_source=x', 'lol', 'that is true', 'gg']
+EMOJIS = [('upvote', 600001), ('downvote', 600002), ('🕔', None), ('👀', None)]
+
+
+def config(base=None):
+    '''the config the bot runs with, every channel it mentions becomes a channel in the fake guild'''
+    if base is not None:
+        with open(base) as f:
+            return json.load(f)
+    channels = {name: 300001 + num for num, name in enumerate(
+        ['ANNOUNCEMENTS', 'ERROR', 'RECYCLE_BIN', 'BEST_OF', 'WORST_OF', 'SPOILER', 'MUSIC', 'GOD_WORLD'])}
+    channels.update({'VIDEO_IDS': [300101], 'GENERAL': [300201, 300202, 300203], 'BANNED_CHANNELS': []})
+    return {
+        'SERVER_ID': 200001,
+        'CHANNEL_IDS': channels,
+        'API_KEYS': {'BOT_TOKEN': '', 'MERRIAM_WEBSTER': '', 'SOUNDCLOUD': '', 'TENOR': ''},
+        'URLS': {'PYDE': '', 'TEMP_URLS': []},
+        'LOCKED': ['API_KEYS', 'SERVER_ID', 'CHANNEL_IDS', 'LOCKED'],
+        'TENOR_CHANCE': 10 ** 9,  # tenor_roll would fetch a gif
+        'METRICS_INTERVAL': 3600
+    }
+
+
+def synthetic(count, mix, channels, users, rate):
+    '''a random stream in the recorded format, mix is {name or literal message: weight}'''
+    names, weights = zip(*mix.items())
+    events, messages = [], 0
+    for num in range(count):
+        kind = random.choices(names, weights)[0]
+        event = {'t': round(num / rate, 4) if rate else 0}
+        if kind in ('reaction', 'delete') and messages:
+            event.update(type=kind, message=random.randrange(messages))
+            if kind == 'reaction':
+                event.update(user=random.randint(1, users), emoji=random.choice(EMOJIS)[0])
+        else:
+            content = random.choice(CHAT) if kind in ('chat', 'reaction', 'delete') else COMMANDS.get(kind, kind)
+            event.update(type='message', channel=random.choice(channels), author=random.randint(1, users), content=content)
+            messages += 1
+        events.append(event)
+    return events
+
+
+def percentiles(values):
+    if not values:
+        return '-'
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000
+    return f"p50 {pick(50):.1f}  p95 {pick(95):.1f}  p99 {pick(99):.1f}  max {ordered[-1] * 1000:.1f}"
+
+
+class Harness():
+    def __init__(self, bot, gateway, http):
+        self.bot = bot
+        self.gateway = gateway
+        self.http = http
+        self.pending = {}  # message id: (injected at, command)
+        self.latencies = defaultdict(list)  # command: seconds from the message arriving to the command finishing
+        self.failed = defaultdict(int)
+        self.shed = defaultdict(int)  # command: times admission control turned it away
+        self.done = asyncio.Event()
+        self.bot.add_listener(self.on_command_completion)
+        self.bot.add_listener(self.on_command_error)
+        self.bot.add_listener(self.on_command_shed)
+
+
+    def _finish(self, message, failed=False, shed=False):
+        injected = self.pending.pop(message.id, None)
+        if injected is None:
+            return
+        started, command = injected
+        if shed:
+            self.shed[command] += 1
+        else:
+            self.latencies[command].append(time.perf_counter() - started)
+        if failed:
+            self.failed[command] += 1
+        if not self.pending:
+            self.done.set()
+
+
+    async def on_command_completion(self, ctx):
+        self._finish(ctx.message)
+
+
+    async def on_command_error(self, ctx, error):
+        self._finish(ctx.message, failed=True)
+
+
+    async def on_command_shed(self, message, command, reason):
+        self._finish(message, shed=True)
+
+
+    async def replay(self, events, rate):
+        ids = []  # message id of each message event, what refs index into
+        start = time.perf_counter()
+        for num, event in enumerate(events):
+            due = start + (num / rate if rate else event.get('t', 0))
+            if due > time.perf_counter():
+                await asyncio.sleep(due - time.perf_counter())
+
+            if event['type'] == 'message':
+                command = event['content'].split(' ')[0][1:] if event['content'][:1] == '!' else None
+                known = command in self.bot.all_commands
+                injected = time.perf_counter()
+                message_id = self.gateway.message(event['channel'], self.gateway.users[event['author']], event['content'])
+                if known:
+                    self.pending[message_id] = (injected, command)
+                    self.done.clear()
+                ids.append(message_id)
+            elif event['type'] == 'reaction' and event['message'] < len(ids):
+                emoji_id = dict(EMOJIS).get(event['emoji'])
+                self.gateway.reaction(ids[event['message']], self.gateway.users[event['user']], event['emoji'], emoji_id)
+            elif event['type'] == 'delete' and event['message'] < len(ids):
+                self.gateway.delete(ids[event['message']])
+            await asyncio.sleep(0)  # let the loop run the dispatch like a real gateway read would
+        return time.perf_counter() - start
+
+
+    def report(self, events, injecting, total):
+        from tony_modules.metrics import REGISTRY
+
+        completed = sum(len(values) for values in self.latencies.values())
+        lag = next(iter(REGISTRY.histograms('loop_lag_seconds').values()), None)
+        lines = [
+            f"{len(events)} events in {injecting:.2f}s ({len(events) / injecting:.1f}/s offered)",
+            f"{completed} commands finished in {total:.2f}s ({completed / total:.1f}/s), "
+            f"{sum(self.failed.values())} failed, {sum(self.shed.values())} shed, {len(self.pending)} still unfinished",
+            f"latency (ms): {percentiles([v for values in self.latencies.values() for v in values])}",
+            f"event loop lag (ms): {percentiles(list(lag.recent)) if lag else '-'}",
+            f"API calls: {sum(self.http.calls.values())} ({', '.join(f'{name} {n}' for name, n in self.http.calls.most_common())})",
+            f"rate limited sends: {self.http.limited} ({self.http.limited_seconds:.1f}s waited)",
+            '',
+            f"{'command':<12}{'runs':>6}{'fails':>6}{'shed':>6}  latency (ms)"
+        ]
+        for command in sorted(set(self.latencies) | set(self.shed), key=lambda command: -len(self.latencies[command])):
+            values = self.latencies[command]
+            lines.append(f"{command:<12}{len(values):>6}{self.failed[command]:>6}{self.shed[command]:>6}  {percentiles(values)}")
+        return '\n'.join(lines)
+
+
+async def run(args, events, tony):
+    from bench.fake_discord import FakeGateway, FakeHTTP
+
+    bot = tony.bot
+    extra = []
+    try:
+        extra.append(importlib.import_module('tony_modules.financial_funcs').IOU_CHANNEL_ID)
+    except Exception:
+        pass
+    gateway = FakeGateway(bot, users=args.users, extra_channels=extra)
+    gateway.echo = not args.no_echo
+    bot.http = bot._connection.http = http = FakeHTTP(gateway, latency=args.api_latency / 1000, rate_limit=not args.no_rate_limit)
+
+    gateway.connect()
+    await tony.start(bot.loop)
+    harness = Harness(bot, gateway, http)
+    await asyncio.sleep(1)  # let the watchdog and cogs settle
+
+    started = time.perf_counter()
+    injecting = await harness.replay(events, args.rate)
+    if harness.pending:
+        try:
+            await asyncio.wait_for(harness.done.wait(), args.drain)
+        except asyncio.TimeoutError:
+            pass
+    total = time.perf_counter() - started
+    print(harness.report(events, injecting, total))
+
+    if hasattr(bot, 'sandbox'):
+        await bot.sandbox.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a stream of Discord events into the bot with no network')
+    parser.add_argument('--replay', help='stream file to replay (JSON lines), instead of a synthetic one')
+    parser.add_argument('--record', help='also write the stream that was played to this file')
+    parser.add_argument('--events', type=int, default=500, help='synthetic stream length')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='synthetic stream weights: name=weight,... '
+                        f"(names: {', '.join(COMMANDS)}, chat, reaction, delete, or a literal message like '!echo hi')")
+    parser.add_argument('--rate', type=float, default=20, help='events per second, 0 to follow the stream\'s own timing')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--api-latency', type=float, default=50, help='milliseconds every fake API call takes')
+    parser.add_argument('--no-rate-limit', action='store_true', help='don\'t emulate Discord\'s 5 sends per 5s per channel limit')
+    parser.add_argument('--no-echo', action='store_true', help='don\'t send the bot\'s own messages back through on_message')
+    parser.add_argument('--config', help='config.json to run with (its channel ids become the fake guild), default: a generated one')
+    parser.add_argument('--drain', type=float, default=120, help='seconds to wait for queued commands once the stream ends')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary TONYROOT (storage, traces, metrics) afterwards')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    root = tempfile.mkdtemp(prefix='tony-bench-')
+    os.makedirs(os.path.join(root, 'storage'))
+    settings = config(args.config)
+    with open(os.path.join(root, 'storage', 'config.json'), 'w') as f:
+        json.dump(settings, f)
+    os.environ['TONYROOT'] = root
+    sys.path.insert(0, REPO_ROOT)
+
+    if args.replay:
+        with open(args.replay) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        ids = lambda value: set(value) if isinstance(value, list) else {value}
+        skip = ids(settings['CHANNEL_IDS'].get('BANNED_CHANNELS', [])) | ids(settings['CHANNEL_IDS'].get('GOD_WORLD', []))  # God world answers everything with an image search
+        channels = sorted(set().union(*(ids(value) for value in settings['CHANNEL_IDS'].values())) - skip)
+        mix = {name: float(weight) for name, weight in (item.rsplit('=', 1) for item in args.mix.split(','))}
+        events = synthetic(args.events, mix, channels, args.users, args.rate)
+    if args.record:
+        with open(args.record, 'w') as f:
+            f.writelines(json.dumps(event) + '\n' for event in events)
+
+    try:
+        tony = importlib.import_module('TSpark')
+        tony.bot.loop.run_until_complete(run(args, events, tony))
+    finally:
+        if args.keep:
+            print(f"TONYROOT kept at {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
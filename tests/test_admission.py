@@ -0,0 +1,64 @@
+import unittest
+from unittest import mock
+
+from tony_modules import ratelimit
+from tony_modules.admission import Admission
+
+
+class Config(dict):
+    '''stands in for the bot's JSONStore config'''
+
+    def __init__(self, **values):
+        super().__init__(values)
+        self.changed = 0
+
+    def __getitem__(self, key):
+        return self.get(key)
+
+    def mtime(self):
+        return self.changed
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(ratelimit.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.config = Config(USER_RATE=[3, 1.0], COMMAND_RATES={'speak': [2, 0.1]})
+        self.admission = Admission(self.config)
+
+    def test_user_limit(self):
+        self.assertEqual([self.admission.admit(1, 'roll') for _ in range(3)], [None] * 3)
+        self.assertEqual(self.admission.admit(1, 'roll'), ('user', 1.0))
+        self.assertIsNone(self.admission.admit(2, 'roll'))  # everyone has their own
+
+    def test_command_limit_is_shared(self):
+        self.assertIsNone(self.admission.admit(1, 'speak'))
+        self.assertIsNone(self.admission.admit(2, 'speak'))
+        self.assertEqual(self.admission.admit(3, 'speak'), ('command', 10.0))
+
+    def test_shed_command_leaves_the_user_budget_alone(self):
+        self.admission.admit(1, 'speak')
+        self.admission.admit(1, 'speak')
+        for _ in range(5):
+            self.assertEqual(self.admission.admit(1, 'speak')[0], 'command')
+        self.assertIsNone(self.admission.admit(1, 'roll'))  # one of the user's 3 tokens is still there
+
+    def test_limits_reset_when_the_config_changes(self):
+        for _ in range(3):
+            self.admission.admit(1, 'roll')
+        self.assertIsNotNone(self.admission.admit(1, 'roll'))
+        self.config['USER_RATE'] = [10, 1.0]
+        self.config.changed += 1
+        self.assertIsNone(self.admission.admit(1, 'roll'))
+
+    def test_warned_once_until_let_in(self):
+        self.assertTrue(self.admission.warn(1))
+        self.assertFalse(self.admission.warn(1))
+        self.admission.admit(1, 'roll')
+        self.assertTrue(self.admission.warn(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import unittest
+
+import discord
+
+from tony_modules.outbox import MAX_CONTENT, MAX_FIELDS, Outbox, pack, packable
+
+
+def simple(title, description='', colour=0x123456):
+    return discord.Embed(title=title, description=description, colour=colour)
+
+
+def queued(*parts):
+    outbox = Outbox(channel=None)
+    outbox._parts = [(None if content is None else str(content), embed) for content, embed in parts]
+    return outbox
+
+
+class Packable(unittest.TestCase):
+    def test_simple_embeds(self):
+        self.assertTrue(packable([simple('a', 'b'), simple('c', 'd')]))
+
+    def test_embed_with_more_than_title_and_description(self):
+        embed = simple('a', 'b')
+        embed.set_footer(text='footer')
+        self.assertFalse(packable([simple('c'), embed]))
+        self.assertFalse(packable([simple('c'), simple('d').add_field(name='x', value='y')]))
+
+    def test_too_many_for_the_field_limit(self):
+        self.assertTrue(packable([simple(str(num)) for num in range(MAX_FIELDS)]))
+        self.assertFalse(packable([simple(str(num)) for num in range(MAX_FIELDS + 1)]))
+
+    def test_description_too_long_for_a_field(self):
+        self.assertFalse(packable([simple('a', 'x' * 1025)]))
+
+    def test_too_big_for_one_embed(self):
+        self.assertFalse(packable([simple('a', 'x' * 1000) for _ in range(7)]))
+
+
+class Pack(unittest.TestCase):
+    def test_nothing_or_one(self):
+        embed = simple('a')
+        self.assertIsNone(pack([]))
+        self.assertIs(pack([embed]), embed)
+
+    def test_one_field_per_embed(self):
+        packed = pack([simple('a', 'b'), simple('c', 'd')])
+        self.assertEqual([(field.name, field.value) for field in packed.fields], [('a', 'b'), ('c', 'd')])
+        self.assertEqual(packed.colour.value, 0x123456)
+
+
+class NextMessage(unittest.TestCase):
+    def test_text_is_joined(self):
+        outbox = queued(('a', None), ('b', None), ('c', None))
+        self.assertEqual(outbox._next_message(), ('a\nb\nc', None, 3))
+        self.assertEqual(outbox._parts, [])
+
+    def test_text_splits_at_the_content_limit(self):
+        outbox = queued(('x' * (MAX_CONTENT - 1), None), ('y', None))
+        self.assertEqual(outbox._next_message(), ('x' * (MAX_CONTENT - 1), None, 1))
+        self.assertEqual(outbox._next_message(), ('y', None, 1))
+
+    def test_embeds_after_text_share_its_message(self):
+        embed = simple('a')
+        outbox = queued(('hi', None), (None, embed))
+        self.assertEqual(outbox._next_message(), ('hi', embed, 2))
+
+    def test_text_after_an_embed_starts_a_new_message(self):
+        embed = simple('a')
+        outbox = queued((None, embed), ('hi', None))
+        self.assertEqual(outbox._next_message(), (None, embed, 1))
+        self.assertEqual(outbox._next_message(), ('hi', None, 1))
+
+    def test_simple_embeds_are_packed(self):
+        outbox = queued((None, simple('a')), (None, simple('b')))
+        content, embed, merged = outbox._next_message()
+        self.assertEqual((content, merged, len(embed.fields)), (None, 2, 2))
+
+    def test_unpackable_embeds_go_separately(self):
+        fancy = simple('b')
+        fancy.set_image(url='https://example.com/a.png')
+        outbox = queued((None, simple('a')), (None, fancy))
+        self.assertEqual(outbox._next_message()[1].title, 'a')
+        self.assertIs(outbox._next_message()[1], fancy)
+        self.assertEqual(outbox._parts, [])
+
+    def test_send_with_text_and_embed_stays_together(self):
+        embed = simple('a')
+        outbox = queued(('hi', embed), ('there', None))
+        self.assertEqual(outbox._next_message(), ('hi', embed, 2))
+        self.assertEqual(outbox._next_message(), ('there', None, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from unittest import mock
+
+from tony_modules import ratelimit
+from tony_modules.ratelimit import SlidingWindow, TokenBucket
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class LimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        patcher = mock.patch.object(ratelimit.time, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(LimiterTest):
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(3, 0.5)
+        self.assertEqual([bucket.take() for _ in range(4)], [True] * 3 + [False])
+        self.assertEqual(bucket.delay(), 2.0)
+        self.clock.now += 2
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+
+    def test_refill_stops_at_capacity(self):
+        bucket = TokenBucket(2, 1.0)
+        self.clock.now += 60
+        self.assertEqual([bucket.take() for _ in range(3)], [True, True, False])
+
+    def test_delay_is_zero_with_a_token(self):
+        bucket = TokenBucket(1, 1.0)
+        self.assertEqual(bucket.delay(), 0)
+        bucket.take()
+        self.assertEqual(bucket.delay(), 1.0)
+
+
+class SlidingWindowTest(LimiterTest):
+    def test_count_per_window(self):
+        limiter = SlidingWindow(5, 5.0)
+        self.assertEqual([limiter.take() for _ in range(6)], [True] * 5 + [False])
+        self.assertEqual(limiter.delay(), 5.0)
+
+    def test_never_more_than_count_in_any_window(self):
+        limiter = SlidingWindow(5, 5.0)
+        taken = []
+        for _ in range(200):  # try to send every 0.1s for 20s
+            if limiter.take():
+                taken.append(self.clock.now)
+            self.clock.now += 0.1
+        self.assertEqual(len(taken), 20)
+        for start in taken:
+            self.assertLessEqual(sum(start <= when < start + 5.0 for when in taken), 5)
+
+    def test_slots_free_up_as_the_window_moves(self):
+        limiter = SlidingWindow(2, 1.0)
+        limiter.take()
+        self.clock.now += 0.5
+        limiter.take()
+        self.assertFalse(limiter.take())
+        self.assertAlmostEqual(limiter.delay(), 0.5)
+        self.clock.now += 0.5
+        self.assertTrue(limiter.take())
+        self.assertFalse(limiter.take())
+
+
+if __name__ == '__main__':
+    unittest.main()
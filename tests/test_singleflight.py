@@ -0,0 +1,111 @@
+import asyncio
+import io
+import types
+import unittest
+
+import discord
+from discord.ext import commands
+
+from tony_modules import singleflight
+
+
+class Context(commands.Context): # Keeps what's sent instead of going to Discord
+    def __init__(self, bot, message_id):
+        self.bot = bot
+        self.message = types.SimpleNamespace(id=message_id)
+        self.command = types.SimpleNamespace(qualified_name='graph')
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        files = [kwargs['file']] if kwargs.get('file') else kwargs.get('files') or []
+        self.sent.append((content, [(file.filename, file.fp.read()) for file in files]))
+
+
+class SingleflightTest(unittest.TestCase):
+    def setUp(self):
+        singleflight._flights.clear()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(asyncio.set_event_loop, None)
+        self.addCleanup(self.loop.close)
+        self.bot = types.SimpleNamespace(last_seen=0)
+        self.runs = []
+        self.release = asyncio.Event()
+
+        @singleflight.singleflight
+        async def command(ctx, *args, **kwargs):
+            self.runs.append(args)
+            await self.release.wait()
+            await ctx.send('graph of ' + ' '.join(args), file=discord.File(io.BytesIO(b'png'), filename='graph.png'))
+            if 'fail' in args:
+                raise ValueError('no data')
+            return 'result'
+        self.command = command
+
+    def ctx(self, message_id):
+        self.bot.last_seen = max(self.bot.last_seen, message_id)
+        return Context(self.bot, message_id)
+
+    def finish(self, *coros):
+        return self.loop.run_until_complete(asyncio.gather(*coros, return_exceptions=True))
+
+    async def started(self, *invocations): # Invokes in order, letting each start before the next, then lets them finish
+        tasks = []
+        for invocation in invocations:
+            tasks.append(asyncio.ensure_future(invocation))
+            await asyncio.sleep(0)
+        self.release.set()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    def test_overlapping_identical_invocations_share_one_run(self):
+        first, second = self.ctx(1), self.ctx(2)
+        (results,) = self.finish(self.started(self.command(first, 'a'), self.command(second, ' a ')))
+        self.assertEqual(self.runs, [('a',)])
+        self.assertEqual(results, ['result', None])
+        self.assertEqual(second.sent, [('graph of a', [('graph.png', b'png')])])
+        self.assertEqual(first.sent, second.sent)
+
+    def test_different_arguments_run_separately(self):
+        self.finish(self.started(self.command(self.ctx(1), 'a'), self.command(self.ctx(2), 'b'),
+                                 self.command(self.ctx(3), 'a', scale='log')))
+        self.assertEqual(len(self.runs), 3)
+
+    def test_sent_while_it_ran_replays_after_it_finished(self):
+        self.release.set()
+        self.finish(self.command(self.ctx(1), 'a'))
+        queued = Context(self.bot, 1) # Sent before the run finished, started after
+        self.finish(self.command(queued, 'a'))
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(queued.sent, [('graph of a', [('graph.png', b'png')])])
+
+    def test_sent_after_it_finished_runs_again(self):
+        self.release.set()
+        self.finish(self.command(self.ctx(1), 'a'))
+        self.finish(self.command(self.ctx(2), 'a'))
+        self.assertEqual(len(self.runs), 2)
+
+    def test_errors_reach_every_invocation(self):
+        second = self.ctx(2)
+        (results,) = self.finish(self.started(self.command(self.ctx(1), 'fail'), self.command(second, 'fail')))
+        self.assertEqual(len(self.runs), 1)
+        self.assertIsInstance(results[0], ValueError)
+        self.assertIs(results[1], results[0])
+        self.assertEqual(len(second.sent), 1)
+
+    def test_cancelled_run_is_run_again_by_a_follower(self):
+        async def cancel_first():
+            first = asyncio.ensure_future(self.command(self.ctx(1), 'a'))
+            await asyncio.sleep(0)
+            second = asyncio.ensure_future(self.command(self.ctx(2), 'a'))
+            await asyncio.sleep(0)
+            first.cancel()
+            await asyncio.sleep(0)
+            self.release.set()
+            return await asyncio.wait_for(second, 1)
+        (result,) = self.finish(cancel_first())
+        self.assertEqual(result, 'result')
+        self.assertEqual(len(self.runs), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
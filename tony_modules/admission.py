@@ -0,0 +1,63 @@
+'''
+Admission control for commands, so one user (or one slow command) can't bury everyone else's in the Handler queue
+
+Every user gets a token bucket (USER_RATE in the config: [burst, commands per second]) and so does every command
+    listed in COMMAND_RATES (same format, on top of COMMAND_RATES below), a command is only let in if both have a token
+The bot separately sheds Handler commands once its queue is MAX_QUEUE deep
+'''
+
+from .ratelimit import TokenBucket
+
+USER_RATE = (6, 0.5)  # a burst of 6, then one every 2 seconds
+COMMAND_RATES = {  # command: (burst, per second), for the slow ones
+    'speak': (3, 0.1),
+    'download': (2, 0.02),
+    'profile': (1, 0.05)
+}
+MAX_QUEUE = 25  # Handler commands waiting before new ones are shed
+
+
+class Admission():
+    def __init__(self, config):
+        self.config = config
+        self._users = {}  # user id: TokenBucket
+        self._commands = {}  # command: TokenBucket
+        self._warned = set()  # users told they're being shed, who won't be told again until they're let in
+        self._mtime = None
+
+
+    def _rates(self):
+        mtime = self.config.mtime()
+        if mtime != self._mtime: # Limits changed (or first use), start every bucket over with the new ones
+            self._user_rate = tuple(self.config['USER_RATE'] or USER_RATE)
+            self._command_rates = {**COMMAND_RATES, **{name: tuple(rate) for name, rate in (self.config['COMMAND_RATES'] or {}).items()}}
+            self._users, self._commands = {}, {}
+            self._mtime = mtime
+        return self._user_rate, self._command_rates
+
+
+    def admit(self, user, command):
+        '''returns None if the command (by name, not alias) can run, otherwise (what limited it ('user' or 'command'), seconds until it could run)
+        nothing is taken from either bucket unless both have a token, so a shed command doesn't use up the user's budget'''
+        user_rate, command_rates = self._rates()
+        if user not in self._users:
+            self._users[user] = TokenBucket(*user_rate)
+        if command in command_rates and command not in self._commands:
+            self._commands[command] = TokenBucket(*command_rates[command])
+        buckets = [('user', self._users[user])] + ([('command', self._commands[command])] if command in command_rates else [])
+
+        for limit, bucket in buckets:
+            if bucket.delay() > 0:
+                return limit, bucket.delay()
+        for limit, bucket in buckets:
+            bucket.take()
+        self._warned.discard(user)
+        return None
+
+
+    def warn(self, user):
+        '''whether a shed user should be told (only the first time in a row)'''
+        if user in self._warned:
+            return False
+        self._warned.add(user)
+        return True
@@ -0,0 +1,62 @@
+'''
+WAV manipulation for !speak
+Works on plain WAV bytes and touches nothing else, so it can be benchmarked (bench/micro.py) on its own
+'''
+
+import io
+import wave
+
+import numpy as np
+
+CHUNKS_PER_SECOND = 20  # pitch is shifted one chunk of audio at a time
+SAMPLE_TYPES = {1: np.int8, 2: np.int16}  # sample width in bytes: numpy type
+
+
+def shift_chunk(samples, shift, channels):
+    '''moves a chunk's frequencies up (or down if shift is negative) by shift FFT bins'''
+    if channels == 1:
+        f = np.fft.rfft(samples)
+        f = np.roll(f, shift)
+        if shift >= 0:
+            f[0:shift] = 0
+        else:
+            f[shift:] = 0
+        return np.fft.irfft(f).astype(samples.dtype)
+
+    left, right = samples[0::2], samples[1::2]
+    lf, rf = np.fft.rfft(left), np.fft.rfft(right)
+    lf, rf = np.roll(lf, shift), np.roll(rf, shift)
+    if shift >= 0:
+        lf[0:shift], rf[0:shift] = 0, 0
+    else:
+        lf[shift:], rf[shift:] = 0, 0
+    nl, nr = np.fft.irfft(lf), np.fft.irfft(rf)
+    return np.column_stack((nl, nr)).ravel().astype(samples.dtype)
+
+
+def alter(data, speed=1, pitch=1):
+    '''
+    Returns a copy of data (a WAV file) played speed times faster and with its pitch shifted by pitch
+    Speed just changes the frame rate, pitch is shifted chunk by chunk in the frequency domain
+    '''
+
+    out = io.BytesIO()
+    with wave.open(out, 'wb') as tf:
+        with wave.open(io.BytesIO(data), 'rb') as cf:
+            params = list(cf.getparams())
+            params[3] = 0
+            tf.setparams(tuple(params))
+            tf.setframerate(int(cf.getframerate() * speed))
+
+            channels, width = cf.getnchannels(), cf.getsampwidth()
+            nframes = (len(data) - 44) // (channels * width)  # espeak's headers don't have a real frame count, go by size
+            if pitch == 1:
+                tf.writeframes(cf.readframes(nframes))
+            else:
+                typ = SAMPLE_TYPES[width]
+                sz = cf.getframerate() // CHUNKS_PER_SECOND  # Number of frames per chunk
+                shift = int((100 * pitch) // CHUNKS_PER_SECOND)
+                for _ in range(nframes // sz):
+                    samples = np.frombuffer(cf.readframes(sz), dtype=typ)
+                    tf.writeframes(shift_chunk(samples, shift, channels).tobytes())
+    return out.getvalue()
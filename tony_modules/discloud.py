@@ -0,0 +1,164 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import time
+import uuid
+
+from .storage import JSONStore
+
+CHUNK_SIZE = 64 * 1024  # bytes read off disk at a time
+STORE_CHUNK_SIZE = 8 * 1024 * 1024 - 64 * 1024  # size of the pieces files are stored as, fits under the default upload limit
+
+
+class DiscloudStore(JSONStore):
+    '''
+    The index for TonyCloud
+    Every stored file gets a permanent numeric id, its metadata lives in index.json
+        and its contents live in objects/ as ordered chunks named by the sha256 of each chunk,
+        so uploading the same file twice costs nothing
+    Listing and lookups only ever touch the index, the objects folder is never scanned
+    '''
+
+    def __init__(self, root, chunk_size=STORE_CHUNK_SIZE):
+        self.root = root
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(root, 'objects'), exist_ok=True)
+        os.makedirs(os.path.join(root, 'incoming'), exist_ok=True)
+        super().__init__(os.path.join(root, 'index.json'))
+        if self['files'] is None:
+            self['files'] = {}
+            self['next_id'] = 1
+            self._adopt()
+
+
+    def _adopt(self):
+        '''moves files saved by the old flat-folder discloud into the index (sorted so they get stable ids)'''
+
+        for name in sorted(os.listdir(self.root)):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path) and name != 'index.json':
+                self._add(name, None, os.path.getmtime(path), *self._chunk(path))
+
+
+    def _object(self, digest):
+        return os.path.join(self.root, 'objects', digest)
+
+
+    def _chunk(self, path):
+        '''splits the file at path into chunk objects and deletes it, returns (file hash, chunk hashes, size)'''
+
+        whole = hashlib.sha256()
+        chunks = []
+        size = 0
+        with open(path, 'rb') as f:
+            while True:
+                tmp = self._object(f"tmp-{uuid.uuid4().hex}")
+                piece = hashlib.sha256()
+                written = 0
+                with open(tmp, 'wb') as out:
+                    while written < self.chunk_size:
+                        data = f.read(min(CHUNK_SIZE, self.chunk_size - written))
+                        if not data:
+                            break
+                        whole.update(data)
+                        piece.update(data)
+                        out.write(data)
+                        written += len(data)
+                if not written and chunks:  # file ended exactly on a chunk boundary
+                    os.remove(tmp)
+                    break
+                digest = piece.hexdigest()
+                if os.path.exists(self._object(digest)):
+                    os.remove(tmp)
+                else:
+                    os.replace(tmp, self._object(digest))
+                chunks.append(digest)
+                size += written
+                if written < self.chunk_size:
+                    break
+        os.remove(path)
+        return whole.hexdigest(), chunks, size
+
+
+    def _chunks(self, entry):
+        return entry.get('chunks') or [entry['hash']]  # entries from before chunking are a single object
+
+
+    def _add(self, name, uploader, timestamp, digest, chunks, size):
+        files = self['files']
+        for fid, entry in files.items():  # same bytes under the same name is the same upload
+            if entry['hash'] == digest and entry['name'] == name:
+                return {**entry, 'id': int(fid)}
+
+        fid = self['next_id']
+        entry = {
+            'name': name,
+            'hash': digest,
+            'chunks': chunks,
+            'size': size,
+            'uploader': uploader,
+            'timestamp': timestamp
+        }
+        files[str(fid)] = entry
+        self['files'] = files
+        self['next_id'] = fid + 1
+        return {**entry, 'id': fid}
+
+
+    def incoming(self, name):
+        '''a scratch path to save an upload to before handing it to add()'''
+        return os.path.join(self.root, 'incoming', f"{uuid.uuid4().hex}-{os.path.basename(name)}")
+
+
+    async def add(self, path, name, uploader):
+        '''moves the file at path into the store, returns its entry (with id)'''
+
+        chunked = await asyncio.get_event_loop().run_in_executor(None, self._chunk, path)
+        return self._add(name, uploader, time.time(), *chunked)
+
+
+    def list(self):
+        return sorted(({**entry, 'id': int(fid)} for fid, entry in self['files'].items()), key=lambda e: e['id'])
+
+
+    def get(self, fid):
+        '''returns the entry for fid (with the paths of its chunks, in order) or None'''
+
+        entry = self['files'].get(str(fid))
+        if entry is None:
+            return None
+        return {**entry, 'id': int(fid), 'paths': [self._object(c) for c in self._chunks(entry)]}
+
+
+    async def assemble(self, entry, spool, limit):
+        '''
+        Joins the chunks of entry back together into files no bigger than limit
+        Returns one {'title', 'path'} dict if the whole file fits, otherwise numbered parts in order
+        '''
+
+        groups = [[]]
+        for path in entry['paths']:
+            if groups[-1] and sum(os.path.getsize(p) for p in groups[-1]) + os.path.getsize(path) > limit:
+                groups.append([])
+            groups[-1].append(path)
+
+        if len(groups) == 1:
+            titles = [entry['name']]
+        else:
+            titles = [f"{entry['name']}.{num:03}of{len(groups):03}" for num in range(1, len(groups) + 1)]
+
+        parts = []
+        loop = asyncio.get_event_loop()
+        for title, group in zip(titles, groups):
+            part = {'title': title, 'path': spool.path(title)}
+            await loop.run_in_executor(None, _join, group, part['path'])
+            parts.append(part)
+        return parts
+
+
+def _join(paths, dest):
+    with open(dest, 'wb') as out:
+        for path in paths:
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, out, CHUNK_SIZE)
@@ -0,0 +1,371 @@
+import asyncio
+import hashlib
+import os
+import random
+import re
+import shutil
+import tempfile
+import time
+import zipfile
+
+from . import web
+from .storage import JSONStore
+
+
+CHUNK_SIZE = 64 * 1024  # bytes read off the socket (and disk) at a time
+UPLOAD_MARGIN = 64 * 1024  # headroom under the upload limit for multipart overhead
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Downloader():
+    '''
+    Fetches urls in parallel without blocking the event loop
+    requests is synchronous, so every call runs in the loop's default executor
+        and a semaphore caps how many calls are in flight at once
+    Failed calls (connection errors, 429s and 5xxs) are retried with exponential backoff
+    '''
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+    def __init__(self, headers=None, concurrency=16, retries=4, backoff=0.5, timeout=30):
+        self.session = web.session()
+        self.headers = headers or {}
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self._limit = asyncio.Semaphore(concurrency)
+
+
+    def _request(self, url, params, headers):
+        resp = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+        if resp.status_code in self.RETRY_STATUSES:
+            raise DownloadError(f"{url} returned {resp.status_code}")
+        resp.raise_for_status()
+        return resp
+
+
+    async def _retry(self, func, *args):
+        '''runs func(*args) in the executor, retrying with backoff until it succeeds or we run out of tries'''
+
+        import requests  # not at the top, so importing this module doesn't import requests
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries):
+            try:
+                async with self._limit:
+                    return await loop.run_in_executor(None, func, *args)
+            except requests.HTTPError as e:  # anything left over from raise_for_status is a 4xx, retrying won't help
+                raise DownloadError(str(e)) from e
+            except (requests.RequestException, DownloadError) as e:
+                if attempt == self.retries - 1:
+                    raise DownloadError(f"Gave up after {self.retries} tries: {e}") from e
+                await asyncio.sleep(self.backoff * 2 ** attempt + random.uniform(0, self.backoff))  # jitter so parallel retries don't line up
+
+
+    def _stream(self, url, params, headers, path, resume):
+        offset = os.path.getsize(path) if resume and os.path.exists(path) else 0
+        if offset:
+            headers = {**headers, 'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'}  # byte offsets are meaningless on a gzipped body
+        with self.session.get(url, params=params, headers=headers, timeout=self.timeout, stream=True) as resp:
+            if resp.status_code in self.RETRY_STATUSES:
+                raise DownloadError(f"{url} returned {resp.status_code}")
+            if resp.status_code == 416:  # we already have every byte
+                return offset
+            resp.raise_for_status()
+            with open(path, 'ab' if resp.status_code == 206 else 'wb') as f:  # servers that ignore Range send a 200 with the whole file
+                for chunk in resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+        return os.path.getsize(path)
+
+
+    async def get(self, url, params=None, headers=None):
+        return await self._retry(self._request, url, params, {**self.headers, **(headers or {})})
+
+
+    async def fetch_to(self, url, path, params=None, headers=None, resume=False):
+        '''streams url straight into the file at path (so the body never sits in memory), returns its size
+        if resume is True and path already holds the start of the file only the rest is requested'''
+        return await self._retry(self._stream, url, params, {**self.headers, **(headers or {})}, path, resume)
+
+
+    async def gather(self, jobs, progress=None):
+        '''awaits every coroutine in jobs concurrently, returning results in the same order
+        a job that raises has its exception returned in place of its result'''
+
+        async def run(job):
+            try:
+                return await job
+            except Exception as e:
+                return e
+            finally:
+                if progress is not None:
+                    await progress.step()
+
+        return await asyncio.gather(*(run(job) for job in jobs))
+
+
+    def close(self):
+        self.session.close()
+
+
+class Progress():
+    '''
+    A status message that gets edited as jobs finish
+    Edits are throttled so a fast album doesn't burn through the channel's rate limit
+    '''
+
+    def __init__(self, ctx, label, total, interval=2):
+        self.ctx = ctx
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.interval = interval
+        self._message = None
+        self._last_edit = 0
+
+
+    def _text(self):
+        return f"{self.label} ({self.done}/{self.total})"
+
+
+    async def start(self):
+        send = getattr(self.ctx, 'send_now', self.ctx.send)  # the message gets edited, so it can't wait to be merged with others
+        self._message = await send(self._text())
+        self._last_edit = time.monotonic()
+
+
+    async def step(self):
+        self.done += 1
+        if self._message is None:
+            return
+        if self.done == self.total or time.monotonic() - self._last_edit >= self.interval:
+            self._last_edit = time.monotonic()
+            try:
+                await self._message.edit(content=self._text())
+            except Exception:  # progress is cosmetic, never fail a download over it
+                pass
+
+
+class Spool():
+    '''
+    A scratch directory for downloaded files, deleted when the with block exits
+    '''
+
+    def __init__(self):
+        self.dir = None
+
+
+    def __enter__(self):
+        self.dir = tempfile.mkdtemp(prefix='tony-spool-')
+        return self
+
+
+    def __exit__(self, *exc):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+    def path(self, name):
+        '''a unique path in the spool for a file called name'''
+        fd, path = tempfile.mkstemp(dir=self.dir, suffix='-' + safe_filename(name))
+        os.close(fd)
+        return path
+
+
+def safe_filename(name):
+    return re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name)[-100:] or 'file'
+
+
+def _zip(path, files):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_STORED) as zf:  # audio is already compressed, deflate would just burn CPU
+        for f in files:
+            zf.write(f['path'], safe_filename(f['title']))
+
+
+def _split(path, parts):
+    with open(path, 'rb') as src:
+        for part in parts:
+            with open(part['path'], 'wb') as dst:
+                remaining = part['size']
+                while remaining:
+                    chunk = src.read(min(CHUNK_SIZE, remaining))
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+
+
+def _zip_overhead(files):
+    return 22 + sum(100 + 2 * len(safe_filename(f['title']).encode()) for f in files)  # end record + local/central headers per file
+
+
+async def pack(spool, files, limit, name='tracks'):
+    '''
+    Packs spooled files ({'title', 'path'} dicts) into uploads no bigger than limit, keeping their order
+        runs of small files are zipped together, files that are too big are split into numbered parts
+    Returns a list of {'title', 'path'} dicts, one per message
+    '''
+
+    loop = asyncio.get_event_loop()
+    limit -= UPLOAD_MARGIN
+    uploads = []
+    group = []
+
+    async def flush():
+        if len(group) == 1:
+            uploads.append(group[0][1])
+        elif group:
+            upload = {'title': f"{name} ({group[0][0]}-{group[-1][0]}).zip"}
+            upload['path'] = spool.path(upload['title'])
+            await loop.run_in_executor(None, _zip, upload['path'], [f for _, f in group])
+            uploads.append(upload)
+        group.clear()
+
+    for num, f in enumerate(files, 1):
+        size = os.path.getsize(f['path'])
+        if size > limit:
+            await flush()
+            count = -(-size // limit)
+            parts = [{
+                'title': f"{f['title']}.{num:03}of{count:03}",
+                'size': min(limit, size - (num - 1) * limit)
+            } for num in range(1, count + 1)]
+            for part in parts:
+                part['path'] = spool.path(part['title'])
+            await loop.run_in_executor(None, _split, f['path'], parts)
+            uploads += [{'title': part['title'], 'path': part['path']} for part in parts]
+            continue
+
+        grouped = [g for _, g in group] + [f]
+        if group and sum(os.path.getsize(g['path']) for g in grouped) + _zip_overhead(grouped) > limit:
+            await flush()
+        group.append((num, f))
+    await flush()
+    return uploads
+
+
+class CacheIndex(JSONStore):
+    def __init__(self, file_name):
+        super().__init__(file_name)
+        if self['entries'] is None:
+            self['entries'] = {}
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link(src, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)  # a hard link keeps the file alive for the upload even if it gets evicted meanwhile
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class DownloadCache():
+    '''
+    A size bounded, content addressed store for downloaded files
+    Files live in objects/<sha256 of contents>, so the same file under two keys is only stored once
+    index.json maps keys (ie "soundcloud:<track id>") to a hash, title, size and last use time
+        once the store grows past max_bytes the least recently used keys are dropped until it fits
+    Unfinished downloads are kept in partial/ and resumed with a Range request on the next try
+    '''
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        for sub in ('objects', 'partial'):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        self.index = CacheIndex(os.path.join(root, 'index.json'))
+        self._locks = {}  # key: (asyncio.Lock held while it's being fetched, fetches using it)
+
+
+    def _object(self, digest):
+        return os.path.join(self.root, 'objects', digest)
+
+
+    def lookup(self, key):
+        '''returns the index entry for key (with its file's path) or None, marking it as recently used'''
+
+        entries = self.index['entries']
+        entry = entries.get(key)
+        if entry is None:
+            return None
+        if not os.path.exists(self._object(entry['hash'])):  # someone cleaned up the objects folder by hand
+            del entries[key]
+            self.index['entries'] = entries
+            return None
+        entry['used'] = time.time()
+        self.index['entries'] = entries
+        return {**entry, 'path': self._object(entry['hash'])}
+
+
+    async def fetch(self, downloader, key, url, dest, title=None, params=None):
+        '''puts the file for key at dest, downloading (or finishing the download of) url on a miss
+        returns the index entry, or None if the file was too big to keep'''
+
+        loop = asyncio.get_event_loop()
+        lock, users = self._locks.get(key) or (asyncio.Lock(), 0)
+        self._locks[key] = lock, users + 1
+        try:
+            async with lock:  # two fetches of one key (two users, or the same track twice in an album) would both write to its partial file
+                entry = self.lookup(key)
+                if entry is None:
+                    partial = os.path.join(self.root, 'partial', hashlib.sha256(key.encode()).hexdigest())
+                    size = await downloader.fetch_to(url, partial, params, resume=True)
+                    if size > self.max_bytes:  # it would be evicted as soon as it went in, so it skips the store
+                        await loop.run_in_executor(None, os.replace, partial, dest)
+                        return None
+                    entry = await self.put(key, partial, title)
+                await loop.run_in_executor(None, _link, entry['path'], dest)
+                return entry
+        finally:
+            lock, users = self._locks[key]
+            if users == 1:
+                del self._locks[key]
+            else:
+                self._locks[key] = lock, users - 1
+
+
+    async def put(self, key, path, title=None):
+        '''moves the file at path into the store under key, returns the new index entry'''
+
+        loop = asyncio.get_event_loop()
+        digest = await loop.run_in_executor(None, _hash_file, path)
+        if os.path.exists(self._object(digest)):
+            os.remove(path)
+        else:
+            os.replace(path, self._object(digest))
+
+        entry = {'hash': digest, 'title': title, 'size': os.path.getsize(self._object(digest)), 'used': time.time()}
+        entries = self.index['entries']
+        entries[key] = entry
+        self.index['entries'] = entries
+        self.evict()
+        return {**entry, 'path': self._object(digest)}
+
+
+    def evict(self):
+        '''drops least recently used keys until the store fits in max_bytes, then deletes unreferenced files'''
+
+        entries = self.index['entries']
+        sizes = {e['hash']: e['size'] for e in entries.values()}
+        total = sum(sizes.values())
+        for key, entry in sorted(entries.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            del entries[key]
+            if all(e['hash'] != entry['hash'] for e in entries.values()):
+                total -= sizes[entry['hash']]
+        self.index['entries'] = entries
+
+        live = {e['hash'] for e in entries.values()}
+        for digest in os.listdir(os.path.join(self.root, 'objects')):
+            if digest not in live:
+                os.remove(self._object(digest))
@@ -0,0 +1,164 @@
+'''
+Backends that run code for !pyde
+Every executor takes a request ({'code', 'language', 'input': [[case values...]...]}) and returns the
+    PyDE result shape ({'status': 'pass' or the failure, 'output': [stdout per case], 'error': [stderr...]})
+'''
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+from collections import OrderedDict
+
+from . import web
+
+# Run with the limits and then the command as arguments, it sets the rlimits on itself and execs the command
+# (limits can't be set from the bot between fork and exec, preexec_fn isn't safe with the Handler threads running)
+LIMIT_WRAPPER = '''
+import os, resource, sys
+cpu, memory = int(sys.argv[1]), int(sys.argv[2])
+resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+os.execvp(sys.argv[3], sys.argv[3:])
+'''
+
+
+class RemoteExecutor():
+    '''the original PyDE web service'''
+
+    def __init__(self, url, timeout=60):
+        self.url = url
+        self.timeout = timeout
+
+    async def run(self, request):
+        loop = asyncio.get_event_loop()
+        response = await loop.run_in_executor(None, lambda: web.post(self.url, '', request, timeout=self.timeout))
+        return response.json()
+
+
+class LocalExecutor():
+    '''
+    Runs code in subprocesses on this machine, one per input case and all at once
+    Each run gets its own scratch directory, a stripped environment, a wall clock timeout and CPU/memory rlimits
+    It's not a jail: the code runs as the bot's user and can read anything the bot can (storage/config.json and its token
+        included), which is why it's only used when PYDE_BACKEND is "local"
+    '''
+
+    # language: (source file name, compile command or None, run command), {src} and {exe} get filled in
+    LANGUAGES = {
+        'python': ('main.py', None, [sys.executable, '-I', '{src}']),
+        'c': ('main.c', ['gcc', '-O2', '-o', '{exe}', '{src}', '-lm'], ['{exe}']),
+        'cpp': ('main.cpp', ['g++', '-O2', '-o', '{exe}', '{src}'], ['{exe}']),
+        'javascript': ('main.js', None, ['node', '{src}']),
+        'bash': ('main.sh', None, ['bash', '{src}'])
+    }
+    ALIASES = {'py': 'python', 'python3': 'python', 'c++': 'cpp', 'js': 'javascript', 'node': 'javascript', 'sh': 'bash'}
+
+    def __init__(self, timeout=10, cpu=5, memory=512 * 1024 * 1024, max_output=64 * 1024):
+        self.timeout = timeout
+        self.cpu = cpu
+        self.memory = memory
+        self.max_output = max_output
+
+    def _limited(self, cmd):
+        '''cmd run under the CPU/memory rlimits
+        RLIMIT_DATA rather than RLIMIT_AS, V8 alone reserves more address space than the memory cap at startup'''
+        return [sys.executable, '-I', '-c', LIMIT_WRAPPER, str(self.cpu), str(self.memory), *cmd]
+
+    async def _exec(self, cmd, cwd, stdin=b''):
+        '''returns (exit code or None on timeout, stdout, stderr)'''
+
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=cwd, env={'PATH': os.environ.get('PATH', '/usr/bin:/bin'), 'HOME': cwd},
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            start_new_session=True  # own process group, so a timeout can kill anything it spawned
+        )
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(stdin), self.timeout)
+        except asyncio.TimeoutError:
+            try:
+                os.killpg(proc.pid, 9)
+            except ProcessLookupError:
+                pass
+            await proc.wait()
+            return None, b'', f"Timed out after {self.timeout}s".encode()
+        return proc.returncode, out[:self.max_output], err[:self.max_output]
+
+    async def run(self, request):
+        language = self.ALIASES.get(request['language'].lower(), request['language'].lower())
+        if language not in self.LANGUAGES:
+            return {'status': 'fail', 'error': [f"Unsupported language {request['language']}, try one of {', '.join(self.LANGUAGES)}"]}
+        src_name, compile_cmd, run_cmd = self.LANGUAGES[language]
+
+        workdir = tempfile.mkdtemp(prefix='tony-pyde-')
+        try:
+            fill = lambda cmd: [part.format(src=os.path.join(workdir, src_name), exe=os.path.join(workdir, 'main')) for part in cmd]
+            with open(os.path.join(workdir, src_name), 'w') as f:
+                f.write(request['code'])
+
+            if compile_cmd is not None:  # the compiler only gets the timeout, the limits are for the user's code
+                code, _, err = await self._exec(fill(compile_cmd), workdir)
+                if code != 0:
+                    return {'status': 'compile error', 'error': [err.decode(errors='replace')]}
+
+            cases = request.get('input') or [[]]
+            runs = await asyncio.gather(*(
+                self._exec(self._limited(fill(run_cmd)), workdir, ''.join(f"{value}\n" for value in case).encode())
+                for case in cases
+            ))
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        result = {'status': 'pass', 'output': [out.decode(errors='replace') for _, out, _ in runs]}
+        errors = [f"Case {num}: {err.decode(errors='replace')}" for num, (_, _, err) in enumerate(runs, 1) if err]
+        if errors:
+            result['error'] = errors
+        if any(code is None for code, _, _ in runs):
+            result['status'] = 'timeout'
+        elif any(code != 0 for code, _, _ in runs):
+            result['status'] = 'fail'
+        return result
+
+
+class CachedExecutor():
+    '''remembers the results of another executor, keyed by a hash of code, language and input'''
+
+    def __init__(self, executor, size=256, warm=None):
+        self.executor = executor
+        self.size = size
+        self._results = warm if warm is not None else OrderedDict()  # warm: another cache's handoff(), when reloading
+
+    @staticmethod
+    def key(request):
+        return hashlib.sha256(json.dumps(
+            [request['code'], request['language'], request.get('input')], sort_keys=True
+        ).encode()).hexdigest()
+
+    async def run(self, request):
+        key = self.key(request)
+        if key in self._results:
+            self._results.move_to_end(key)
+            return self._results[key]
+
+        result = await self.executor.run(request)
+        if result.get('status') != 'timeout':  # a timeout might just have been a busy machine
+            self._results[key] = result
+            if len(self._results) > self.size:
+                self._results.popitem(last=False)
+        return result
+
+    def handoff(self):
+        return self._results
+
+
+def make_executor(config, warm=None):
+    '''builds the executor configured by PYDE_BACKEND ("remote" (default) or "local"), warm: results to start with'''
+
+    if config['PYDE_BACKEND'] == 'local':
+        backend = LocalExecutor(timeout=config['PYDE_TIMEOUT'] or 10)
+    else:
+        backend = RemoteExecutor(config['URLS']['PYDE'])
+    return CachedExecutor(backend, warm=warm)
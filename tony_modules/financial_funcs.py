@@ -1,9 +1,10 @@
 import re
 import io
-from pydot import Dot, Edge
 from collections import namedtuple
 from discord.ext import commands
 import discord
+from . import offload
+from .singleflight import singleflight
 
 
 class Debt:
@@ -91,6 +92,7 @@ def sum_debts(debts):
 
 
 def plot_debts(all_debts):
+    from pydot import Dot, Edge  # only !iou needs pydot, no point importing it at startup
     graph = Dot()
     for debt in all_debts:
         amt_str = '$' + str(round(debt.amount, 2))  # round to cents when we display everything
@@ -157,7 +159,7 @@ IOU_CHANNEL_ID = 391842582948216833
 
 
 async def plot_and_send(ctx, debts, additional_text):
-    graph = plot_debts(debts)
+    graph = await offload.run(plot_debts, debts)  # pydot is slow for big graphs, keep it off the event loop
     graph = discord.File(io.BytesIO(graph), filename="ious.png")
     await ctx.send(additional_text, file=graph)
 
@@ -169,6 +171,7 @@ class Financials(commands.Cog):
 
     @commands.command(description = "~ Display current IOU debts",
             usage = "\n\tquiet : Hide parsing output")
+    @singleflight
     async def iou(self, ctx, *args):
         quiet = "quiet" in args
         if not quiet:
@@ -1,20 +1,24 @@
 import discord
 from discord.ext import commands
-import requests
 import random
 import traceback
 import re
 import asyncio
-import wave
-import numpy as np
 import subprocess
 from .storage import \
     JSONStore  # relative import means this wak_funcs.py can only be used as part of the tony_modules package now
+from .discloud import DiscloudStore
+from .executors import make_executor
+from .router import URL_QUERY
+from . import offload, web
+from .singleflight import singleflight
+from .downloads import Downloader, DownloadError, DownloadCache, Progress, Spool, pack, safe_filename
 import os
 import io
 import json
+from collections import OrderedDict
 from datetime import datetime, timedelta
-from urllib.parse import urlparse
+from urllib.parse import urlparse, urlunparse, parse_qsl, urlencode
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 # GLOBAL DEFINITIONS
@@ -22,6 +26,8 @@ from urllib.parse import urlparse
 
 ROOTPATH = os.environ['TONYROOT']  # Bot's root path
 STORAGE_FILE = os.path.join(ROOTPATH, 'storage', 'lego_storage.json')
+TRACKING_PARAMS = {'fbclid', 'gclid', 'igshid', 'si', 'feature', 'ref', 'ref_src', 'app', 'mc_cid', 'mc_eid'}
+WATCHLIST_PAGE_SIZE = 20
 
 # ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
 
@@ -31,82 +37,183 @@ class LegoStore(JSONStore):
         if self['reminders'] is None:
             self['reminders'] = {}
         if self['watchlist'] is None:
-            self['watchlist'] = {}
+            self['watchlist'] = {'urls': {}, 'users': {}}
+        elif 'urls' not in self['watchlist']: # Convert the old {user: {url: message link}} layout
+            old = self['watchlist']
+            self['watchlist'] = {'urls': {}, 'users': {}}
+            for uid, urls in old.items():
+                for url, jump in urls.items():
+                    self.watch(uid, [url], jump)
+        elif any('jump' in entry for entry in self['watchlist']['urls'].values()): # Convert the one message link per url layout
+            wl = self['watchlist']
+            for entry in wl['urls'].values():
+                if 'jump' in entry:
+                    entry['watchers'] = {uid: entry['jump'] for uid in entry['watchers']}
+                    del entry['jump']
+            self['watchlist'] = wl
+
+    # The watchlist is stored normalized: every canonical url is stored once with the users watching it
+    # (and the message each of them reacted to), and every user has an ordered list of the canonical urls they're watching
+    # {'urls': {canonical url: {'watchers': {uid: message link}}}, 'users': {uid: [canonical url]}}
+    def watch(self, uid, urls, jump):
+        wl = self['watchlist']
+        for url in map(canonical_url, urls):
+            entry = wl['urls'].setdefault(url, {'watchers': {}})
+            if uid not in entry['watchers']:
+                entry['watchers'][uid] = jump
+                wl['users'].setdefault(uid, []).append(url)
+        self['watchlist'] = wl
+
+    def unwatch(self, uid, urls):
+        wl = self['watchlist']
+        for url in map(canonical_url, urls):
+            if url in wl['users'].get(uid, []):
+                wl['users'][uid].remove(url)
+                del wl['urls'][url]['watchers'][uid]
+                if not wl['urls'][url]['watchers']:
+                    del wl['urls'][url]
+        if uid in wl['users'] and not wl['users'][uid]:
+            del wl['users'][uid]
+        self['watchlist'] = wl
+
+    def watched(self, uid):
+        wl = self['watchlist']
+        return [(url, wl['urls'][url]['watchers'][uid]) for url in wl['users'].get(uid, [])]
+
+
+class MessageCache():
+    '''
+    A bounded LRU of recently seen messages
+    Messages are added as they're sent, so reactions on anything recent never need to hit the API
+    '''
+
+    def __init__(self, bot, size=1000, warm=None):
+        self.bot = bot
+        self.size = size
+        self._messages = warm if warm is not None else OrderedDict()  # warm: another cache's handoff(), when reloading
+
+    def add(self, msg):
+        self._messages[msg.id] = msg
+        self._messages.move_to_end(msg.id)
+        if len(self._messages) > self.size:
+            self._messages.popitem(last=False)
+
+    def discard(self, message_id): # Edited or deleted messages are stale
+        self._messages.pop(message_id, None)
+
+    def handoff(self):
+        return self._messages
+
+    async def get(self, channel_id, message_id):
+        if message_id in self._messages:
+            self._messages.move_to_end(message_id)
+            return self._messages[message_id]
+
+        channel = self.bot.get_channel(channel_id)
+        if channel is None: # DMs aren't always cached by discord.py
+            channel = await self.bot.fetch_channel(channel_id)
+        try:
+            msg = await channel.fetch_message(message_id)
+        except discord.NotFound:
+            return None
+        self.add(msg)
+        return msg
 
 
 class LegoFuncs(commands.Cog):
-    def __init__(self, bot, store):
+    def __init__(self, bot, store, warm=None):
+        warm = warm or {}  # What the cog this replaces (on a reload) left behind
         self.bot = bot
         self.storage = store
+        self.discloud = DiscloudStore(os.path.join(ROOTPATH, 'discloud'))
+        self.messages = MessageCache(bot, warm=warm.get('messages'))
+        self.pyde_executor = make_executor(bot.config, warm=warm.get('pyde'))
+        self.reaction_routes = { # emoji name: (handler, which reactions it should see)
+            'upvote': (self.vote, self.in_server),
+            'downvote': (self.vote, self.in_server),
+            '🕔': (self.watch, self.in_server),
+            '👀': (self.unwatch, self.anywhere),
+            '👂': (self.unwatch, self.anywhere)
+        }
+        self.dlcache = DownloadCache(os.path.join(ROOTPATH, 'storage', 'dlcache'), (bot.config['DOWNLOAD_CACHE_MB'] or 2048) * 1024 * 1024)
 
-    @commands.Cog.listener()
-    async def on_message(self, message):
-        if self.bot.filter(message, False):
-            cur_channel = self.bot.get_channel(message.channel.id)
+    # Message handlers, registered with bot.router in setup
+
+    async def remember(self, message, info): # Sees every message, so reactions on recent ones don't need a fetch
+        self.messages.add(message)
 
-            if message.channel.id in self.bot.config['CHANNEL_IDS']['VIDEO_IDS'] and "http" in message.content:
-                await message.add_reaction("👀")
-                await message.add_reaction("🕔")
+    async def video_link(self, message, info):
+        if info.urls:
+            await asyncio.gather(message.add_reaction("👀"), message.add_reaction("🕔"))
 
-            elif message.channel.id == self.bot.config['CHANNEL_IDS']['MUSIC'] and "http" in message.content:
-                await message.add_reaction("👂")
-                await message.add_reaction("🕔")
+    async def music_link(self, message, info):
+        if info.urls:
+            await asyncio.gather(message.add_reaction("👂"), message.add_reaction("🕔"))
 
-            if 'ai' in re.findall(r'\bai\b', message.content.lower()):
-                async with cur_channel.typing():
-                    await cur_channel.send('AI...?')
-                    await asyncio.sleep(random.randint(30, 50))
-                    await cur_channel.send('bum to the boo to the bum to the bass https://www.youtube.com/watch?v=bawDe5jag68')
+    async def ai(self, message, info):
+        if 'ai' in info.words:
+            async with message.channel.typing():
+                await message.channel.send('AI...?')
+                await asyncio.sleep(random.randint(30, 50))
+                await message.channel.send('bum to the boo to the bum to the bass https://www.youtube.com/watch?v=bawDe5jag68')
 
+    def cog_unload(self):
+        self.bot.router.unregister(self)
 
     @commands.Cog.listener()
     async def on_raw_reaction_add(self, reaction):
-        channel = self.bot.get_channel(reaction.channel_id)
-        user = self.bot.get_user(reaction.user_id)
-        msg = await channel.fetch_message(reaction.message_id)
-    
-        try:
-            name = reaction.emoji.name
-        except AttributeError:
+        # Route on the raw payload first, most reactions aren't ones we care about and fetching their message costs an API call
+        if reaction.user_id == self.bot.user.id:
+            return
+        name = getattr(reaction.emoji, 'name', None)
+        if name not in self.reaction_routes:
+            return
+        handler, allowed = self.reaction_routes[name]
+        if not allowed(reaction):
             return
-        else:
-            if name == 'upvote' or name == 'downvote': # Add to best/worstof
-                emb = discord.Embed(title=msg.content, colour=msg.author.colour)  # Create embed
-                emb.set_author(name=msg.author.display_name + ':', icon_url=msg.author.avatar_url)
-                emb.add_field(name="l4tl:", value=msg.jump_url, inline=True)
-                
-                if msg.attachments:
-                    emb.set_image(url=list(msg.attachments)[0].url)
-
-                if name == 'downvote':
-                    chnl = self.bot.get_channel(self.bot.config['CHANNEL_IDS']['WORST_OF'])
-                    await chnl.send(
-                        f"**{user.name} has declared the following to be rude, or otherwise offensive content:**",
-                        embed=emb)
-                elif name == 'upvote':
-                    chnl = self.bot.get_channel(self.bot.config['CHANNEL_IDS']['BEST_OF'])
-                    await chnl.send(
-                        f"**{user.name} declared the following to be highly esteemed content:**",
-                        embed=emb)
-
-            elif name == '🕔': # Add to watchlist
-                wl = self.storage.read('watchlist')
-                uid = str(user.id)
-                if uid not in self.storage['watchlist']:
-                    wl[uid] = {}
-                    self.storage.write('watchlist', wl)
-                for url in re.findall(r'http\S+', msg.content):
-                    if url not in wl[uid]:
-                        wl[uid][url] = msg.jump_url
-                self.storage.write('watchlist', wl)
-
-            elif name == '👀' or name == '👂': # Remove from watchlist
-                wl = self.storage.read('watchlist')
-                uid = str(user.id)
-                for url in re.findall(r'http\S+', msg.content):
-                    if uid in wl and url in wl[uid]:
-                        del wl[uid][url]
-                        self.storage.write('watchlist', wl)
+
+        msg = await self.messages.get(reaction.channel_id, reaction.message_id)
+        if msg is not None:
+            await handler(name, self.bot.get_user(reaction.user_id), msg)
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload):
+        self.messages.discard(payload.message_id)
+
+    @commands.Cog.listener()
+    async def on_raw_message_delete(self, payload):
+        self.messages.discard(payload.message_id)
+
+    def in_server(self, reaction):
+        return reaction.guild_id == self.bot.config['SERVER_ID'] and reaction.channel_id not in self.bot.config['CHANNEL_IDS']['BANNED_CHANNELS']
+
+    def anywhere(self, reaction): # Watchlist DMs are reacted to outside the server
+        return True
+
+    async def vote(self, name, user, msg): # Add to best/worstof
+        emb = discord.Embed(title=msg.content, colour=msg.author.colour)  # Create embed
+        emb.set_author(name=msg.author.display_name + ':', icon_url=msg.author.avatar_url)
+        emb.add_field(name="l4tl:", value=msg.jump_url, inline=True)
+
+        if msg.attachments:
+            emb.set_image(url=list(msg.attachments)[0].url)
+
+        if name == 'downvote':
+            chnl = self.bot.get_channel(self.bot.config['CHANNEL_IDS']['WORST_OF'])
+            await chnl.send(
+                f"**{user.name} has declared the following to be rude, or otherwise offensive content:**",
+                embed=emb)
+        elif name == 'upvote':
+            chnl = self.bot.get_channel(self.bot.config['CHANNEL_IDS']['BEST_OF'])
+            await chnl.send(
+                f"**{user.name} declared the following to be highly esteemed content:**",
+                embed=emb)
+
+    async def watch(self, name, user, msg): # Add to watchlist
+        self.storage.watch(str(user.id), URL_QUERY.findall(msg.content), msg.jump_url)
+
+    async def unwatch(self, name, user, msg): # Remove from watchlist
+        self.storage.unwatch(str(user.id), URL_QUERY.findall(msg.content))
 
     @commands.command(description = "<str> ~ Echo input as output, useful for testing pipes")
     async def echo(self, ctx, *args):
@@ -141,10 +248,11 @@ class LegoFuncs(commands.Cog):
         await ctx.send(f"https://thisanimedoesnotexist.ai/results/psi-{creativity}/seed{seed}.png")
 
     @commands.command(aliases=['temp'], description = "~ Get current temperature at the gamer house")
+    @singleflight
     async def temperature(self, ctx):
         for url in self.bot.config['URLS']['TEMP_URLS']:
             try:
-                await ctx.send(f"{url['name']}: {requests.get(url['url'], timeout=2).text}")
+                await ctx.send(f"{url['name']}: {web.get(url['url'], timeout=2).text}")
             except:
                 await ctx.send(f"Failed to reach {url['name']}")
 
@@ -172,30 +280,53 @@ class LegoFuncs(commands.Cog):
         await ctx.send(' '.join(args), files=files)
 
     
-    @commands.command(description = "~ View your watchlist")
-    async def watchlist(self, ctx):
+    @commands.command(description = "~ View your watchlist",
+            usage = "\n\t-r <#...> : Remove entries by number\n\t-c : Clear your watchlist")
+    async def watchlist(self, ctx, *args):
         uid = str(ctx.author.id)
-        if uid in self.storage['watchlist'] and self.storage['watchlist'][uid]:
-            if ctx.author.dm_channel is None:
-                await ctx.author.create_dm()
-            channel = ctx.author.dm_channel
-
-            for url, msgURL in self.storage['watchlist'][uid].items():
-                try: # User might not accept DMs
-                    msg = await channel.send(f"{url} ({msgURL})")
-                except:
-                    msg = await ctx.send(f"{url} ({msgURL})")
-                await msg.add_reaction("👀")
-        else:
+        watched = self.storage.watched(uid)
+        if not watched:
             await ctx.send("You have no videos in your watch list")
+            return
+
+        if '-c' in args:
+            self.storage.unwatch(uid, [url for url, _ in watched])
+            await ctx.send(f"Removed {len(watched)} entries from your watch list")
+            return
+
+        if '-r' in args:
+            nums = {int(a) for a in args if is_num(a) and 0 < int(a) <= len(watched)}
+            self.storage.unwatch(uid, [watched[n - 1][0] for n in nums])
+            await ctx.send(f"Removed {len(nums)} entries from your watch list")
+            return
+
+        pages = [[]]
+        for num, (url, jump) in enumerate(watched, 1):
+            line = f"{num}. {url} ([msg]({jump}))"
+            if len(pages[-1]) == WATCHLIST_PAGE_SIZE or sum(len(l) + 1 for l in pages[-1]) + len(line) > 2000:
+                pages.append([])
+            pages[-1].append(line)
+
+        if ctx.author.dm_channel is None:
+            await ctx.author.create_dm()
+        channel = ctx.author.dm_channel
+        for num, page in enumerate(pages, 1):
+            emb = discord.Embed(title=f"Watch list ({num}/{len(pages)})", description='\n'.join(page))
+            emb.set_footer(text="React 👀 on the original message or use !watchlist -r <#> to remove entries")
+            try: # User might not accept DMs
+                await channel.send(embed=emb)
+            except discord.Forbidden:
+                await ctx.send(embed=emb)
 
     @commands.command(description = "~ Output Tony's public IP")
     async def ip(self, ctx):
-        await ctx.send(requests.get("https://ifconfig.me").text)
+        await ctx.send(web.get("https://ifconfig.me").text)
 
     @commands.command(description = "<str> ~ Converts a string to speech",
             usage = "\n\t[config] : Object in form {<speed>, <pitch>}")
     async def speak(self, ctx, *args):
+        import wave
+        from .audio import alter  # numpy comes with this, only import it when someone actually speaks
         word_map = {}
         words = list(args)
 
@@ -218,22 +349,22 @@ class LegoFuncs(commands.Cog):
                 # Therefore we should note which type a file is in word_map as well as its config
                 if word not in word_map:
                     try:
-                        resp = requests.get(
+                        resp = web.get(
                                 f"https://www.dictionaryapi.com/api/v3/references/collegiate/json/{word}?key={self.bot.config['API_KEYS']['MERRIAM_WEBSTER']}"
                                 ).json()
                         
-                        audio = resp[0]["hwi"]["prs"][0]["sound"]["audio"]
-                        if audio[0:3] == "bix":
+                        clip = resp[0]["hwi"]["prs"][0]["sound"]["audio"]
+                        if clip[0:3] == "bix":
                             sub = "bix"
-                        elif audio[0:2] == "gg":
+                        elif clip[0:2] == "gg":
                             sub = "gg"
-                        elif not audio[0].isalpha():
+                        elif not clip[0].isalpha():
                             sub = "number"
                         else:
-                            sub = audio[0]
+                            sub = clip[0]
                         
-                        word_map[word] = io.BytesIO(requests.get(
-                            f"https://media.merriam-webster.com/soundc11/{sub}/{audio}.wav",
+                        word_map[word] = io.BytesIO(web.get(
+                            f"https://media.merriam-webster.com/soundc11/{sub}/{clip}.wav",
                             stream=True).content)
                         #word_file = io.BytesIO()
                         #with wave.open(word_file, 'wb') as wf:
@@ -253,49 +384,7 @@ class LegoFuncs(commands.Cog):
                 alt_file = word_map[word] # File to be altered
                 alt_file.seek(0)
                 if config["speed"] != 1 or config["pitch"] != 1: # Must alter file
-                    alt_file = io.BytesIO()
-                    with wave.open(alt_file, 'wb') as tf:
-                        with wave.open(word_map[word], 'rb') as cf:
-                            params = list(cf.getparams())
-                            params[3] = 0
-                            tf.setparams(tuple(params))
-                            tf.setframerate(int(cf.getframerate() * config["speed"]))
-                            
-                            if config["pitch"] == 1:
-                                continue
-
-                            nframes = (word_map[word].getbuffer().nbytes - 44) // (cf.getnchannels() * cf.getsampwidth())
-                            fr = 20 # Number of iterations per second of audio
-                            sz = cf.getframerate()//fr # Number of frames per iteration
-                            c = int(nframes/sz) # Number of iterations
-                            shift = int((100*config["pitch"])//fr)
-                            for _ in range(c):
-                                if cf.getsampwidth() == 1:
-                                    typ = np.int8
-                                elif cf.getsampwidth() == 2:
-                                    typ = np.int16
-                                
-                                da = np.fromstring(cf.readframes(sz), dtype=typ)
-                                if cf.getnchannels() == 1:
-                                    f = np.fft.rfft(da)
-                                    f = np.roll(f, shift)
-                                    if shift >= 0:
-                                        f[0:shift] = 0
-                                    else:
-                                        f[shift:] = 0
-                                    n = np.fft.irfft(f)
-                                    ns = np.column_stack((n)).ravel().astype(typ)
-                                elif cf.getnchannels() == 2:
-                                    left, right = da[0::2], da[1::2]
-                                    lf, rf = np.fft.rfft(left), np.fft.rfft(right)
-                                    lf, rf = np.roll(lf, shift), np.roll(rf, shift)
-                                    if shift >= 0:
-                                        lf[0:shift], rf[0:shift] = 0, 0
-                                    else:
-                                        lf[shift:], rf[shift:] = 0, 0
-                                    nl, nr = np.fft.irfft(lf), np.fft.irfft(rf)
-                                    ns = np.column_stack((nl, nr)).ravel().astype(typ)
-                                tf.writeframes(ns.tostring())
+                    alt_file = io.BytesIO(await offload.run(alter, word_map[word].getvalue(), config["speed"], config["pitch"]))
                 
                 alt_file.seek(0)
                 with wave.open(alt_file, 'rb') as wf:
@@ -318,7 +407,7 @@ class LegoFuncs(commands.Cog):
         url = f"https://www.dictionaryapi.com/api/v3/references/collegiate/json/{word}?key={self.bot.config['API_KEYS']['MERRIAM_WEBSTER']}"
 
         try:
-            resp = requests.get(url).json()
+            resp = web.get(url).json()
         except:
             await ctx.send(f"Error: {word} has no definition")
             return
@@ -344,7 +433,7 @@ class LegoFuncs(commands.Cog):
             else:
                 sub = audio[0]
             alink = f"https://media.merriam-webster.com/soundc11/{sub}/{audio}.wav"
-            await ctx.send(file=discord.File(io.BytesIO(requests.get(alink, stream=True).content), filename=f"{word}.wav"))
+            await ctx.send(file=discord.File(io.BytesIO(web.get(alink, stream=True).content), filename=f"{word}.wav"))
         except:
             await ctx.send("No pronunciation found")
 
@@ -383,9 +472,7 @@ class LegoFuncs(commands.Cog):
                 await ctx.send(f"Error: No {key} value provided")
                 return
 
-        response = requests.post(self.bot.config['URLS']['PYDE'], '', request)
-
-        rJSON = response.json()
+        rJSON = await self.pyde_executor.run(request)
         rString = f"**Exit Status:** {rJSON['status']}"
 
         if rJSON['status'] == 'pass':
@@ -423,7 +510,7 @@ class LegoFuncs(commands.Cog):
 
     @commands.command(description = "~ Tells a joke")
     async def joke(self, ctx):
-        resp = requests.get('https://api.chucknorris.io/jokes/random').json()  # Get the response in JSON
+        resp = web.get('https://api.chucknorris.io/jokes/random').json()  # Get the response in JSON
         emb = discord.Embed(title=resp['value'])  # Prepare the embed
         emb.set_author(name='​', icon_url=resp['icon_url'])  # Attach icon
         
@@ -482,88 +569,100 @@ class LegoFuncs(commands.Cog):
 
     @commands.command(description = "<link> ~ Download a link from BandCamp or SoundCloud")
     async def download(self, ctx, *links):
-        sesh = requests.Session()
         headerdata = {
             'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Ubuntu Chromium/64.0.3282.140 Chrome/64.0.3282.140 Safari/537.36',
             'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8',
             'Accept-Encoding': 'gzip, deflate, br',
             'Accept-Language': 'en-CA,en-GB;q=0.9,en-US;q=0.8,en;q=0.7}'
         }
+        dl = Downloader(headerdata, concurrency=self.bot.config['DOWNLOAD_CONCURRENCY'] or 16)
+        limit = ctx.guild.filesize_limit if ctx.guild else 8 * 1024 * 1024
 
-        async def get(sesh, url, headerData, parameters={}, maxNumTries=3):
-            for _ in range(1, maxNumTries):
-                try:
-                    return sesh.get(url, params=parameters, headers=headerData)
-                except:
-                    continue
-            await ctx.send("Failed to get data")
-
-        async def soundcloud(sesh, page, headerdata):
-            songs = []
+        async def soundcloud(spool, page):
             trackParams = {"client_id": self.bot.config['API_KEYS']['SOUNDCLOUD']}
-            ids = set(re.findall(r'"id":[0-9]{5,}', page))
-            
-            for i in ids:
-                try:
-                    i = str(i)[5:]
-                    infoURL = f"https://api-v2.soundcloud.com/tracks/{i}?client_id={self.bot.config['API_KEYS']['SOUNDCLOUD']}"
-                    info = await get(sesh, infoURL, headerdata, trackParams)
-                    dlurl = list(filter(lambda u: u["format"]["protocol"] == "progressive", info.json()["media"]["transcodings"]))[0]["url"]
-                    mp3URL = await get(sesh, dlurl, headerdata, trackParams)
-                    mp3 = await get(sesh, mp3URL.json()["url"], headerdata)
-                    songs.append({'title': f'{info.json()["title"]}.mp3', 'file': io.BytesIO(mp3.content)})
-                except:
-                    continue
-            return songs
-
-        async def bandcamp(sesh, albumpage, headerdata):  # {"album name": "", "album art": f, "files": []}
+            ids = list(dict.fromkeys(i[5:] for i in re.findall(r'"id":[0-9]{5,}', page)))  # dedupe but keep page order
+
+            async def track(i):
+                cached = self.dlcache.lookup(f"soundcloud:{i}")
+                if cached is not None:  # skip all three API calls
+                    song = {'title': cached['title']}
+                    song['path'] = spool.path(song['title'])
+                    await self.dlcache.fetch(dl, f"soundcloud:{i}", None, song['path'])
+                    return song
+
+                info = (await dl.get(f"https://api-v2.soundcloud.com/tracks/{i}", trackParams)).json()
+                dlurl = list(filter(lambda u: u["format"]["protocol"] == "progressive", info["media"]["transcodings"]))[0]["url"]
+                mp3URL = await dl.get(dlurl, trackParams)
+                song = {'title': f'{info["title"]}.mp3'}
+                song['path'] = spool.path(song['title'])
+                await self.dlcache.fetch(dl, f"soundcloud:{i}", mp3URL.json()["url"], song['path'], song['title'])
+                return song
+
+            progress = Progress(ctx, "Downloading tracks", len(ids))
+            await progress.start()
+            results = await dl.gather((track(i) for i in ids), progress)
+            return {"name": "soundcloud", "art": None, "songs": [song for song in results if not isinstance(song, Exception)]}  # ids that aren't tracks just fail, skip them
+
+        async def bandcamp(spool, albumpage):  # {"name": "", "art": path, "songs": []}
             infostart = albumpage.find('trackinfo: ') + len('trackinfo: ')
             infoend = albumpage.find('\n', infostart) - 1
             info = json.loads(albumpage[infostart:infoend])
 
             imagestart = albumpage.find('<link rel="image_src" href="') + len('<link rel="image_src" href="')
-            imagelink = imagestart[:imagestart.find('">')]
+            imagelink = albumpage[imagestart:albumpage.find('">', imagestart)]
 
             namestart = albumpage.find('<title>') + len('<title>')
             nameend = albumpage.find('</title>')
             albumname = albumpage[namestart:nameend]
-            await ctx.send(f'Downloading {albumname}....')
-            songs = []
-            trackNum = 1
-            for track in info:
-                if track['file'] is not None:
-                    title = f'{str(trackNum)}.{track["title"]}.mp3'.replace('/', '\\\\')
-                    dlLink = track['file']['mp3-128']
-                    mp3 = await get(sesh, dlLink, headerdata)
-                    songs.append({"title": title, "file": mp3.content})
-                    trackNum += 1
-
-            data = await get(sesh, imagelink, headerdata)
-            return {"name": albumname, "art": data.content, "songs": songs}
-
-        for link in links:
-            plink = urlparse(link)
-            page = await get(sesh, link, headerdata)
-
-            if 'bandcamp' in plink.netloc:
-                album = await bandcamp(sesh, page.content.decode('utf-8'), headerdata)
-                songs = album['songs']
-                await ctx.send(file=discord.File(album['art'], 'albumart.png'))
-
-            elif 'soundcloud' in plink.netloc:
-                songs = await soundcloud(sesh, page.content.decode('utf-8'), headerdata)
 
-            else:
-                await ctx.send(f"{link} is not a supported site, skipping...")
-                continue
+            tracks = [track for track in info if track['file'] is not None]
+
+            async def song(trackNum, track):
+                song = {"title": f'{str(trackNum)}.{track["title"]}.mp3'.replace('/', '\\\\')}
+                song['path'] = spool.path(song['title'])
+                key = f"bandcamp:{urlparse(track['file']['mp3-128']).path}"  # the query string is a token that changes every page load
+                await self.dlcache.fetch(dl, key, track['file']['mp3-128'], song['path'], song['title'])
+                return song
+
+            art = spool.path('albumart.png')
+            progress = Progress(ctx, f'Downloading {albumname}', len(tracks) + 1)  # the album art is one of the jobs too
+            await progress.start()
+            art_size, *songs = await dl.gather([dl.fetch_to(imagelink, art)] + [song(num, track) for num, track in enumerate(tracks, 1)], progress)
+            for failed in (s for s in songs if isinstance(s, Exception)):
+                await ctx.send(f"Failed to download a track: {failed}")
+            songs = [s for s in songs if not isinstance(s, Exception)]
+            return {"name": albumname, "art": None if isinstance(art_size, Exception) else art, "songs": songs}
 
-            for song in songs:
+        try:
+            for link in links:
+                plink = urlparse(link)
                 try:
-                    await ctx.send(file=discord.File(song['file'], filename=song['title']))
-                except discord.errors.HTTPException:
-                    await ctx.send("Error, file too large to send...")
-                except:
-                    await ctx.send("Failed to send file")
+                    page = await dl.get(link)
+                except DownloadError as e:
+                    await ctx.send(f"Failed to get {link}: {e}")
+                    continue
+
+                with Spool() as spool:  # tracks are streamed to disk then deleted once sent, so memory use doesn't grow with album size
+                    if 'bandcamp' in plink.netloc:
+                        album = await bandcamp(spool, page.content.decode('utf-8'))
+
+                    elif 'soundcloud' in plink.netloc:
+                        album = await soundcloud(spool, page.content.decode('utf-8'))
+
+                    else:
+                        await ctx.send(f"{link} is not a supported site, skipping...")
+                        continue
+
+                    if album['art'] is not None:
+                        await ctx.send(file=discord.File(album['art'], 'albumart.png'))
+
+                    for upload in await pack(spool, album['songs'], limit, safe_filename(album['name'])):
+                        try:
+                            await ctx.send(file=discord.File(upload['path'], filename=upload['title']))
+                        except discord.errors.HTTPException as e:
+                            await ctx.send(f"Failed to send {upload['title']}: {e}")
+        finally:
+            dl.close()
 
         await ctx.send("All done")
 
@@ -774,44 +873,65 @@ class LegoFuncs(commands.Cog):
             usage = "\n\t-l : List files\n\t-s [messageID (current) ...] : Specify message(s) to pull files from\n\t-g <#> : Get file at specified index")
     async def discloud(self, ctx, *cmd):
         cmd = list(cmd)
-        path = os.path.join(ROOTPATH, 'discloud')
+        store = self.discloud
         if '-l' in cmd:
             liststring = ""
-            for num, val in enumerate(os.listdir(path)):
-                liststring += f"{num + 1} - {val}\n"
-            await ctx.send(f"```{liststring}```")
+            for entry in store.list():
+                stamp = datetime.fromtimestamp(entry['timestamp']).strftime('%Y-%m-%d')
+                liststring += f"{entry['id']} - {entry['name']} ({entry['size'] // 1024}KB, {entry['uploader'] or 'unknown'}, {stamp})\n"
+            await ctx.send(f"```{liststring or 'Nothing stored yet'}```")
             return
 
         if '-s' in cmd:
             cmd.remove('-s')
-            msgs = []
             if not cmd:
-                msgs.append(ctx.message)
+                msgs = [ctx.message]
             else:
-                for mID in cmd:
-                    msgs.append(await ctx.get_message(mID))
-            for msg in msgs:
-                for attachment in msg.attachments:
-                    await attachment.save(os.path.join(path, attachment.filename))
-                    await ctx.send(f'File "{attachment.filename}" stored')
+                msgs = await asyncio.gather(*(ctx.fetch_message(int(mID)) for mID in cmd))
+
+            async def save(msg, attachment):
+                incoming = store.incoming(attachment.filename)
+                await attachment.save(incoming)
+                return await store.add(incoming, attachment.filename, str(msg.author))
+
+            attachments = [(msg, attachment) for msg in msgs for attachment in msg.attachments]
+            entries = await asyncio.gather(*(save(msg, attachment) for msg, attachment in attachments))
+            if entries:
+                await ctx.send('\n'.join(f'File "{entry["name"]}" stored as {entry["id"]}' for entry in entries))
 
         if '-g' in cmd:
             cmd.remove('-g')
             if not cmd:
                 await ctx.send('Please specify file(s) by index (i.e. "1 2 4 5")')
             else:
-                files = []
-                for data in cmd:
-                    data = int(data) - 1
-                    files.append(discord.File(open(os.path.join(path, os.listdir(path)[data]), 'rb'),
-                                              filename=os.listdir(path)[data]))
+                entries = [store.get(data) if is_num(data) else None for data in cmd]
+                if None in entries:
+                    await ctx.send(f'Error: Index {cmd[entries.index(None)]} not found')
+                    return
+
+                limit = (ctx.guild.filesize_limit if ctx.guild else 8 * 1024 * 1024) - 64 * 1024
+                messages = []
                 try:
-                    message = await ctx.send(content='```Warning, file(s) will be deleted in 5 minutes.```',
-                                             files=files)
+                    with Spool() as spool:
+                        uploads = []
+                        for entry in entries:
+                            uploads += await store.assemble(entry, spool, limit)
+
+                        batches = [[]]  # files that fit together go in one message, parts of big files get their own
+                        for upload in uploads:
+                            size = os.path.getsize(upload['path'])
+                            if batches[-1] and (len(batches[-1]) == 10 or sum(os.path.getsize(u['path']) for u in batches[-1]) + size > limit):
+                                batches.append([])
+                            batches[-1].append(upload)
+
+                        for num, batch in enumerate(batches, 1):  # one at a time so the parts arrive in order
+                            messages.append(await ctx.send(
+                                content=f'```Warning, file(s) will be deleted in 5 minutes. ({num}/{len(batches)})```',
+                                files=[discord.File(u['path'], filename=u['title']) for u in batch]
+                            ))
                     await asyncio.sleep(300)
-                    await message.delete()
-                except IndexError:
-                    await ctx.send('Error: Index not found')
+                finally:  # if a part failed to send, the ones that made it are deleted right away
+                    await asyncio.gather(*(message.delete() for message in messages if message is not None), return_exceptions=True)
 
 
 async def check_reminder(bot, storage):
@@ -823,6 +943,26 @@ async def check_reminder(bot, storage):
             await bot.get_channel(rem['channel']).send(rem['user'] + ' - ' + rem['reminder'])
 
 
+def canonical_url(url):
+    '''Normalizes a url so the same video posted two ways is watched once
+    lowercases the host, drops www./m., expands youtu.be links and strips tracking parameters and fragments'''
+    url = url.rstrip('>)]}.,!?\'"')
+    parsed = urlparse(url)
+    host = parsed.netloc.lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path = parsed.path.rstrip('/')
+    query = [(k, v) for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+             if k not in TRACKING_PARAMS and not k.startswith('utm_')]
+
+    if host == 'youtu.be': # youtu.be/<id> is youtube.com/watch?v=<id>
+        query.insert(0, ('v', path.lstrip('/')))
+        host, path = 'youtube.com', '/watch'
+
+    return urlunparse(('https', host, path, '', urlencode(sorted(query)), ''))
+
+
 def is_num(s):
     try:
         int(s)
@@ -843,5 +983,17 @@ async def lego_background(bot, storage):
 
 def setup(bot):
     storage = LegoStore()
-    bot.add_cog(LegoFuncs(bot, storage))
-    bot.loop.create_task(lego_background(bot, storage))
+    cog = LegoFuncs(bot, storage, warm=bot.handoff.pop(__name__, None))
+    bot.add_cog(cog)
+    bot.lego_funcs = cog  # The cog is already removed by the time teardown runs
+    bot.router.register(cog, cog.remember, filtered=False)
+    bot.router.register(cog, cog.video_link, channels=lambda config: config['CHANNEL_IDS']['VIDEO_IDS'])
+    bot.router.register(cog, cog.music_link, channels=lambda config: config['CHANNEL_IDS']['MUSIC'])
+    bot.router.register(cog, cog.ai)
+    bot.start_task(__name__, lego_background(bot, storage))
+
+
+def teardown(bot):
+    bot.stop_tasks(__name__)
+    cog = bot.lego_funcs
+    bot.handoff[__name__] = {'messages': cog.messages.handoff(), 'pyde': cog.pyde_executor.handoff()}
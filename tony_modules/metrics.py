@@ -0,0 +1,160 @@
+'''
+Counters and latency histograms for the whole bot
+Anything can record into REGISTRY (it's thread safe, the Handler thread records into it too),
+    !stats reads it back and the bot periodically writes it out in Prometheus' text format
+'''
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)  # seconds
+RECENT = 1024  # samples kept per histogram for percentiles
+
+
+class Histogram():
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)  # non cumulative, one per bucket (anything bigger only counts towards +Inf)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=RECENT)
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, p):
+        '''p (0-100) percentile of the most recent samples, None if there aren't any'''
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class Registry():
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}  # (name, labels): value
+        self._histograms = {}  # (name, labels): Histogram
+        self._gauges = {}  # (name, labels): function returning the current value
+        self.help = {}  # name: description for the Prometheus HELP line
+
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(value)
+
+
+    def gauge(self, name, func, **labels):
+        '''registers func to be called for name's value whenever metrics are read'''
+        with self._lock:
+            self._gauges[self._key(name, labels)] = func
+
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''records how long the with block took (works across awaits too), and counts {name}_failures_total if it raises'''
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.inc(f"{name}_failures_total", **labels)
+            raise
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+
+    def counter(self, name, **labels):
+        return self._counters.get(self._key(name, labels), 0)
+
+
+    def histograms(self, name):
+        '''{labels dict as a tuple of items: Histogram} for every histogram called name'''
+        with self._lock:
+            return {labels: hist for (n, labels), hist in self._histograms.items() if n == name}
+
+
+    def gauges(self):
+        with self._lock:
+            gauges = dict(self._gauges)
+        return {key: func() for key, func in gauges.items()}
+
+
+    def prometheus(self):
+        '''everything in Prometheus' text exposition format'''
+
+        def fmt(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"'.replace('\n', ' ') for k, v in labels) + '}'
+
+        lines = []
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h.counts), h.count, h.sum) for key, h in self._histograms.items()}
+
+        for kind, metrics in (('counter', counters), ('gauge', self.gauges())):
+            for name in sorted({name for name, _ in metrics}):
+                lines.append(f"# HELP {name} {self.help.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (n, labels), value in sorted(metrics.items()):
+                    if n == name:
+                        lines.append(f"{name}{fmt(labels)} {value}")
+
+        for name in sorted({name for name, _ in histograms}):
+            lines.append(f"# HELP {name} {self.help.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), (counts, count, total) in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, c in zip(BUCKETS, counts):
+                    cumulative += c
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{name}_sum{fmt(labels)} {total}")
+                lines.append(f"{name}_count{fmt(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path):
+        '''writes prometheus() to path atomically, so a scrape never reads half a file'''
+        tmp = f"{path}.tmp"
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+REGISTRY = Registry()
+REGISTRY.help.update({
+    'command_seconds': 'Time spent running a command',
+    'command_queue_seconds': 'Time a command waited in the Handler queue before running',
+    'command_failures_total': 'Commands that raised',
+    'http_seconds': 'Time spent on outbound HTTP requests',
+    'http_failures_total': 'Outbound HTTP requests that raised or returned an error status',
+    'handler_queue_depth': 'Commands waiting for the Handler thread',
+    'commands_shed_total': 'Commands turned away by admission control, by reason (user, command or queue)',
+    'singleflight_shared_total': 'Invocations that got the output of an identical one already running instead of running again'
+})
@@ -0,0 +1,119 @@
+'''
+A pool of worker processes for CPU-bound pure functions (!speak's pitch shifting, !iou's graphs),
+    so they run on other cores instead of holding the GIL that the gateway and every other command need
+Functions and their arguments are pickled over to the workers, so they have to be module level functions of plain data
+CPU_WORKERS in the config sets how many processes there are (2 by default), 0 runs everything in a thread instead
+
+Each worker is `python -m tony_modules.offload` (like the sandbox's workers) rather than a multiprocessing child,
+    those re-run the bot's main script in every worker and need 3.7 to pick a start method per pool
+It reads a length-prefixed pickle of (func, args) on stdin and writes one back with ('ok', result) or ('error', exception)
+Only the module a function comes from gets imported in the worker, so this module mustn't import anything heavy
+'''
+
+import asyncio
+import os
+import pickle
+import sys
+import traceback
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # cwd workers need for `-m tony_modules.offload`
+WORKERS = 2
+_size = None  # workers to run, None until configured
+_idle = None  # asyncio.Queue of workers waiting for a job, made on first use
+_workers = []  # every worker process, busy or not
+
+
+class WorkerDied(Exception):
+    pass
+
+
+def configure(workers):
+    '''sets how many worker processes there are, replacing the pool if that changed'''
+    global _size
+    if workers == _size:
+        return
+    shutdown()
+    _size = workers
+
+
+def shutdown():
+    global _size, _idle
+    for worker in _workers:
+        if worker.returncode is None:
+            worker.kill()
+    _workers.clear()
+    _size, _idle = None, None
+
+
+async def _spawn():
+    worker = await asyncio.create_subprocess_exec(
+        sys.executable, '-m', 'tony_modules.offload',
+        stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, cwd=PACKAGE_ROOT
+    )
+    _workers.append(worker)
+    return worker
+
+
+def _frame(data):
+    return len(data).to_bytes(8, 'big') + data
+
+
+async def run(func, *args):
+    '''returns func(*args), run in a worker process'''
+    global _idle
+    if _size is None:
+        configure(WORKERS)
+    if not _size:
+        return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+    if _idle is None: # Spawned on first use, most runs of the bot never need them
+        _idle = asyncio.Queue()
+        for _ in range(_size):
+            _idle.put_nowait(None)
+
+    idle = _idle
+    worker = await idle.get()
+    try:
+        if worker is None: # Not spawned yet, or replacing one that died
+            worker = await _spawn()
+        worker.stdin.write(_frame(pickle.dumps((func, args))))
+        await worker.stdin.drain()
+        try:
+            size = int.from_bytes(await worker.stdout.readexactly(8), 'big')
+            status, value = pickle.loads(await worker.stdout.readexactly(size))
+        except asyncio.IncompleteReadError: # Killed, most likely for memory
+            raise WorkerDied(f"Worker running {func.__name__} died") from None
+    except BaseException: # Whatever went wrong its state is unknown, the next job gets a fresh one
+        if worker is not None and worker.returncode is None:
+            worker.kill()
+        if worker in _workers:
+            _workers.remove(worker)
+        worker = None
+        raise
+    finally:
+        idle.put_nowait(worker)
+    if status == 'error':
+        raise value
+    return value
+
+
+def serve(): # Worker side
+    jobs, results = sys.stdin.buffer, sys.stdout.buffer
+    sys.stdout = sys.stderr # Anything a function prints mustn't end up in the results
+    while True:
+        header = jobs.read(8)
+        if len(header) < 8: # The bot closed the pipe
+            return
+        try:
+            func, args = pickle.loads(jobs.read(int.from_bytes(header, 'big')))
+            result = pickle.dumps(('ok', func(*args)))
+        except Exception as error:
+            try:
+                result = pickle.dumps(('error', error))
+            except Exception: # Exceptions that can't be pickled come back as their traceback
+                result = pickle.dumps(('error', RuntimeError(traceback.format_exc())))
+        results.write(_frame(result))
+        results.flush()
+
+
+if __name__ == '__main__':
+    serve()
@@ -0,0 +1,145 @@
+'''
+Per-channel outbound queues, so bursts of small sends go out as a few messages instead of one API call each
+
+Commands get a CoalescingContext (see Tony.get_context): its plain sends (text and/or an embed) are queued on
+    the channel's Outbox and return None instead of the Message, everything else (files, tts, delete_after, ...)
+    first flushes what's queued and then goes out as usual
+Queued sends are flushed when the command finishes, or WINDOW seconds after the first of them if it's still running.
+    Flushing is paced per channel to Discord's send limit, so while a channel is at its limit
+    the sends waiting on it keep merging instead of queueing up behind 429s
+A command that needs the Message back (to edit it, react to it, delete it later) uses ctx.send_now
+'''
+
+import asyncio
+import traceback
+
+import discord
+from discord.ext import commands
+
+from .metrics import REGISTRY
+from .ratelimit import SlidingWindow
+
+MAX_CONTENT = 2000  # characters in one message
+MAX_FIELDS = 25  # fields in one embed
+MAX_EMBED = 6000  # characters in one embed, all of its parts together
+WINDOW = 0.25  # seconds queued sends wait for others to merge with, unless the command finishes first
+SEND_LIMIT = (5, 5.0)  # Discord's per-channel limit: 5 messages in any 5 seconds
+SIMPLE = {'type', 'title', 'description', 'color'}  # embeds with nothing else can be packed into one as fields
+
+
+def packable(embeds):
+    '''whether embeds can be sent as one embed with a field per embed'''
+    if len(embeds) > MAX_FIELDS:
+        return False
+    size = 0
+    for embed in embeds:
+        data = embed.to_dict()
+        if not set(data) <= SIMPLE or len(data.get('title', '')) > 256 or len(data.get('description', '')) > 1024:
+            return False
+        size += len(data.get('title', '')) + len(data.get('description', ''))
+    return size <= MAX_EMBED
+
+
+def pack(embeds):
+    if len(embeds) < 2:
+        return embeds[0] if embeds else None
+    packed = discord.Embed(colour=embeds[0].colour)
+    for embed in embeds:
+        packed.add_field(name=embed.title or '\u200b', value=embed.description or '\u200b', inline=False)
+    return packed
+
+
+class Outbox():
+    def __init__(self, channel, window=WINDOW, limit=SEND_LIMIT):
+        self.channel = channel
+        self.window = window
+        self.limiter = SlidingWindow(*limit)
+        self._parts = []  # (content or None, embed or None) waiting to be sent, in order
+        self._lock = asyncio.Lock()
+        self._timer = None
+
+
+    @staticmethod
+    def accepts(content, kwargs):
+        '''whether a send with these arguments can be queued (and merged)'''
+        return set(kwargs) <= {'embed'} and (content is None or len(str(content)) <= MAX_CONTENT) \
+            and (content is not None or kwargs.get('embed') is not None)
+
+
+    def add(self, content=None, embed=None):
+        self._parts.append((None if content is None else str(content), embed))
+        if self._timer is None:
+            self._timer = asyncio.get_event_loop().call_later(self.window, lambda: asyncio.ensure_future(self._flush_later()))
+
+
+    async def _flush_later(self):
+        try:
+            await self.flush()
+        except Exception: # No command left to report it to
+            traceback.print_exc()
+
+
+    def _next_message(self):
+        '''takes the next message's worth of queued sends: text up to MAX_CONTENT then (packable) embeds'''
+        text, embeds = [], []
+        while self._parts:
+            content, embed = self._parts[0]
+            if content is not None and (embeds or len('\n'.join(text + [content])) > MAX_CONTENT):
+                break
+            if embed is not None and embeds and not packable(embeds + [embed]):
+                break
+            if content is not None:
+                text.append(content)
+            if embed is not None:
+                embeds.append(embed)
+            self._parts.pop(0)
+        return ('\n'.join(text) if text else None), pack(embeds), len(text) + len(embeds)
+
+
+    async def flush(self):
+        '''sends everything queued'''
+        async with self._lock:
+            await self._flush()
+
+
+    async def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._parts:
+            await self.limiter.wait() # Anything queued while this waits gets merged in
+            content, embed, merged = self._next_message()
+            REGISTRY.inc('outbox_messages_total')
+            REGISTRY.inc('outbox_sends_total', merged)
+            await self.channel.send(content, embed=embed)
+
+
+    async def send_now(self, send):
+        '''flushes what's queued, then awaits send() (a coroutine function sending something) and returns what it does'''
+        async with self._lock:
+            await self._flush()
+            await self.limiter.wait()
+            REGISTRY.inc('outbox_messages_total')
+            REGISTRY.inc('outbox_sends_total')
+            return await send()
+
+
+class CoalescingContext(commands.Context):
+    def outbox(self):
+        return self.bot.outbox(self.channel)
+
+
+    async def send(self, content=None, **kwargs):
+        outbox = self.outbox()
+        if outbox.accepts(content, kwargs):
+            return outbox.add(content, kwargs.get('embed'))
+        return await outbox.send_now(lambda: super(CoalescingContext, self).send(content, **kwargs))
+
+
+    async def send_now(self, content=None, **kwargs):
+        '''sends right away (after anything already queued) and returns the Message'''
+        return await self.outbox().send_now(lambda: super(CoalescingContext, self).send(content, **kwargs))
+
+
+    async def flush(self):
+        await self.outbox().flush()
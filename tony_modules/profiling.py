@@ -0,0 +1,106 @@
+'''
+Profilers for !profile
+The command being profiled runs on the event loop thread, so everything here watches that thread:
+    cProfile (deterministic, gives a pstats file) has to be enabled from it, the sampler reads its stack from outside
+'''
+
+import cProfile
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class StackSampler(threading.Thread):
+    '''samples another thread's stack every interval, for collapsed stack output (what flamegraph.pl/speedscope read)'''
+
+    def __init__(self, thread_id, interval=0.005):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._done = threading.Event()
+
+
+    def run(self):
+        while not self._done.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+
+    def collapsed(self):
+        return ''.join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class Profile():
+    '''
+    with Profile(alloc=...) as p: ...   (must be entered on the thread being profiled)
+    then p.files() gives (filename, bytes) pairs to attach, and p.summary() the top functions
+    '''
+
+    def __init__(self, alloc=False, interval=0.005):
+        self.alloc = alloc
+        self.profiler = cProfile.Profile()
+        self.sampler = StackSampler(threading.get_ident(), interval)
+        self._snapshot = None
+        self._alloc_diff = None
+        self.elapsed = 0
+
+
+    def __enter__(self):
+        if self.alloc:
+            tracemalloc.start(25)
+            self._snapshot = tracemalloc.take_snapshot()
+        self.sampler.start()
+        self._start = time.perf_counter()
+        self.profiler.enable()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.profiler.disable()
+        self.elapsed = time.perf_counter() - self._start
+        self.sampler.stop()
+        if self.alloc:
+            after = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            self._alloc_diff = after.compare_to(self._snapshot, 'traceback')
+
+
+    def summary(self, limit=15):
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+
+    def files(self, name):
+        self.profiler.create_stats()
+        files = [
+            (f"{name}.pstats", marshal.dumps(self.profiler.stats)),  # same format as Profile.dump_stats, load with pstats.Stats(path)
+            (f"{name}.collapsed.txt", self.sampler.collapsed().encode()),
+            (f"{name}.summary.txt", self.summary(50).encode())
+        ]
+        if self._alloc_diff is not None:
+            lines = [f"Top allocations by size while running (of {len(self._alloc_diff)} sites):"]
+            for stat in self._alloc_diff[:25]:
+                lines.append(f"\n{stat.size_diff / 1024:+.1f} KiB ({stat.count_diff:+} blocks)")
+                lines += [f"    {line}" for line in stat.traceback.format()]
+            files.append((f"{name}.alloc.txt", '\n'.join(lines).encode()))
+        return files
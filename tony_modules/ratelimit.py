@@ -0,0 +1,87 @@
+'''
+Rate limiters, for pacing things to a rate: token buckets (admission control) and sliding windows (Discord's send limit)
+'''
+
+import asyncio
+import time
+from collections import deque
+
+
+class TokenBucket():
+    '''
+    Holds up to capacity tokens and refills at rate tokens per second
+    Starts full, so a burst of capacity goes through right away and then things are paced to rate
+    '''
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self._stamp = time.monotonic()
+
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+
+    def take(self):
+        '''takes a token if there is one, returns whether it did'''
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+    def delay(self):
+        '''seconds until there's a token'''
+        self._refill()
+        return max(0, (1 - self.tokens) / self.rate)
+
+
+    async def wait(self):
+        '''takes a token, waiting for one if it has to'''
+        while not self.take():
+            await asyncio.sleep(self.delay())
+
+
+class SlidingWindow():
+    '''
+    Allows at most count takes in any window seconds
+    Discord's limits work like this, a token bucket's steady refill would let twice as many through in the first window
+    '''
+
+    def __init__(self, count, window):
+        self.count = count
+        self.window = window
+        self._taken = deque()  # when each take in the current window happened
+
+
+    def _expire(self):
+        now = time.monotonic()
+        while self._taken and now - self._taken[0] >= self.window:
+            self._taken.popleft()
+        return now
+
+
+    def take(self):
+        '''takes a slot if there is one, returns whether it did'''
+        now = self._expire()
+        if len(self._taken) < self.count:
+            self._taken.append(now)
+            return True
+        return False
+
+
+    def delay(self):
+        '''seconds until there's a slot'''
+        now = self._expire()
+        return 0 if len(self._taken) < self.count else self.window - (now - self._taken[0])
+
+
+    async def wait(self):
+        '''takes a slot, waiting for one if it has to'''
+        while not self.take():
+            await asyncio.sleep(self.delay())
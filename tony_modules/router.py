@@ -0,0 +1,104 @@
+import asyncio
+import re
+import traceback
+
+# Patterns shared by every message handler, compiled once
+URL_QUERY = re.compile(r'http\S+')
+WORD_QUERY = re.compile(r'\b\w+\b')
+PIPE_QUERY = re.compile(r'\$\(![a-z]+[^$()]*\)')  # innermost $(!cmd ...) of a message
+
+
+def substitute_pipes(content, run):
+    '''replaces every $(!cmd ...) in content with run('!cmd ...'), innermost first, and returns the result'''
+    sub = PIPE_QUERY.search(content)
+    while sub:
+        content = content.replace(sub[0], run(sub[0][2:-1]), 1)
+        sub = PIPE_QUERY.search(content)
+    return content
+
+
+class MessageInfo():
+    '''things handlers keep asking about a message, worked out once per message instead of once per handler'''
+
+    def __init__(self, msg):
+        self.lower = msg.content.lower()
+        self.urls = URL_QUERY.findall(msg.content)
+        self.words = set(WORD_QUERY.findall(self.lower))
+        self.command = msg.content.split(' ')[0][1:] if msg.content[:1] == '!' else None
+
+
+class Router():
+    '''
+    The one on_message listener
+    Cogs register handlers (coroutines taking (msg, info)) for the channels they care about instead of
+        adding their own listeners, then every message is filtered once and only reaches the handlers for its channel
+    Channel lists come from the config, the channel -> handler table is rebuilt whenever the config file changes
+    '''
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._routes = []  # (owner, handler, channels(config) or None, exclude(config) or None, filtered)
+        self._table = {}  # channel id: handlers just for that channel
+        self._everywhere = []  # handlers for all channels, minus the channels in excluded
+        self._excluded = {}  # handler: channel ids it skips
+        self._mtime = None
+        self._dirty = True
+
+
+    def register(self, owner, handler, channels=None, exclude=None, filtered=True):
+        '''
+        owner: what to unregister the handler by (usually the cog)
+        channels/exclude: functions of the config returning a channel id or list of ids, None means every channel
+        filtered: False to also see messages bot.filter rejects (DMs, banned channels, Tony's own messages)
+        '''
+        self._routes.append((owner, handler, channels, exclude, filtered))
+        self._dirty = True
+
+
+    def unregister(self, owner):
+        self._routes = [route for route in self._routes if route[0] is not owner]
+        self._dirty = True
+
+
+    def __len__(self):
+        return len(self._routes)
+
+
+    def _refresh(self):
+        mtime = self.bot.config.mtime()
+        if mtime == self._mtime and not self._dirty:
+            return
+        config = self.bot.config.read()
+
+        def ids(pick):
+            value = pick(config)
+            return set(value) if isinstance(value, list) else {value}
+
+        self._table = {}
+        self._everywhere = []
+        self._excluded = {}
+        for _, handler, channels, exclude, filtered in self._routes:
+            if channels is None:
+                self._everywhere.append((handler, filtered))
+                self._excluded[handler] = ids(exclude) if exclude is not None else set()
+            else:
+                for channel in ids(channels):
+                    self._table.setdefault(channel, []).append((handler, filtered))
+        self._mtime = mtime
+        self._dirty = False
+
+
+    async def dispatch(self, msg):
+        self._refresh()
+        allowed = self.bot.filter(msg)
+        channel = msg.channel.id
+        handlers = [handler for handler, filtered in self._table.get(channel, []) + self._everywhere
+                    if (allowed or not filtered) and channel not in self._excluded.get(handler, ())]
+        if not handlers:
+            return
+
+        info = MessageInfo(msg)
+        results = await asyncio.gather(*(handler(msg, info) for handler in handlers), return_exceptions=True)
+        for error in results:
+            if isinstance(error, Exception):
+                await self.bot.log(f"```{''.join(traceback.format_exception(type(error), error, error.__traceback__))[-1990:]}```")
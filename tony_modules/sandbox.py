@@ -0,0 +1,238 @@
+'''
+A pool of pre-warmed worker processes for running user code (!eval and !lambda) off the event loop
+
+Each worker is `python -m tony_modules.sandbox`, it reads one JSON job per line on stdin and writes
+    one JSON result per line back, with address space and CPU time capped by rlimits
+If a job runs past its wall clock timeout (or blows through an rlimit) its worker is killed and replaced
+
+This module is imported by the workers themselves, so it must not import discord or anything that needs TONYROOT
+'''
+
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import resource
+import sys
+import traceback
+from collections import OrderedDict
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))  # cwd workers need for `-m tony_modules.sandbox`
+MAX_LINE = 64 * 1024 * 1024  # biggest result we'll read back (files are base64'd into it)
+MAX_SENDS = 50  # a lambda stuck printing in a loop shouldn't flood the channel
+MAX_COMPILED = 128  # compiled sources each worker keeps, it lives for many jobs under the same address space limit
+
+
+class SandboxError(Exception):
+    pass
+
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# BOT SIDE
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class WorkerPool():
+    '''
+    Hands jobs to idle workers, at most `size` jobs run at once and the rest wait their turn
+    Jobs are dicts: {'kind': 'eval' or 'exec', 'code': source, 'env': {name: value}, 'files': [file dicts]}
+    Results are dicts: {'value': repr of an eval, 'stdout': captured output, 'sends': [send dicts], 'error': traceback}
+    '''
+
+    def __init__(self, size=2, timeout=10, cpu=5, memory=256 * 1024 * 1024):
+        self.size = size
+        self.timeout = timeout
+        self.cpu = cpu
+        self.memory = memory
+        self._idle = None
+
+
+    async def _spawn(self):
+        return await asyncio.create_subprocess_exec(
+            sys.executable, '-m', 'tony_modules.sandbox', str(self.memory),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+            cwd=PACKAGE_ROOT, limit=MAX_LINE
+        )
+
+
+    async def start(self):
+        '''spawns every worker up front, so the first !eval doesn't pay for interpreter startup'''
+
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in await asyncio.gather(*(self._spawn() for _ in range(self.size))):
+                self._idle.put_nowait(worker)
+
+
+    async def run(self, job):
+        await self.start()
+        worker = await self._idle.get()
+        try:
+            if worker is None:  # replacing it failed last time, try again
+                worker = await self._spawn()
+            worker.stdin.write(json.dumps({**job, 'cpu': self.cpu}).encode() + b'\n')
+            await worker.stdin.drain()
+            try:
+                line = await asyncio.wait_for(worker.stdout.readline(), self.timeout)
+            except asyncio.TimeoutError:
+                raise SandboxError(f"Timed out after {self.timeout}s") from None
+            except ValueError:  # what readline raises for a line over MAX_LINE
+                raise SandboxError(f"Result was over {MAX_LINE // 1024 // 1024}MB") from None
+            if not line:  # the worker died, most likely SIGXCPU or a MemoryError it couldn't recover from
+                await worker.wait()
+                raise SandboxError(f"Worker died (exit code {worker.returncode}), did you hit the {self.cpu}s CPU or {self.memory // 1024 // 1024}MB memory limit?")
+            result = json.loads(line)
+        except BaseException:  # whatever went wrong the worker's state is unknown, replace it
+            if worker is not None and worker.returncode is None:
+                worker.kill()
+                await worker.wait()
+            worker = None  # so a failed respawn doesn't put the dead one back
+            try:
+                worker = await self._spawn()
+            except Exception:
+                traceback.print_exc()
+            raise
+        finally:
+            self._idle.put_nowait(worker)
+        return result
+
+
+    async def close(self):
+        if self._idle is None:
+            return
+        while not self._idle.empty():
+            worker = self._idle.get_nowait()
+            if worker is not None and worker.returncode is None:
+                worker.kill()
+                await worker.wait()
+
+
+def encode_file(filename, data):
+    return {'filename': filename, 'data': base64.b64encode(data).decode()}
+
+
+def decode_file(f):
+    return f['filename'], base64.b64decode(f['data'])
+
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+# WORKER SIDE
+# ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+class File():
+    '''stands in for discord.File inside the sandbox (same fp and filename attributes)'''
+
+    def __init__(self, fp, filename=None):
+        if isinstance(fp, (bytes, bytearray)):
+            fp = io.BytesIO(fp)
+        elif isinstance(fp, str):
+            fp = open(fp, 'rb')
+        self.fp = fp
+        self.filename = filename or getattr(fp, 'name', 'file')
+
+
+class Namespace():
+    '''read only attribute access to a dict (ie the snapshot of the discord message a lambda gets)'''
+
+    def __init__(self, d):
+        for key, value in d.items():
+            object.__setattr__(self, key, Namespace(value) if isinstance(value, dict) else value)
+
+    def __setattr__(self, key, value):
+        raise AttributeError(f"can't set {key}")
+
+    def __repr__(self):
+        return f"Namespace({vars(self)})"
+
+
+def _encode_send(args, kwargs):
+    send = {'content': str(args[0]) if args and args[0] is not None else kwargs.get('content')}
+    if send['content'] is not None:
+        send['content'] = str(send['content'])
+    files = list(kwargs.get('files') or []) + ([kwargs['file']] if kwargs.get('file') is not None else [])
+    if files:
+        send['files'] = []
+        for f in files:
+            f.fp.seek(0)
+            send['files'].append(encode_file(f.filename, f.fp.read()))
+    if kwargs.get('embed') is not None:
+        embed = kwargs['embed']
+        send['embed'] = embed.to_dict() if hasattr(embed, 'to_dict') else dict(embed)
+    return send
+
+
+_compiled = OrderedDict()  # sha256 of source: code, least recently used first, so hot lambdas only get compiled once per worker
+
+
+def _compile(source, mode):
+    key = hashlib.sha256(f"{mode}:{source}".encode()).hexdigest()
+    if key in _compiled:
+        _compiled.move_to_end(key)
+        return _compiled[key]
+    code = _compiled[key] = compile(source, '<user code>', mode)
+    if len(_compiled) > MAX_COMPILED:
+        _compiled.popitem(last=False)
+    return code
+
+
+def _run(job):
+    import math  # what !eval has always had available
+    import random
+    import re
+
+    sends = []
+
+    def send(*args, **kwargs):
+        if len(sends) >= MAX_SENDS:
+            raise SandboxError(f"Too many prints (max {MAX_SENDS})")
+        sends.append(_encode_send(args, kwargs))
+
+    env = {'math': math, 'random': random, 're': re, 'File': File}
+    env.update({key: Namespace(value) if isinstance(value, dict) else value for key, value in job.get('env', {}).items()})
+    if job['kind'] == 'exec':
+        env['print'] = send
+        env['files'] = [File(data, filename) for filename, data in map(decode_file, job.get('files', []))]
+
+    stdout = io.StringIO()
+    sys.stdout = stdout
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    used = int(resource.getrusage(resource.RUSAGE_SELF).ru_utime + resource.getrusage(resource.RUSAGE_SELF).ru_stime)
+    limit = used + job['cpu'] if hard == resource.RLIM_INFINITY else min(used + job['cpu'], hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))  # SIGXCPU (which kills us) once this job uses its share
+    result = {}
+    try:
+        if job['kind'] == 'eval':
+            result['value'] = str(eval(_compile(job['code'], 'eval'), env))
+        else:
+            exec(_compile(job['code'], 'exec'), env)
+    except BaseException as e:
+        if isinstance(e, (MemoryError, RecursionError)):
+            result['error'] = f"{e.__class__.__name__}: {e}"
+        else:
+            result['error'] = ''.join(traceback.format_exception(type(e), e, e.__traceback__.tb_next))
+    finally:
+        sys.stdout = sys.__stdout__
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+    result['stdout'] = stdout.getvalue()
+    result['sends'] = sends
+    return result
+
+
+def main():
+    memory = int(sys.argv[1])
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    results = os.fdopen(os.dup(1), 'w')  # keep the real stdout for results, anything else that writes to fd 1 goes nowhere
+    os.dup2(os.open(os.devnull, os.O_WRONLY), 1)
+    sys.__stdout__ = sys.stdout = open(os.devnull, 'w')
+
+    for line in sys.stdin:
+        try:
+            result = _run(json.loads(line))
+        except MemoryError:  # couldn't even build the result
+            result = {'error': 'MemoryError', 'stdout': '', 'sends': []}
+        results.write(json.dumps(result) + '\n')
+        results.flush()
+
+
+if __name__ == '__main__':
+    main()
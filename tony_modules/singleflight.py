@@ -0,0 +1,118 @@
+'''
+Singleflight for commands: identical invocations (same command, same arguments) that overlap share one run
+
+Opt a command in with @singleflight (under @commands.command). The first invocation runs with its sends recorded,
+    any identical one sent before that run finished waits for it (if it's still going) and gets the same sends
+    replayed into its own channel, instead of repeating the same history scans, HTTP calls and renders
+If the first one is cancelled its followers don't get its partial output, one of them runs it again for the rest
+"Sent before it finished" goes by message id (the newest one the bot had seen when the run finished)
+    rather than when it starts running, so invocations queued behind the first one on the Handler thread share its run too
+Only what goes through ctx.send is shared, so it's for commands whose output doesn't depend on who asked
+'''
+
+import asyncio
+import functools
+import io
+
+import discord
+from discord.ext import commands
+
+from .metrics import REGISTRY
+
+LINGER = 120  # seconds a finished run is kept around for invocations that were sent while it ran but are queued behind it
+
+_flights = {}  # (command, arguments...): the latest Flight for it
+
+
+class Flight():
+    def __init__(self):
+        self.sends = []  # (content, other send kwargs, files as (filename, bytes)) for everything the run sent
+        self.error = None  # what the run raised
+        self.finished = None  # loop time it finished at
+        self.last_id = None  # id of the newest message seen when it finished, anything up to it was sent while it ran
+        self._done = asyncio.Event()
+
+    def finish(self, last_id, error=None):
+        self.error = error
+        self.finished = asyncio.get_event_loop().time()
+        self.last_id = last_id
+        self._done.set()
+
+    async def wait(self):
+        await self._done.wait()
+
+
+class Recording(commands.context.Context): # Wrapper for Context that keeps a copy of everything sent through it
+    def __init__(self, ctx, flight):
+        object.__setattr__(self, '_Recording__ctx', ctx)
+        object.__setattr__(self, '_Recording__flight', flight)
+
+    async def send(self, content=None, **kwargs):
+        return await self.__ctx.send(content, **self.__keep(content, kwargs))
+
+    async def send_now(self, content=None, **kwargs):
+        return await getattr(self.__ctx, 'send_now', self.__ctx.send)(content, **self.__keep(content, kwargs))
+
+    def __keep(self, content, kwargs): # Sending a File uses it up, so it's read once and sent from copies
+        files = [kwargs['file']] if kwargs.get('file') else kwargs.get('files') or []
+        files = [(file.filename, file.fp.read()) for file in files]
+        kwargs = {name: value for name, value in kwargs.items() if name not in ('file', 'files')}
+        self.__flight.sends.append((content, kwargs, files))
+        return with_files(kwargs, files)
+
+    def __getattr__(self, attr):
+        return getattr(self.__ctx, attr)
+
+    def __setattr__(self, attr, value):
+        return setattr(self.__ctx, attr, value)
+
+
+def with_files(kwargs, files):
+    if not files:
+        return kwargs
+    return dict(kwargs, files=[discord.File(io.BytesIO(data), filename=filename) for filename, data in files])
+
+
+def normalize(value):
+    return ' '.join(str(value).split())
+
+
+def singleflight(callback):
+    '''makes identical invocations of a command that overlap share one run, see the top of this file'''
+
+    @functools.wraps(callback)
+    async def run(*args, **kwargs):
+        position = next(num for num, arg in enumerate(args) if isinstance(arg, commands.Context)) # After self for cog commands
+        ctx = args[position]
+        key = (ctx.command.qualified_name, *map(normalize, args[position + 1:]), *sorted((name, normalize(value)) for name, value in kwargs.items()))
+
+        now = asyncio.get_event_loop().time()
+        for old in [old for old, flight in _flights.items() if flight.finished is not None and now - flight.finished > LINGER]:
+            del _flights[old]
+
+        flight = _flights.get(key)
+        while flight is not None and (flight.finished is None or ctx.message.id <= flight.last_id):
+            await flight.wait()
+            if isinstance(flight.error, asyncio.CancelledError): # Cut short, so it runs again with the first of its followers leading
+                if _flights.get(key) is flight:
+                    del _flights[key]
+                flight = _flights.get(key)
+                continue
+            REGISTRY.inc('singleflight_shared_total', command=key[0])
+            for content, rest, files in flight.sends:
+                await ctx.send(content, **with_files(rest, files))
+            if flight.error is not None:
+                raise flight.error
+            return
+
+        flight = _flights[key] = Flight()
+        error = None
+        try:
+            return await callback(*args[:position], Recording(ctx, flight), *args[position + 1:], **kwargs)
+        except BaseException as raised: # Cancelled too, the ones waiting on it mustn't wait forever
+            error = raised
+            raise
+        finally:
+            flight.finish(max(ctx.bot.last_seen, ctx.message.id), error)
+
+    return run
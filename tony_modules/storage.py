@@ -1,4 +1,7 @@
 import json
+import os
+
+from . import tracing
 
 
 class JSONStore():
@@ -16,11 +19,20 @@ class JSONStore():
     
 
     def _read_file(self):
+        with tracing.span('storage read', file=os.path.basename(self._file)):
+            try:
+                with open(self._file, 'r') as f:
+                    return json.loads(f.read())
+            except FileNotFoundError:
+                return {}
+    
+
+    def mtime(self):
+        '''when the file was last changed (None if it doesn't exist yet), for caching things built from its contents'''
         try:
-            with open(self._file, 'r') as f:
-                return json.loads(f.read())
+            return os.path.getmtime(self._file)
         except FileNotFoundError:
-            return {}
+            return None
     
 
     def read(self, key=None): #seperate set and get functions for when get item and set item are too confusing (ie, for cases when sync() is useful)
@@ -40,8 +52,9 @@ class JSONStore():
             raise ValueError('Sorry, JSON can only store string keys')
         data = self._read_file() #re-read whole file in case it was changed manually
         data[key] = value
-        with open(self._file, 'w') as json_file:
-            json_file.write(json.dumps(data))
+        with tracing.span('storage write', file=os.path.basename(self._file), key=key):
+            with open(self._file, 'w') as json_file:
+                json_file.write(json.dumps(data))
         
 
     def __setitem__(self, key, value):
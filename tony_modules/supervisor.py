@@ -0,0 +1,151 @@
+'''
+Runs the bot as a child process and replaces it without a gap when it needs a restart
+
+    python -m tony_modules.supervisor
+
+When the running bot asks for a restart (!restart, or a !rebase that changed a core module) a second bot is started
+    next to it as a standby: it imports everything and connects, but answers nothing
+Once the standby is connected the old bot is told to hand over (SIGTERM): it stops taking commands, lets the one it's
+    running finish, saves the commands still queued to storage/pending.json and disconnects
+Then the standby is told to take over (SIGUSR1): it sets its modules up and runs the saved commands, plus any it saw
+    arrive after the old bot disconnected
+If the standby fails to start the old bot just keeps running, if the running bot dies a new one is started
+
+Bots talk to the supervisor with lines on stdout (everything else they print is passed through)
+'''
+
+import asyncio
+import os
+import signal
+import sys
+import time
+
+RESTART = '@tony restart'  # running bot: start a standby to replace me
+READY = '@tony ready'  # standby: connected, ready to take over
+RELEASED = '@tony released'  # old bot: saved its queue and is disconnecting, the standby can go
+EXITED = '@tony exited'  # not a line a bot prints, what the supervisor queues when one's stdout closes
+
+PACKAGE_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STANDBY_TIMEOUT = 300  # seconds a standby gets to connect before it's given up on
+RESPAWN_DELAY = 5  # seconds before replacing a bot that died, so a crash on startup doesn't spin
+
+
+def announce(line):
+    '''how a bot tells the supervisor something (if it was started by one)'''
+    print(line, flush=True)
+
+
+def supervised():
+    return os.environ.get('TONY_SUPERVISED') == '1'
+
+
+def standby():
+    return os.environ.get('TONY_STANDBY') == '1'
+
+
+class Supervisor():
+    def __init__(self, args):
+        self.args = args  # what to run, ie [python, TSpark.py]
+        self.events = asyncio.Queue()  # (process, line)
+        self.active = None
+        self.standby = None
+        self.ready = False  # whether the standby has said READY
+        self.handing_over = False  # whether the active bot has been told to hand over
+
+
+    async def spawn(self, standby=False):
+        env = dict(os.environ, TONY_SUPERVISED='1', PYTHONUNBUFFERED='1')
+        if standby:
+            env['TONY_STANDBY'] = '1'
+        process = await asyncio.create_subprocess_exec(*self.args, stdout=asyncio.subprocess.PIPE, env=env, cwd=PACKAGE_ROOT)
+        asyncio.ensure_future(self.watch(process))
+        self.log(f"started {'standby' if standby else 'bot'} (pid {process.pid})")
+        return process
+
+
+    async def watch(self, process):
+        while True:
+            line = await process.stdout.readline()
+            if not line:
+                break
+            text = line.decode(errors='replace').rstrip('\n')
+            if text in (RESTART, READY, RELEASED):
+                await self.events.put((process, text))
+            else:
+                print(text, flush=True)
+        await process.wait()
+        await self.events.put((process, EXITED))
+
+
+    def log(self, text):
+        print(f"[supervisor {time.strftime('%H:%M:%S')}] {text}", flush=True)
+
+
+    async def give_up_on(self, process):
+        await asyncio.sleep(STANDBY_TIMEOUT)
+        if process is self.standby and not self.ready:
+            self.log(f"standby (pid {process.pid}) didn't connect in {STANDBY_TIMEOUT}s, keeping the running bot")
+            process.kill()
+
+
+    def take_over(self):
+        self.log(f"standby (pid {self.standby.pid}) taking over")
+        self.standby.send_signal(signal.SIGUSR1)
+        self.active, self.standby = self.standby, None
+        self.ready = self.handing_over = False
+
+
+    async def run(self):
+        self.active = await self.spawn()
+        while True:
+            process, event = await self.events.get()
+
+            if process is self.active:
+                if event == RESTART and self.standby is None:
+                    self.standby = await self.spawn(standby=True)
+                    asyncio.ensure_future(self.give_up_on(self.standby))
+                elif event in (RELEASED, EXITED) and self.ready:
+                    self.take_over()
+                elif event == EXITED and self.standby is None:
+                    self.log(f"bot (pid {process.pid}) exited with {process.returncode}, replacing it in {RESPAWN_DELAY}s")
+                    await asyncio.sleep(RESPAWN_DELAY)
+                    self.active = await self.spawn()
+                elif event == EXITED: # Died mid handover, the standby takes over as soon as it's ready
+                    self.handing_over = True
+
+            elif process is self.standby:
+                if event == READY:
+                    self.ready = True
+                    if self.handing_over or self.active.returncode is not None:
+                        self.take_over()
+                    else:
+                        self.handing_over = True
+                        self.active.send_signal(signal.SIGTERM)
+                elif event == EXITED:
+                    self.log(f"standby (pid {process.pid}) exited with {process.returncode}, keeping the running bot")
+                    self.standby, self.ready, self.handing_over = None, False, False
+                    if self.active.returncode is not None:
+                        self.active = await self.spawn()
+
+
+    def stop(self):
+        for process in (self.active, self.standby):
+            if process is not None and process.returncode is None:
+                process.terminate()
+
+
+def main():
+    supervisor = Supervisor([sys.executable, os.path.join(PACKAGE_ROOT, 'TSpark.py')] + sys.argv[1:])
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, loop.stop)
+    try:
+        loop.run_until_complete(supervisor.run())
+    except RuntimeError: # loop.stop() from a signal
+        pass
+    finally:
+        supervisor.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+'''
+Tracing spans for following one command through the bot
+A trace starts when a command is routed and every span opened while it runs (pipe sub-commands, the commands
+    themselves, storage and HTTP calls) records under its trace id, whichever thread it's on
+Finished traces are appended to a rotating file in Chrome's trace-event format, open it in
+    chrome://tracing or ui.perfetto.dev (each trace's spans carry its trace_id in their args)
+
+The current span is kept per asyncio task, or per thread outside of one (contextvars would do this, but they're 3.7+)
+    install() makes new tasks start under their creator's span and the loop's default executor a ContextExecutor,
+    so run_in_executor calls keep the caller's span, coroutines handed to the loop from another thread go through bind()
+'''
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import count
+
+from .watchdog import current_task
+
+_tasks = weakref.WeakKeyDictionary()  # asyncio task: its current span
+_threads = threading.local()  # .span: the current span of a thread that isn't running a task
+_ids = count(1)
+
+
+def _task():
+    try:
+        return current_task()
+    except RuntimeError: # No event loop in this thread (the Handler, executor threads)
+        return None
+
+
+def _get():
+    task = _task()
+    return _tasks.get(task) if task is not None else getattr(_threads, 'span', None)
+
+
+def _set(span):
+    '''makes span the current span of this task (or thread), returns the one it replaced'''
+    previous = _get()
+    task = _task()
+    if task is not None:
+        _tasks[task] = span
+    else:
+        _threads.span = span
+    return previous
+
+
+class Span():
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start', 'tid', 'args')
+
+    def __init__(self, name, parent=None, **args):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex[:16]
+        self.span_id = next(_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.start = time.perf_counter()
+        self.tid = threading.get_ident()
+        self.args = args
+        TRACER.threads.setdefault(self.tid, threading.current_thread().name)
+
+    def finish(self, **args):
+        self.args.update(args)
+        TRACER.record(self, time.perf_counter())
+        if self.parent_id is None:  # the whole trace is done
+            TRACER.flush()
+
+
+class Tracer():
+    '''collects finished spans and writes them out, does nothing until configure() is called'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events = []
+        self.threads = {}  # thread id: name, written once per file as metadata so the viewer labels the rows
+        self._named = set()
+        self.path = None
+
+
+    def configure(self, path, max_bytes=5 * 1024 * 1024, backups=3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+
+    def record(self, span, end):
+        if not self.enabled:
+            return
+        args = {'trace_id': span.trace_id, 'span_id': span.span_id, 'parent_id': span.parent_id}
+        args.update({key: str(value) for key, value in span.args.items()})
+        event = {'name': span.name, 'cat': span.name.split(' ')[0], 'ph': 'X', 'pid': os.getpid(), 'tid': span.tid,
+                 'ts': round(span.start * 1e6), 'dur': round((end - span.start) * 1e6), 'args': args}
+        with self._lock:
+            self._events.append(event)
+
+
+    def _rotate(self):
+        for num in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{num}"):
+                os.replace(f"{self.path}.{num}", f"{self.path}.{num + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self._named = set()
+
+
+    def flush(self):
+        if not self.enabled:
+            return
+        with self._lock:
+            events, self._events = self._events, []
+            if not events:
+                return
+            if os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                self._rotate()
+
+            lines = [] if os.path.exists(self.path) else ['[']  # the closing ] is optional in this format, so the file is always appendable
+            for tid in {event['tid'] for event in events} - self._named:
+                lines.append(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': self.threads.get(tid, str(tid))}}) + ',')
+                self._named.add(tid)
+            lines += [json.dumps(event) + ',' for event in events]
+            with open(self.path, 'a') as f:
+                f.write('\n'.join(lines) + '\n')
+
+
+TRACER = Tracer()
+
+
+def current():
+    return _get()
+
+
+def begin(name, root=False, **args):
+    '''starts a span under the current one, or a new trace if root, None if there's no trace to be part of'''
+    parent = _get()
+    if not TRACER.enabled or (parent is None and not root):
+        return None
+    return Span(name, None if root else parent, **args)
+
+
+def end(span, **args):
+    if span is not None:
+        span.finish(**args)
+
+
+def attach(span):
+    '''makes span the current span until detach(token), for when the start and end can't share a with block'''
+    return _set(span)
+
+
+def detach(token):
+    _set(token)
+
+
+@contextmanager
+def activate(span):
+    '''makes span the current span for the with block, without finishing it'''
+    token = _set(span)
+    try:
+        yield span
+    finally:
+        _set(token)
+
+
+@contextmanager
+def span(name, root=False, **args):
+    '''with span('name'): ... records the block as a span of the current trace (or starts one if root)'''
+    new = begin(name, root, **args)
+    if new is None:
+        yield None
+        return
+    token = _set(new)
+    try:
+        yield new
+    except BaseException as error:
+        new.args['error'] = repr(error)
+        raise
+    finally:
+        _set(token)
+        new.finish()
+
+
+def bind(coroutine):
+    '''wraps coroutine to run under the caller's current span, for handing coroutines to the loop from another thread'''
+
+    async def bound(parent):
+        token = _set(parent)
+        try:
+            return await coroutine
+        finally:
+            _set(token)
+    return bound(_get())
+
+
+def _run_under(span, fn, args, kwargs):
+    with activate(span):
+        return fn(*args, **kwargs)
+
+
+class ContextExecutor(ThreadPoolExecutor):
+    '''a ThreadPoolExecutor whose jobs run under the span that was current when they were submitted'''
+
+    def submit(self, fn, *args, **kwargs):
+        return super().submit(_run_under, _get(), fn, args, kwargs)
+
+
+def install(loop):
+    '''makes loop's tasks start under the span of whatever created them, and its run_in_executor jobs under their caller's'''
+
+    def create(loop, coroutine, **kwargs):
+        task = asyncio.Task(coroutine, loop=loop, **kwargs)
+        span = _get()
+        if span is not None:
+            _tasks[task] = span
+        return task
+
+    loop.set_task_factory(create)
+    loop.set_default_executor(ContextExecutor())
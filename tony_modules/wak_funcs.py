@@ -2,7 +2,6 @@
 # Might be broken into a bunch of files if the bot gets bloated
 import discord
 from discord.ext import commands
-import requests
 import random
 import re
 import discord
@@ -13,6 +12,10 @@ import os
 from pathlib import Path
 import io
 import json
+import time
+from .sandbox import WorkerPool, SandboxError, encode_file, decode_file
+from . import web
+from .singleflight import singleflight
 
 ROOTPATH = os.environ['TONYROOT']  # Bot's root path
 STORAGE_FILE = os.path.join(ROOTPATH, 'storage', 'wak_storage.json')
@@ -27,25 +30,88 @@ class WakStore(JSONStore):
             self['lambdas'] = {}
 
 
+class LambdaCache():
+    '''
+    Lambda sources kept in memory, only re-read from storage when its file changes (so manual edits still get picked up)
+    Compiling happens here once when a lambda is defined (so syntax errors show up then),
+        the sandbox workers keep their own compiled code keyed by a hash of the source
+    '''
+
+    def __init__(self, store, warm=None):
+        self.store = store
+        self._sources, self._mtime = warm or ({}, None)  # warm: another cache's handoff(), when reloading
+
+    def sources(self):
+        mtime = os.path.getmtime(STORAGE_FILE)
+        if mtime != self._mtime:
+            self._sources = self.store['lambdas']
+            self._mtime = mtime
+        return self._sources
+
+    def get(self, name):
+        '''returns the source of lambda name, or None if it doesn't exist'''
+        return self.sources().get(name)
+
+    def define(self, name, source):
+        '''compiles then stores a lambda, raises SyntaxError or ValueError (without storing anything) if it doesn't compile'''
+        compile(source, f'<lambda {name}>', 'exec')
+        lambdas = self.store['lambdas']
+        lambdas[name] = source
+        self.store.write('lambdas', lambdas)
+        self._mtime = None
+
+    def delete(self, name):
+        lambdas = self.store['lambdas']
+        del lambdas[name]
+        self.store.write('lambdas', lambdas)
+        self._mtime = None
+
+    def handoff(self):
+        return self._sources, self._mtime
+
+
+def snapshot(message):
+    '''the parts of a discord message a sandboxed lambda gets to see'''
+    return {
+        'id': message.id,
+        'content': message.content,
+        'jump_url': message.jump_url,
+        'created_at': message.created_at.isoformat(),
+        'author': {'id': message.author.id, 'name': message.author.name,
+            'display_name': message.author.display_name, 'mention': message.author.mention},
+        'channel': {'id': message.channel.id, 'name': getattr(message.channel, 'name', None)},
+        'guild': {'id': message.guild.id, 'name': message.guild.name} if message.guild else None
+    }
+
+
+async def replay(ctx, send):
+    '''sends something a sandboxed lambda printed'''
+    kwargs = {}
+    if 'files' in send:
+        kwargs['files'] = [discord.File(io.BytesIO(data), filename=filename) for filename, data in map(decode_file, send['files'])]
+    if 'embed' in send:
+        kwargs['embed'] = discord.Embed.from_dict(send['embed'])
+    await ctx.send(send['content'], **kwargs)
+
+
 class WakFuncs(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        self._config_mtime = None
+        self._tenor_chance = None
 
     @commands.command(name="eval", description = "<code> ~ Execute arbitary code")
     async def execute(self, ctx, *, cmd):  # if cmd arg is keyword only it lets discordpy know to pass in args as one string
-        import random  # import locally because I don't want eval to have global namespace
-        import math
-        import re
+        # runs in a sandbox worker process with random, math and re available, so a runaway expression can't freeze the bot
         try:
-            return_val = str(eval(cmd, locals()))  # only executes expressions, not statements.
-            # ALSO: FOR SOME UNGODLY REASON eval WILL NOT CONSERVE locals IF YOU HAVE NESTED SCOPE
-            # ie, eval("[math.sin(x) for x in range(10)]", None, locals()) WILL FAIL BECAUSE WHEN YOU DO LIST COMPREHENSION YOU CREATE A NESTED SCOPE, AND FOR SOME REASON THAT NESTED SCOPE IS EMPTY. IT DOESN'T CONTAIN locals
-            # BUT NOTICE THAT THIS WILL ONLY BREAK FOR LOCAL SCOPE. SO ALL YOUR VARIABLES HAVE TO BE DEFINED IN GLOBAL SCOPE
-            # THAT'S WHY IM PASSING IN locals() WHERE IM SUPPOSED TO BE PASSING IN globals()!!!!!!
-            # ALSO BE AWARE THAT WHEN YOU USE eval OUTSIDE OF A FUNCTION AND DON'T SPECIFY ANY SCOPE PARAMS IT'LL USE THE CORRECT LOCAL AND GLOBAL SCOPES BY DEFAULT, AND LOCAL SCOPE WILL BE EQUAL TO GLOBAL SCOPE SO IT'LL ALL WORK OUT
-            # THIS MEANS THAT I ALSO COULD HAVE IMPORTED THE MODULES OUTSIDE OF THE FUNCTION AND PASSED NO PARAMS INTO eval, HOWEVER THEN ALL MY GLOBALS WOULD BE AVAILABLE IN THE CALL TO eval WHICH WOULD BE A BIT OF A MESS
-        except BaseException as e:
-            return_val = "{}: {}".format(e.__class__.__name__, e)
+            result = await self.bot.sandbox.run({'kind': 'eval', 'code': cmd})
+        except SandboxError as e:
+            result = {'error': f"{e.__class__.__name__}: {e}", 'stdout': ''}
+        if 'error' in result:
+            return_val = result['error'].strip().split('\n')[-1]  # just "ExceptionName: message"
+        else:
+            return_val = result['value']
+        return_val = result['stdout'] + return_val
         if len(return_val) > 2000:
             await ctx.send("Sorry, the return value's too long to send")
         else:
@@ -58,7 +124,7 @@ class WakFuncs(commands.Cog):
     async def send_image(self, ctx, words):
         query = '+'.join(words) + '&source=lnms&tbm=isch'
         url = 'https://www.google.ca/search?q=' + query
-        data = requests.get(url).content.decode(errors='ignore')
+        data = web.get(url).content.decode(errors='ignore')
         imgs = re.findall(r'src="(https?://(?:encrypted-tbn0|t0)\.gstatic\.com/images.+?)"', data)
         if len(imgs) == 0:
             await ctx.send('No images found')
@@ -120,7 +186,7 @@ class WakFuncs(commands.Cog):
             search_words = words[0: num_words]
             search_term = ' '.join(search_words)
             api_key = self.bot.config['API_KEYS']['TENOR']
-            res = requests.get(endpoint.format(search=search_term, api_key=api_key)).json()
+            res = web.get(endpoint.format(search=search_term, api_key=api_key)).json()
             results = res['results']
             if len(results) > 0:
                 gif = random.choice(results)
@@ -129,25 +195,37 @@ class WakFuncs(commands.Cog):
             print("no results for '{}'".format(search_term))
 
 
-    @commands.Cog.listener()
-    async def on_message(self, mess):
-        if mess.author.id != self.bot.user.id:
+    # Message handlers, registered with bot.router in setup
 
-            # godworld spam
-            if mess.channel.id == self.bot.config['CHANNEL_IDS']['GOD_WORLD'] and not mess.content.startswith('http'):
-                spam_func = random.choice([self.send_image, self.send_gif])
-                await spam_func(mess.channel, mess.content.split(' '))
+    async def godworld_spam(self, mess, info):
+        if not mess.content.startswith('http'):
+            spam_func = random.choice([self.send_image, self.send_gif])
+            await spam_func(mess.channel, mess.content.split(' '))
+        else: # Links aren't spammed, they get the Tenor roll like everywhere else
+            await self.tenor_roll(mess, info)
 
-            else:
-                roll = random.randint(1, self.bot.config['TENOR_CHANCE'])
-                if roll == 1:
-                    await self.send_gif(mess.channel, mess.content.split(' '))
+    async def tenor_roll(self, mess, info):
+        roll = random.randint(1, self.tenor_chance)
+        if roll == 1:
+            await self.send_gif(mess.channel, mess.content.split(' '))
+
+    @property
+    def tenor_chance(self): # Only re-read from the config when it changes, not on every message
+        mtime = self.bot.config.mtime()
+        if mtime != self._config_mtime:
+            self._tenor_chance = self.bot.config['TENOR_CHANCE']
+            self._config_mtime = mtime
+        return self._tenor_chance
+
+    def cog_unload(self):
+        self.bot.router.unregister(self)
 
 
     @commands.command(description = "<search terms> ~ Search Wikipedia")
+    @singleflight
     async def wiki(self, ctx, *, query):
         query = query.replace(' ', '_')
-        response = requests.get(f"https://en.wikipedia.org/api/rest_v1/page/summary/{query}")
+        response = web.get(f"https://en.wikipedia.org/api/rest_v1/page/summary/{query}")
         if response.ok:
                 data = json.loads(response.content)
                 data_type = data['type']
@@ -172,9 +250,10 @@ class WakFuncs(commands.Cog):
     
 
     @commands.command(description = "~ Display Ontario COVID-19 data")
+    @singleflight
     async def covid(self, ctx, *args):
         api_url = "https://api.ontario.ca/api/drupal/page%2F2019-novel-coronavirus?fields=nid,field_body_beta,body"
-        response = requests.get(api_url)
+        response = web.get(api_url)
         if not response.ok:
             await ctx.send(f"error: ontario api returned a {response.status_code} status code")
             return
@@ -199,13 +278,13 @@ class WakFuncs(commands.Cog):
     @commands.command(
         name="lambda",
         description="[action] [lambda name] [code] [input] ~ Create and run python scripts",
-        usage = "\n\t<lambda name> <code> : Create a new lambda\n\t<lambda name> [input] : Execute a lambda with input\n\tdelete <lambda name> : Deletes the lambda\n\tsource <lambda name> : Prints a lambda's source code\n\tlist : Lists all existing lambdas\n\tInside a lambda the following variables are available:\n\t\tprint: A function to print to discord\n\t\targs: The input passed to this lambda\n\t\tfiles: A list of files attached to the message that called the lambda\n\t\tmessage: The discord message that called the lambda"
+        usage = "\n\t<lambda name> <code> : Create a new lambda\n\t<lambda name> [input] : Execute a lambda with input\n\tdelete <lambda name> : Deletes the lambda\n\tsource <lambda name> : Prints a lambda's source code\n\tlist : Lists all existing lambdas\n\tInside a lambda the following variables are available:\n\t\tprint: A function to print to discord\n\t\targs: The input passed to this lambda\n\t\tfiles: A list of files (with fp and filename) attached to the message that called the lambda\n\t\tmessage: A snapshot of the message that called the lambda (id, content, author, channel, guild)\n\t\tFile(data, filename): Make a file to print, i.e. print(file=File(b'hi', 'hi.txt'))"
     )
     async def user_command(self, ctx, *, text):
         split = re.split(r'[ \n]+', text, 1) # command and args are seperated by at least one space or newline or both
         command = split[0]
         args = '' if len(split) == 1 else split[1]
-        lambdas = self.bot.wstorage['lambdas']
+        lambdas = self.bot.lambdas.sources()
 
         # check if command is valid (useful for if you accidently do !lambda ```code``` or something)
         if not command.isidentifier():
@@ -215,8 +294,7 @@ class WakFuncs(commands.Cog):
         elif command == 'delete':
             lambda_name = args
             if lambda_name in lambdas:
-                del lambdas[lambda_name]
-                self.bot.wstorage.write('lambdas', lambdas)
+                self.bot.lambdas.delete(lambda_name)
                 await ctx.send(f"deleted {lambda_name}")
             else:
                 await ctx.send(f"can't delete {lambda_name} (no lambda with that name found)")
@@ -238,21 +316,26 @@ class WakFuncs(commands.Cog):
         # execute a lambda
         elif command in lambdas:
 
-            send_calls = [] # need to keep track of calls to ctx.send so pipes work (basically piping works by checking what was sent to ctx.send after awaiting user_command. BUT asyncio.ensure_future only *schedules* the corutine, it has no way of waiting for its completion like await does. And scheduled corutines cannot run until we hand program exectution back to asyncio (via returning from an awaited corutine or awaiting a corutine). and so, since the rest of this code (including exec) is synchronous, if we used asyncio.ensure_future there would actually be no way for ctx.send calls to run until we return from user_command. This would result in a race condition in asyncio where either it has to choose between running the rest of the pipe code (that's currently awaiting user_command) or running the scheduled ctx.sends (and the pipe code seems to win the race every time). Luckily there is an easy solution: instead of scheduling the ctx.send calls, keep track of all of them and then await them all before exiting this function)
-            def send(*args, **kwargs):
-                call = ctx.send(*args, **kwargs)
-                send_calls.append(call) # don't actually schedule ctx.send calls yet (wait until we can await them all)
-
+            # lambdas run in a sandbox worker process, everything they print is collected there and sent once they finish
+            # (in order, and before we return, so pipes still see the output)
             files = [
-                await attachment.to_file() 
+                encode_file(attachment.filename, await attachment.read())
                 for attachment in ctx.message.attachments
             ]
-            environment = {'print': send, 'args': args, 
-                'files': files, 'message': ctx.message}
-
-            exec(lambdas[command], environment)
-            for coro in send_calls: # run all ctx.send calls and wait for them all to finish before returning (so pipes work)
-                await coro # using a for loop instead of asyncio.wait because asyncio.wait doesn't maintain order of execution
+            job = {'kind': 'exec', 'code': self.bot.lambdas.get(command), 'files': files,
+                'env': {'args': args, 'message': snapshot(ctx.message)}}
+            try:
+                result = await self.bot.sandbox.run(job)
+            except SandboxError as e:
+                await ctx.send(f"```{e.__class__.__name__}: {e}```")
+                return
+
+            for send in result['sends']:
+                await replay(ctx, send)
+            if result['stdout']:
+                await ctx.send(result['stdout'][:2000])
+            if 'error' in result:
+                await ctx.send(f"```{result['error'][-1990:]}```")
         
         # lambda doesn't exist yet
         else:
@@ -264,9 +347,12 @@ class WakFuncs(commands.Cog):
 
             # create a new lambda if user sent code
             if matched_code is not None:
-                lambdas[command] = matched_code.group('code')
-                self.bot.wstorage.write('lambdas', lambdas)
-                await ctx.send(f"new lambda `{command}` created")
+                try:
+                    self.bot.lambdas.define(command, matched_code.group('code'))
+                except (SyntaxError, ValueError) as e:  # ValueError for source with null bytes
+                    await ctx.send(f"couldn't create `{command}`: {e.__class__.__name__}: {e}")
+                else:
+                    await ctx.send(f"new lambda `{command}` created")
 
             # don't know what to do, assume user was trying to execute a lambda
             else:
@@ -283,16 +369,43 @@ async def play_random_playable(bot):
         await bot.change_presence(activity=None)
 
 
-async def background(bot):
+async def background(bot, state):
     print('wak background process started')
     while bot.ws is None:  # wait until ws connection is made (there is a short period of time after bot.run is called during which the event loop has started but a discord websocket hasn't been established)
         await asyncio.sleep(1)
     while True:
+        if 'next' in state: # Reloaded, pick up the schedule the old task was on instead of changing the game right away
+            await asyncio.sleep(max(0, state['next'] - time.monotonic()))
         await play_random_playable(bot)
-        await asyncio.sleep(int((random.random() + 0.2) * 30 * 60))  # add 0.2 so minimal time isn't 0
+        state['next'] = time.monotonic() + int((random.random() + 0.2) * 30 * 60)  # add 0.2 so minimal time isn't 0
 
 
 def setup(bot):
-    bot.add_cog(WakFuncs(bot))
+    cog = WakFuncs(bot)
+    bot.add_cog(cog)
+    bot.router.register(cog, cog.godworld_spam, channels=lambda config: config['CHANNEL_IDS']['GOD_WORLD'])
+    bot.router.register(cog, cog.tenor_roll, exclude=lambda config: config['CHANNEL_IDS']['GOD_WORLD'])
+    warm = bot.handoff.pop(__name__, {}) # What teardown left behind, when reloading
     bot.wstorage = WakStore()
-    bot.loop.create_task(background(bot))
+    bot.lambdas = LambdaCache(bot.wstorage, warm=warm.get('lambdas'))
+
+    pool = warm.get('sandbox')
+    if type(pool) is WorkerPool: # Keep the running workers, unless sandbox.py itself was reloaded
+        bot.sandbox = pool
+    else:
+        if pool is not None:
+            bot.loop.create_task(pool.close())
+        bot.sandbox = WorkerPool(
+            size=bot.config['SANDBOX_WORKERS'] or 2,
+            timeout=bot.config['SANDBOX_TIMEOUT'] or 10,
+            cpu=bot.config['SANDBOX_CPU'] or 5,
+            memory=(bot.config['SANDBOX_MEMORY_MB'] or 256) * 1024 * 1024
+        )
+        bot.loop.create_task(bot.sandbox.start())
+    bot.wak_schedule = warm.get('schedule', {})
+    bot.start_task(__name__, background(bot, bot.wak_schedule))
+
+
+def teardown(bot):
+    bot.stop_tasks(__name__)
+    bot.handoff[__name__] = {'sandbox': bot.sandbox, 'lambdas': bot.lambdas.handoff(), 'schedule': bot.wak_schedule}
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from .metrics import REGISTRY
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+current_task = getattr(asyncio, 'current_task', None) or asyncio.Task.current_task  # asyncio.current_task is 3.7+, Task.current_task went in 3.9
+all_tasks = getattr(asyncio, 'all_tasks', None) or asyncio.Task.all_tasks  # same for all_tasks, though Task.all_tasks includes finished tasks
+
+
+class LoopWatchdog(threading.Thread):
+    '''
+    Measures event loop lag from a side thread
+    Every interval it schedules a no-op on the loop and times how long the loop takes to get to it
+        (recorded in the loop_lag_seconds histogram)
+    If the loop hasn't got to it within threshold something is blocking it, so the loop thread's stack is
+        captured on the spot and reported (with the command that was running) once the loop is free again
+    '''
+
+    def __init__(self, loop, report, threshold=0.5, interval=0.25, cooldown=60):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.loop = loop
+        self.loop_thread = threading.get_ident()  # must be constructed on the loop's thread
+        self.report = report  # coroutine function taking the report text
+        self.threshold = threshold
+        self.interval = interval
+        self.cooldown = cooldown  # minimum seconds between reports, one long stall shouldn't become a wall of them
+        self.running = weakref.WeakKeyDictionary()  # task: command it's running
+        self._last_report = 0
+
+
+    def track(self, task, command):
+        self.running[task] = command
+
+
+    def untrack(self, task):
+        self.running.pop(task, None)
+
+
+    def _blocked(self):
+        frame = sys._current_frames().get(self.loop_thread)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        ours = [f for f in stack if f.filename.startswith(PROJECT_ROOT)]  # innermost frame in our own code is the culprit
+        culprit = ours[-1] if ours else stack[-1]
+        task = current_task(self.loop)
+        return self.running.get(task) if task is not None else None, culprit, stack
+
+
+    def run(self):
+        while True:
+            answered = threading.Event()
+            sent = time.monotonic()
+            self.loop.call_soon_threadsafe(answered.set)
+
+            blocked = None
+            if not answered.wait(self.threshold):
+                blocked = self._blocked()
+                answered.wait()
+            lag = time.monotonic() - sent
+            REGISTRY.observe('loop_lag_seconds', lag)
+
+            if blocked is not None and time.monotonic() - self._last_report >= self.cooldown:
+                self._last_report = time.monotonic()
+                command, culprit, stack = blocked
+                text = (f"Event loop blocked for {lag:.2f}s" + (f" while running !{command}" if command else '') +
+                        f"\nat {os.path.relpath(culprit.filename, PROJECT_ROOT)}:{culprit.lineno} in {culprit.name}\n" +
+                        ''.join(traceback.format_list(stack[-8:])))
+                asyncio.run_coroutine_threadsafe(self.report(text), self.loop)
+
+            time.sleep(self.interval)
@@ -0,0 +1,52 @@
+'''
+Outbound HTTP, timed into the metrics registry and traced
+Drop-in replacements for requests.get/post, and session() for a requests.Session
+requests itself is only imported on first use, it's one of the slowest imports the bot has
+'''
+
+from urllib.parse import urlparse
+
+from . import tracing
+from .metrics import REGISTRY
+
+
+def _timed(send, method, url, **kwargs):
+    parsed = urlparse(url)
+    host = parsed.netloc
+    with tracing.span(f"http {method.upper()}", host=host, path=parsed.path) as span, REGISTRY.timer('http', host=host): # Not the query, it can hold API keys
+        response = send(method, url, **kwargs)
+        if span is not None:
+            span.args['status'] = response.status_code
+    if response.status_code >= 400:
+        REGISTRY.inc('http_failures_total', host=host)
+    return response
+
+
+_Session = None
+
+
+def session():
+    '''a new requests.Session that times and traces its requests'''
+    global _Session
+    if _Session is None: # Only built (and requests imported) the first time something asks for one
+        import requests
+
+        class Session(requests.Session):
+            def request(self, method, url, **kwargs):
+                return _timed(super().request, method, url, **kwargs)
+
+        _Session = Session
+    return _Session()
+
+
+def request(method, url, **kwargs):
+    import requests
+    return _timed(requests.request, method, url, **kwargs)
+
+
+def get(url, params=None, **kwargs):
+    return request('get', url, params=params, **kwargs)
+
+
+def post(url, data=None, json=None, **kwargs):
+    return request('post', url, data=data, json=json, **kwargs)